@@ -0,0 +1,145 @@
+#
+# Author: Jordan Doyle
+#
+
+import struct
+import xml.etree.ElementTree as ElementTree
+
+# Chunk types of the binary XML format aapt and aapt2 compile AndroidManifest.xml into.
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+UTF8_FLAG = 1 << 8
+
+TYPE_NULL = 0x00
+TYPE_REFERENCE = 0x01
+TYPE_ATTRIBUTE = 0x02
+TYPE_STRING = 0x03
+TYPE_FLOAT = 0x04
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+TYPE_INT_BOOLEAN = 0x12
+
+ANDROID_NAMESPACE = "http://schemas.android.com/apk/res/android"
+# Shrunk manifests may drop the names of framework attributes, they are still found by their resource id.
+ANDROID_ATTRIBUTES = {0x01010003: "name", 0x0101000e: "enabled", 0x0101000f: "debuggable", 0x01010010: "exported",
+                      0x01010021: "targetPackage", 0x01010024: "value", 0x01010202: "targetActivity"}
+
+
+def read_length(data, position, utf8):
+    # Lengths of UTF-8 strings take one or two bytes and of UTF-16 strings one or two 16-bit units, the high bit of
+    # the first one marks the long form.
+    if utf8:
+        length = data[position]
+        if length & 0x80:
+            return ((length & 0x7F) << 8) | data[position + 1], position + 2
+        return length, position + 1
+
+    length, = struct.unpack_from("<H", data, position)
+    if length & 0x8000:
+        return ((length & 0x7FFF) << 16) | struct.unpack_from("<H", data, position + 2)[0], position + 4
+    return length, position + 2
+
+
+def read_string_pool(data, start):
+    string_count, style_count, flags, strings_start = struct.unpack_from("<IIII", data, start + 8)
+    header_size, = struct.unpack_from("<H", data, start + 2)
+    utf8 = bool(flags & UTF8_FLAG)
+
+    strings = []
+    for index in range(string_count):
+        offset, = struct.unpack_from("<I", data, start + header_size + index * 4)
+        position = start + strings_start + offset
+        if utf8:
+            # The length in UTF-16 units comes first and is not needed, the byte length follows it.
+            length, position = read_length(data, position, True)
+            length, position = read_length(data, position, True)
+            strings.append(data[position:position + length].decode("utf-8", errors="replace"))
+        else:
+            length, position = read_length(data, position, False)
+            strings.append(data[position:position + length * 2].decode("utf-16-le", errors="replace"))
+
+    return strings
+
+
+def format_value(strings, raw_value, data_type, value):
+    if raw_value != 0xFFFFFFFF and raw_value < len(strings):
+        return strings[raw_value]
+    if data_type == TYPE_STRING:
+        return strings[value] if value < len(strings) else ""
+    if data_type == TYPE_INT_BOOLEAN:
+        return "true" if value != 0 else "false"
+    if data_type in (TYPE_REFERENCE, TYPE_ATTRIBUTE):
+        return ("@" if data_type == TYPE_REFERENCE else "?") + format(value, "08x")
+    if data_type == TYPE_INT_HEX:
+        return "0x" + format(value, "08x")
+    if data_type == TYPE_FLOAT:
+        return repr(struct.unpack("<f", struct.pack("<I", value))[0])
+    if data_type == TYPE_NULL:
+        return ""
+    return str(struct.unpack("<i", struct.pack("<I", value))[0]) if data_type == TYPE_INT_DEC else str(value)
+
+
+def decode(data):
+    # Returns the root element of the binary XML document, attribute names are qualified with their namespace like
+    # ElementTree does for text documents.
+    try:
+        return read_document(data)
+    except (struct.error, IndexError) as error:
+        raise ValueError("Invalid binary XML document, " + str(error) + ".")
+
+
+def read_document(data):
+    if len(data) < 8 or struct.unpack_from("<H", data, 0)[0] != RES_XML_TYPE:
+        raise ValueError("Not a binary XML document.")
+
+    strings = []
+    resource_ids = []
+    root = None
+    stack = []
+    position = struct.unpack_from("<H", data, 2)[0]
+    end = min(len(data), struct.unpack_from("<I", data, 4)[0])
+    while position + 8 <= end:
+        chunk_type, header_size, chunk_size = struct.unpack_from("<HHI", data, position)
+        if chunk_size < 8 or position + chunk_size > len(data):
+            raise ValueError("Invalid binary XML chunk at offset " + str(position) + ".")
+
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = read_string_pool(data, position)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            resource_ids = list(struct.unpack_from("<" + str((chunk_size - header_size) // 4) + "I", data,
+                                                   position + header_size))
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            element = read_element(data, position + header_size, strings, resource_ids)
+            if stack:
+                stack[-1].append(element)
+            elif root is None:
+                root = element
+            stack.append(element)
+        elif chunk_type == RES_XML_END_ELEMENT_TYPE and stack:
+            stack.pop()
+
+        position += chunk_size
+
+    if root is None:
+        raise ValueError("Binary XML document has no root element.")
+    return root
+
+
+def read_element(data, position, strings, resource_ids):
+    namespace, name, attribute_start, attribute_size, attribute_count = struct.unpack_from("<IIHHH", data, position)
+    element = ElementTree.Element(strings[name] if name < len(strings) else "")
+
+    for index in range(attribute_count):
+        attribute_position = position + attribute_start + index * attribute_size
+        namespace, name, raw_value, data_type, value = struct.unpack_from("<III3xBI", data, attribute_position)
+        attribute_name = strings[name] if name < len(strings) else ""
+        if name < len(resource_ids) and resource_ids[name] in ANDROID_ATTRIBUTES:
+            attribute_name = "{" + ANDROID_NAMESPACE + "}" + ANDROID_ATTRIBUTES[resource_ids[name]]
+        elif namespace != 0xFFFFFFFF and namespace < len(strings):
+            attribute_name = "{" + strings[namespace] + "}" + attribute_name
+        element.set(attribute_name, format_value(strings, raw_value, data_type, value))
+
+    return element
@@ -1,27 +1,51 @@
 #
 # Author: Jordan Doyle
 #
-# usage: build.py [-h] [-o OUTPUT] [-v] [-c]
+# usage: build.py [-h] [-o OUTPUT] [-v] [-c] [-j JOBS] [-g GRADLE_HOME] [-k] [-t TIMEOUT]
+#                 [-s OUTPUT_TIMEOUT]
 #
 # options:
 #   -h, --help                          show this help message and exit
 #   -o OUTPUT, --output OUTPUT          set output directory
 #   -v, --verbose                       output all log messages
 #   -c, --clean                         delete previous builds
+#   -j JOBS, --jobs JOBS                maximum concurrent builds
+#   -g GRADLE_HOME, --gradle-home GRADLE_HOME
+#                                       shared Gradle user home
+#   -k, --keep-daemons                  leave Gradle daemons running after the build
+#   -t TIMEOUT, --timeout TIMEOUT       minutes before a Gradle build is stopped
+#   -s OUTPUT_TIMEOUT, --output-timeout OUTPUT_TIMEOUT
+#                                       minutes without Gradle output before a build is stopped
 #
 
 import argparse
 import logging
 import os
 import shutil
-import subprocess
 import sys
-from pathlib import Path
+
+import buildcache
+import buildfile
+import gradle
+import project
+import scheduler
+import toolchain
+import worktree
+
+VARIANT = "debug"
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("-o", "--output", type=str, default='output', help="set output directory")
 arg_parser.add_argument("-v", "--verbose", default=False, action="store_true", help="output all log messages")
 arg_parser.add_argument("-c", "--clean", default=False, action="store_true", help="delete previous builds")
+arg_parser.add_argument("-j", "--jobs", type=int, default=scheduler.BUILD_JOBS, help="maximum concurrent builds")
+arg_parser.add_argument("-g", "--gradle-home", type=str, default=None, help="shared Gradle user home")
+arg_parser.add_argument("-k", "--keep-daemons", default=False, action="store_true",
+                        help="leave Gradle daemons running after the build")
+arg_parser.add_argument("-t", "--timeout", type=int, default=gradle.BUILD_TIMEOUT,
+                        help="minutes before a Gradle build is stopped")
+arg_parser.add_argument("-s", "--output-timeout", type=int, default=gradle.OUTPUT_TIMEOUT,
+                        help="minutes without Gradle output before a build is stopped")
 args = arg_parser.parse_args()
 
 log_level = logging.DEBUG if args.verbose else logging.INFO
@@ -44,6 +68,9 @@ if args.clean:
     if os.path.isdir(dapk_directory):
         logging.info("Deleting previous debug APK files.")
         shutil.rmtree(dapk_directory)
+    if os.path.isdir(os.path.join(args.output, worktree.WORKTREE_DIRECTORY, VARIANT)):
+        logging.info("Deleting previous debug worktrees.")
+        shutil.rmtree(os.path.join(args.output, worktree.WORKTREE_DIRECTORY, VARIANT))
 
 if not os.path.isdir(dapk_directory):
     logging.info("Creating new debug APK directory (" + dapk_directory + ").")
@@ -52,135 +79,107 @@ if not os.path.isdir(dapk_directory):
 if "JAVA_HOME" not in os.environ:
     logging.warning("Java home environment variable is not set.")
 
-if "JAVA_11_HOME" not in os.environ:
-    logging.warning("Java 11 home environment variable is not set.")
-
-
-def update_build_file(build_file):
-    if not os.path.isfile(build_file + ".orig"):
-        logging.info("Creating backup of gradle build file.")
-        shutil.copy(build_file, build_file + ".orig")
-
-    with open(build_file, "r") as file:
-        logging.info("Reading app gradle file contents.")
-        contents = file.readlines()
-
-    build_block = debug_block = debug_found = debugging = False
-    other_block = 0
-    for index, line in enumerate(contents):
-        if build_block:
-            if debug_block:
-                if "debuggable true" in line:
-                    debugging = True
-                elif "}" in line and "{" not in line:
-                    debug_block = False
-                    if not debugging:
-                        logging.info("Adding 'debuggable true' to the gradle build.")
-                        contents.insert(index, "\t\t\tdebuggable true\n")
-                    debugging = False
-                continue
-            elif "debug {" in line:
-                debug_block = True
-                debug_found = True
-                continue
-
-            if other_block > 0:
-                if "}" in line and "{" not in line:
-                    other_block = other_block - 1
-                elif "{" in line and "}" not in line:
-                    other_block = other_block + 1
-                continue
-
-            if "{" in line and "}" not in line:
-                other_block = other_block + 1
-                continue
-
-            if "}" in line and "{" not in line:
-                build_block = False
-                if not debug_found:
-                    logging.info("Adding debug release to the app gradle build.")
-                    contents.insert(index, "\t\t}\n")
-                    contents.insert(index, "\t\t\tdebuggable true\n")
-                    contents.insert(index, "\t\tdebug {\n")
-        elif "buildTypes {" in line:
-            build_block = True
-            continue
-
-    with open(build_file, "w") as file:
-        logging.info("Writing updated content to app gradle file.")
-        file.writelines(contents)
-
-
-def copy_apk_file(title, source, destination, name):
-    file = None
-    for file_path in Path(source).rglob("*.apk"):
-        file = str(file_path.resolve())
-        logging.info("Debug APK for " + title + " is " + file)
-        break
 
+def link_apk_file(title, layout, destination, name):
+    file = project.find_output_apk(layout, "debug")
     if file is None:
         logging.error("Failed to find the debug APK for " + title + ".")
         return
+    logging.info("Debug APK for " + title + " is " + file)
 
-    logging.info("Copying debug APK to DAPK directory.")
-    shutil.copy(file, str(os.path.join(destination, name + ".apk")))
+    logging.info("Linking debug APK to DAPK directory.")
+    worktree.replace_link(file, os.path.join(destination, name + ".apk"))
 
 
-def build_apk(title, source, build):
+def build_apk(title, log_file, build, java_home):
     logging.info("Running gradle build on " + title + ".")
-    command = "gradlew.sh assembleDebug -Dorg.gradle.java.home=" + os.environ.get("JAVA_11_HOME") \
-        if title in ["Ad-Free", "Gpstest", "Timetable"] else "gradlew.sh assembleDebug"
-
-    exit_code = subprocess.call(os.getcwd() + "/" + command + " > " + source + "/build.log 2>&1", cwd=build, shell=True)
-    if exit_code != 0:
+    gradle_run = gradle.run_gradle(daemon_pool.command(build, ["assembleDebug"], java_home), build, log_file,
+                                   timeout=args.timeout * 60, output_timeout=args.output_timeout * 60)
+    if gradle_run.exit_code != 0:
         logging.error("Gradle build for " + title + " failed. See log for details.")
 
-    return exit_code
-
+    return gradle_run
 
-for apk_file in os.listdir(apk_directory):
-    if not os.path.isfile(os.path.join(apk_directory, apk_file)) or not apk_file.endswith(".apk"):
-        logging.info("Ignoring file " + apk_file)
-        continue
 
-    app = os.path.splitext(os.path.basename(apk_file))[0]
+def build_app(app):
+    apk_file = app + ".apk"
     app_title = ''.join([i for i in app if not i.isdigit()]).replace('_', ' ').title().strip()
 
-    if os.path.isfile(os.path.join(dapk_directory, apk_file)):
-        logging.info(app_title + " already built, Skipping.")
-        continue
-
     logging.info("Processing '" + app_title + "'.")
 
     source_directory = os.path.join(args.output, "source", app)
     if not os.path.isdir(source_directory):
         logging.error("Source directory (" + source_directory + ") does not exist.")
-        continue
-
-    for path in Path(source_directory).rglob('local.properties'):
-        properties_file = str(path.resolve())
-        os.remove(properties_file)
-
-    gradle_build_file = None
-    for path in Path(source_directory).rglob('*/build.gradle'):
-        gradle_build_file = str(path.resolve())
-        logging.info("Gradle build file for " + app_title + " is " + gradle_build_file)
-        break
-
+        return "failed"
+
+    # The app is built in its own worktree of the extracted source, so the JaCoCo build of the same app can run at the
+    # same time and the extracted source is never patched.
+    worktree_directory = worktree.create_worktree(
+        source_directory, worktree.get_worktree_directory(args.output, VARIANT, app))
+    layout = project.scan_project(worktree_directory)
+    for properties_file in layout.properties_files:
+        if os.path.isfile(properties_file):
+            os.remove(properties_file)
+
+    gradle_build_file = layout.app_build_file
     if gradle_build_file is None:
         logging.error("Failed to find gradle build file for " + app_title + ".")
-        continue
-    update_build_file(gradle_build_file)
-
-    build_directory = None
-    for path in Path(source_directory).rglob("build.gradle"):
-        build_directory = os.path.dirname(str(path.resolve()))
-        logging.info("Build directory for " + app_title + " is " + build_directory)
-        break
+        return "failed"
+    logging.info("Gradle build file for " + app_title + " is " + gradle_build_file)
+    buildfile.update_build_file(gradle_build_file, {"debug": [buildfile.DEBUGGABLE]})
 
+    build_directory = layout.build_directory
     if build_directory is None:
         logging.error("Failed to find build directory for " + app_title + ".")
-        continue
+        return "failed"
+    logging.info("Build directory for " + app_title + " is " + build_directory)
+
+    java_home = toolchain_resolver.resolve(app, build_directory)
+    logging.info("JDK for " + app_title + " is " + str(java_home or "the default JDK") + ".")
+
+    # Apps are only built again when their patched source, the Gradle tasks or the JDK changed since the last build.
+    fingerprint = buildcache.get_fingerprint(worktree_directory, ["assembleDebug"])
+    if build_cache.lookup(app, fingerprint, java_home, os.path.join(dapk_directory, apk_file)) is not None:
+        logging.info(app_title + " already built, Skipping.")
+        return "skipped"
+
+    gradle_log_file = os.path.abspath(os.path.join(log_directory, app + ".gradle.log"))
+    project.unlink_output_apks(layout)
+    gradle_run = build_apk(app_title, gradle_log_file, build_directory, java_home)
+    build_scheduler.add_details(app, {"gradle": gradle_run.summary()})
+    toolchain_resolver.record(app, build_directory, java_home, gradle_run.reason)
+    if gradle_run.exit_code != 0:
+        return "failed"
 
-    if build_apk(app_title, source_directory, build_directory) == 0:
-        copy_apk_file(app_title, source_directory, dapk_directory, app)
+    link_apk_file(app_title, layout, dapk_directory, app)
+    if not os.path.isfile(os.path.join(dapk_directory, apk_file)):
+        return "failed"
+
+    build_cache.record(app, fingerprint, java_home, os.path.join(dapk_directory, apk_file))
+    return "built"
+
+
+apps = []
+for apk_file in sorted(os.listdir(apk_directory)):
+    if not os.path.isfile(os.path.join(apk_directory, apk_file)) or not apk_file.endswith(".apk"):
+        logging.info("Ignoring file " + apk_file)
+        continue
+    apps.append(os.path.splitext(os.path.basename(apk_file))[0])
+
+# Each app's messages and Gradle output are written to its own log files, builds of different apps run concurrently.
+log_directory = os.path.join(args.output, "logs", "build")
+build_scheduler = scheduler.BuildScheduler(log_directory, args.jobs)
+build_cache = buildcache.BuildCache(os.path.join(dapk_directory, buildcache.CACHE_FILE))
+# The JDK for each app is chosen from its Gradle and Android Gradle Plugin versions, the JDK that built an app is
+# remembered for the next run.
+toolchain_resolver = toolchain.ToolchainResolver(os.path.join(args.output, toolchain.TOOLCHAIN_FILE))
+# Gradle daemons are kept warm between apps and share one Gradle user home and build cache, they are registered for
+# this script only and stopped once every app is built unless another run is going to use them.
+daemon_pool = gradle.DaemonPool(args.gradle_home, "build")
+try:
+    build_scheduler.run(apps, build_app)
+finally:
+    if not args.keep_daemons:
+        daemon_pool.stop()
+build_scheduler.log_summary()
+build_scheduler.write_summary()
@@ -0,0 +1,98 @@
+#
+# Author: Jordan Doyle
+#
+
+import hashlib
+import os
+import threading
+
+import buildfile
+import project
+import statefile
+
+CACHE_FILE = "build_cache.json"
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_tree(directory):
+    # Files are hashed in a fixed order with their relative paths, so the same tree always has the same hash. Backups
+    # and fingerprints of patched files and Gradle output are not build inputs.
+    tree_hash = hashlib.sha256()
+    for current_directory, directories, files in os.walk(directory):
+        directories[:] = sorted(name for name in directories if name not in project.PRUNED_DIRECTORIES and not (
+                name == "build" and any(build_file in files for build_file in project.BUILD_FILES)))
+
+        for file in sorted(files):
+            if file.endswith(".orig") or file.endswith(buildfile.FINGERPRINT_SUFFIX):
+                continue
+
+            file_path = os.path.join(current_directory, file)
+            tree_hash.update(os.path.relpath(file_path, directory).encode() + b"\0")
+            if os.path.islink(file_path):
+                tree_hash.update(os.readlink(file_path).encode())
+                continue
+            with open(file_path, "rb") as tree_file:
+                for chunk in iter(lambda: tree_file.read(CHUNK_SIZE), b""):
+                    tree_hash.update(chunk)
+            tree_hash.update(b"\0")
+
+    return tree_hash.hexdigest()
+
+
+def get_java_identity(java_home=None):
+    java_home = java_home or os.environ.get("JAVA_HOME")
+    if java_home is None:
+        return None
+
+    # The release file of a JDK names its exact version, a JDK updated in place gets a new identity.
+    release = ""
+    release_file = os.path.join(java_home, "release")
+    if os.path.isfile(release_file):
+        with open(release_file, errors="replace") as release_data:
+            release = release_data.read()
+
+    return hashlib.sha256((os.path.realpath(java_home) + "\0" + release).encode()).hexdigest()
+
+
+def get_fingerprint(source_directory, tasks, template_directory=None):
+    # The source is fingerprinted after it is patched, so the patches and the instrumentation classes added to it are
+    # part of the fingerprint along with the templates themselves.
+    inputs = [hash_tree(source_directory), " ".join(tasks)]
+    if template_directory is not None:
+        inputs.append(hash_tree(template_directory))
+
+    return hashlib.sha256("\0".join(inputs).encode()).hexdigest()
+
+
+class BuildCache:
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = statefile.load(cache_file) or {}
+
+    def lookup(self, app, fingerprint, java_home, apk_file):
+        with self.lock:
+            entry = self.entries.get(app)
+
+        # A build is only reused for the exact same inputs and JDK, and only while its APK file still exists.
+        if entry is None or entry["fingerprint"] != fingerprint or not os.path.isfile(apk_file):
+            return None
+        if entry["javaHome"] != java_home or get_java_identity(java_home) != entry["java"]:
+            return None
+        return entry
+
+    def record(self, app, fingerprint, java_home, apk_file):
+        with self.lock:
+            self.entries[app] = {"fingerprint": fingerprint, "javaHome": java_home,
+                                 "java": get_java_identity(java_home), "apk": os.path.basename(apk_file)}
+            entry = self.entries[app]
+
+            # build.py and jacoco.py --combined share the cache of the debug APK directory, only this app's entry is
+            # written into the current file.
+            def merge(entries):
+                entries = entries or {}
+                entries[app] = entry
+                return entries
+
+            statefile.update(self.cache_file, merge)
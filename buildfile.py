@@ -0,0 +1,348 @@
+#
+# Author: Jordan Doyle
+#
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import worktree
+
+FINGERPRINT_SUFFIX = ".fingerprint"
+TRANSFORM_VERSION = 2
+
+DEBUGGABLE = "debuggable"
+TEST_COVERAGE = "testCoverageEnabled"
+# Names each property is set with in Groovy and Kotlin build files, AGP 7.3 replaced test coverage with one property
+# for each kind of test.
+PROPERTY_NAMES = {DEBUGGABLE: {"debuggable", "isDebuggable"},
+                  TEST_COVERAGE: {"testCoverageEnabled", "isTestCoverageEnabled", "enableAndroidTestCoverage"}}
+KOTLIN_PROPERTIES = {DEBUGGABLE: "isDebuggable", TEST_COVERAGE: "isTestCoverageEnabled"}
+# Calls that select a build type by name, e.g. getByName("debug") in Kotlin build files.
+NAMED_BLOCKS = {"getByName", "named", "maybeCreate", "create"}
+ANDROIDX_DEPENDENCIES = ("androidx.appcompat:appcompat", "libs.androidx.appcompat")
+
+
+class Token:
+
+    def __init__(self, kind, start, end, text):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.text = text
+
+
+class Block:
+
+    def __init__(self, name, argument, start, parent):
+        self.name = name
+        self.argument = argument
+        self.start = start
+        self.end = None
+        self.parent = parent
+        self.children = []
+        # Tokens directly inside the block, the tokens of nested blocks are kept by the nested blocks.
+        self.tokens = []
+
+    def is_named(self, name):
+        return self.name == name or (self.name in NAMED_BLOCKS and self.argument == name)
+
+    def find(self, name):
+        return next((child for child in self.children if child.is_named(name)), None)
+
+
+def read_string(contents, index):
+    # Groovy and Kotlin strings may be single or triple quoted, interpolated expressions may contain braces.
+    quote = contents[index:index + 3] if contents[index:index + 3] in ('"""', "'''") else contents[index]
+    index += len(quote)
+    depth = 0
+    while index < len(contents):
+        if depth == 0 and contents.startswith(quote, index):
+            return index + len(quote)
+        if contents[index] == "\\" and len(quote) == 1:
+            index += 2
+            continue
+        if contents.startswith("${", index):
+            depth += 1
+            index += 2
+            continue
+        if depth > 0 and contents[index] == "}":
+            depth -= 1
+        elif depth == 0 and len(quote) == 1 and contents[index] == "\n":
+            return index
+        index += 1
+
+    return len(contents)
+
+
+def tokenize(contents):
+    tokens = []
+    index = 0
+    while index < len(contents):
+        character = contents[index]
+        if contents.startswith("//", index):
+            end = contents.find("\n", index)
+            end = len(contents) if end == -1 else end
+            kind = "comment"
+        elif contents.startswith("/*", index):
+            end = contents.find("*/", index + 2)
+            end = len(contents) if end == -1 else end + 2
+            kind = "comment"
+        elif character in "\"'":
+            end = read_string(contents, index)
+            kind = "string"
+        elif character == "\n":
+            end = index + 1
+            kind = "newline"
+        elif character.isspace():
+            end = index + 1
+            while end < len(contents) and contents[end].isspace() and contents[end] != "\n":
+                end += 1
+            kind = "space"
+        elif character.isalnum() or character in "_.$":
+            end = index + 1
+            while end < len(contents) and (contents[end].isalnum() or contents[end] in "_.$"):
+                end += 1
+            kind = "name"
+        else:
+            end = index + 1
+            kind = character if character in "{}()=;" else "other"
+
+        tokens.append(Token(kind, index, end, contents[index:end]))
+        index = end
+
+    return tokens
+
+
+def parse_blocks(tokens):
+    # Blocks are named after the call they belong to, e.g. 'buildTypes {' or 'getByName("debug") {'.
+    root = Block(None, None, 0, None)
+    block = root
+    significant = []
+    for token in tokens:
+        if token.kind == "{":
+            name = argument = None
+            if significant and significant[-1].kind == "name":
+                name = significant[-1].text
+            elif len(significant) >= 4 and [item.kind for item in significant[-4:]] == ["name", "(", "string", ")"]:
+                name = significant[-4].text
+                argument = significant[-2].text.strip("\"'")
+            child = Block(name, argument, token.start, block)
+            block.children.append(child)
+            block = child
+            significant = []
+            continue
+
+        if token.kind == "}" and block.parent is not None:
+            block.end = token.start
+            block = block.parent
+            significant = []
+            continue
+
+        block.tokens.append(token)
+        if token.kind not in ("space", "comment"):
+            significant.append(token)
+
+    return root
+
+
+def find_property(block, names):
+    # Returns the tokens of the value assigned to a property directly inside the block, e.g. 'debuggable true' or
+    # 'isDebuggable = true'.
+    tokens = [token for token in block.tokens if token.kind not in ("space", "comment")]
+    for index, token in enumerate(tokens):
+        if token.kind != "name" or token.text not in names or (index > 0 and tokens[index - 1].kind != "newline"
+                                                                and tokens[index - 1].kind != ";"):
+            continue
+
+        value = []
+        for value_token in tokens[index + 1:]:
+            if value_token.kind in ("newline", ";"):
+                break
+            if value_token.kind != "=" or value:
+                value.append(value_token)
+        # Groovy allows the value to be passed as a method argument, e.g. 'debuggable(true)'.
+        if len(value) > 2 and value[0].kind == "(" and value[-1].kind == ")":
+            value = value[1:-1]
+        if value:
+            return value
+
+    return None
+
+
+def detect_indent(contents):
+    tab_lines = space_lines = 0
+    space_indent = None
+    for line in contents.splitlines():
+        stripped = line.lstrip(" \t")
+        if not stripped or stripped == line:
+            continue
+        if line.startswith("\t"):
+            tab_lines += 1
+        else:
+            space_lines += 1
+            indent = len(line) - len(line.lstrip(" "))
+            space_indent = indent if space_indent is None else min(space_indent, indent)
+
+    return "\t" if tab_lines >= space_lines or space_indent is None else " " * space_indent
+
+
+def insert_lines(contents, block, lines, indent, newline):
+    # Lines are added before the closing brace of the block, indented one level deeper than the brace.
+    line_start = contents.rfind("\n", 0, block.end) + 1
+    prefix = contents[line_start:block.end]
+    base = prefix[:len(prefix) - len(prefix.lstrip(" \t"))]
+    text = "".join(base + indent * (level + 1) + line + newline for level, line in lines)
+    if not prefix.strip():
+        return line_start, line_start, text
+
+    trailing = len(prefix) - len(prefix.rstrip(" \t"))
+    return block.end - trailing, block.end, newline + text + base
+
+
+def get_property_line(build_file, name):
+    if build_file.endswith(".kts"):
+        return KOTLIN_PROPERTIES[name] + " = true"
+    return name + " true"
+
+
+def get_build_type_lines(build_file, name, properties):
+    # Build types other than debug are created from the debug build type, so they are signed with the debug key, and
+    # fall back to the debug build type of library modules that do not have them.
+    kotlin = build_file.endswith(".kts")
+    if name == "debug":
+        lines = [(0, ('getByName("debug")' if kotlin else "debug") + " {")]
+    elif kotlin:
+        lines = [(0, 'create("' + name + '") {'), (1, 'initWith(getByName("debug"))'),
+                 (1, 'matchingFallbacks += listOf("debug")')]
+    else:
+        lines = [(0, name + " {"), (1, "initWith debug"), (1, "matchingFallbacks = ['debug']")]
+
+    return lines + [(1, get_property_line(build_file, property_name)) for property_name in properties] + [(0, "}")]
+
+
+def get_dependency_line(build_file, configuration, file):
+    # Configurations of custom build types have no Kotlin accessors, they are called by name.
+    if build_file.endswith(".kts"):
+        return '"' + configuration + '"(files("' + file + '"))'
+    return configuration + " files('" + file + "')"
+
+
+def has_dependency(block, file):
+    return any(token.kind == "string" and token.text.strip("\"'") == file for token in block.tokens)
+
+
+def transform(build_file, contents, build_types, dependencies=()):
+    tokens = tokenize(contents)
+    root = parse_blocks(tokens)
+    indent = detect_indent(contents)
+    newline = "\r\n" if "\r\n" in contents else "\n"
+
+    android_block = root.find("android")
+    if android_block is None or android_block.end is None:
+        logging.warning("Failed to find android block in " + build_file + ".")
+        return contents
+
+    # Every edit is collected from one parse of the file and applied from the end of the file backwards.
+    edits = []
+    build_types_block = android_block.find("buildTypes")
+    missing_build_types = []
+    for name, properties in build_types.items():
+        block = build_types_block.find(name) if build_types_block is not None else None
+        if block is None:
+            logging.info("Adding " + name + " release to the app gradle build.")
+            missing_build_types += get_build_type_lines(build_file, name, properties)
+            continue
+
+        missing = []
+        for property_name in properties:
+            value = find_property(block, PROPERTY_NAMES[property_name])
+            if value is None:
+                logging.info("Adding '" + property_name + "' to the " + name + " release of the gradle build.")
+                missing.append((0, get_property_line(build_file, property_name)))
+            elif len(value) != 1 or value[0].text != "true":
+                logging.info("Enabling '" + property_name + "' in the " + name + " release of the gradle build.")
+                edits.append((value[0].start, value[-1].end, "true"))
+        if missing:
+            edits.append(insert_lines(contents, block, missing, indent, newline))
+
+    if missing_build_types and build_types_block is None:
+        logging.info("Adding build types to the gradle build.")
+        edits.append(insert_lines(contents, android_block, [(0, "buildTypes {")] + [
+            (level + 1, line) for level, line in missing_build_types] + [(0, "}")], indent, newline))
+    elif missing_build_types:
+        edits.append(insert_lines(contents, build_types_block, missing_build_types, indent, newline))
+
+    # Local dependencies are added to the module's own dependencies block, not the one of its buildscript block.
+    dependencies_block = root.find("dependencies")
+    missing_dependencies = []
+    for configuration, file in dependencies:
+        if dependencies_block is None or not has_dependency(dependencies_block, file):
+            logging.info("Adding " + file + " to the " + configuration + " dependencies of the gradle build.")
+            missing_dependencies.append((0, get_dependency_line(build_file, configuration, file)))
+
+    if missing_dependencies and dependencies_block is not None and dependencies_block.end is not None:
+        edits.append(insert_lines(contents, dependencies_block, missing_dependencies, indent, newline))
+    elif missing_dependencies:
+        separator = newline if contents.endswith("\n") else newline * 2
+        edits.append((len(contents), len(contents), separator + "dependencies {" + newline + "".join(
+            indent + line + newline for level, line in missing_dependencies) + "}" + newline))
+
+    for start, end, text in sorted(edits, reverse=True):
+        contents = contents[:start] + text + contents[end:]
+    return contents
+
+
+def uses_androidx(contents):
+    return any(token.kind in ("string", "name") and any(dependency in token.text
+                                                         for dependency in ANDROIDX_DEPENDENCIES)
+               for token in tokenize(contents) if token.kind != "comment")
+
+
+def read_fingerprint(build_file):
+    try:
+        with open(build_file + FINGERPRINT_SUFFIX) as fingerprint_data:
+            return json.load(fingerprint_data)
+    except (OSError, ValueError):
+        return None
+
+
+def update_build_file(build_file, build_types, dependencies=()):
+    with open(build_file, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    properties = [name + "." + property_name for name in build_types for property_name in build_types[name]] + [
+        configuration + ":" + file for configuration, file in dependencies]
+
+    # A file patched by an earlier run with at least the same properties is left untouched, so that Gradle's up to date
+    # checks for it still hold.
+    fingerprint = read_fingerprint(build_file)
+    if fingerprint is not None and fingerprint.get("version") == TRANSFORM_VERSION and \
+            fingerprint.get("sha256") == digest and set(properties) <= set(fingerprint.get("properties", [])):
+        logging.info("Gradle build file " + build_file + " is already patched.")
+        return fingerprint["androidx"]
+
+    logging.info("Reading app gradle file contents.")
+    contents = data.decode("utf-8", errors="surrogateescape")
+    updated = transform(build_file, contents, build_types, dependencies)
+    if updated != contents:
+        if not os.path.isfile(build_file + ".orig"):
+            logging.info("Creating backup of gradle build file.")
+            shutil.copy(build_file, build_file + ".orig")
+
+        logging.info("Writing updated content to app gradle file.")
+        data = updated.encode("utf-8", errors="surrogateescape")
+        worktree.write_file(build_file, data)
+
+    patched = set(properties)
+    if fingerprint is not None and fingerprint.get("version") == TRANSFORM_VERSION and \
+            fingerprint.get("sha256") == digest:
+        patched |= set(fingerprint.get("properties", []))
+
+    androidx = uses_androidx(updated)
+    worktree.write_file(build_file + FINGERPRINT_SUFFIX,
+                        json.dumps({"version": TRANSFORM_VERSION, "properties": sorted(patched),
+                                    "sha256": hashlib.sha256(data).hexdigest(), "androidx": androidx}, indent=4))
+    return androidx
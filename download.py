@@ -0,0 +1,297 @@
+#
+# Author: Jordan Doyle
+#
+
+import hashlib
+import http.client
+import logging
+import os
+import shutil
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_JOBS = 4
+MAX_REDIRECTS = 5
+REQUEST_TIMEOUT = 60
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+
+def verify_file(file_name, sha256=None, size=None):
+    if size is not None and os.path.getsize(file_name) != size:
+        return False
+
+    if sha256 is not None:
+        file_hash = hashlib.sha256()
+        with open(file_name, "rb") as hash_file:
+            for chunk in iter(lambda: hash_file.read(CHUNK_SIZE), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest() == sha256
+
+    return True
+
+
+class StreamReader:
+
+    def __init__(self, response, archive=None):
+        self.response = response
+        self.archive = archive
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.response.read(size if size >= 0 else None)
+        self.hash.update(data)
+        self.size += len(data)
+        if self.archive is not None:
+            self.archive.write(data)
+        return data
+
+
+class ConnectionPool:
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def acquire(self, scheme, host):
+        with self.lock:
+            idle = self.connections.get((scheme, host))
+            if idle:
+                return idle.pop()
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def release(self, scheme, host, connection):
+        with self.lock:
+            self.connections.setdefault((scheme, host), []).append(connection)
+
+    def close(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for connection in idle:
+                    connection.close()
+            self.connections = {}
+
+
+class Downloader:
+
+    def __init__(self, jobs=DOWNLOAD_JOBS):
+        self.pool = ConnectionPool()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.downloaded = self.failed = self.size = 0
+        self.start = datetime.now()
+
+    def submit(self, key, function, *arguments):
+        # Packages selected more than once, e.g. randomly and manually, are only downloaded once.
+        with self.lock:
+            if key in self.tasks:
+                return self.tasks[key]
+            task = self.tasks[key] = self.executor.submit(function, *arguments)
+
+        # The callback runs immediately if the task has already finished, so it is added without holding the lock.
+        task.add_done_callback(self.progress)
+        return task
+
+    def progress(self, _):
+        with self.lock:
+            done = sum(task.done() for task in self.tasks.values())
+            logging.info("Download progress: " + str(done) + " of " + str(len(self.tasks)) + " task(s) complete.")
+
+    def request(self, scheme, host, path, headers):
+        connection = self.pool.acquire(scheme, host)
+        for attempt in range(2):
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server may have closed an idle keep-alive connection, retry once with a new connection.
+                connection.close()
+                if attempt > 0:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+
+    def open_url(self, url, headers, redirects=MAX_REDIRECTS):
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        connection, response = self.request(parts.scheme, parts.netloc, path, headers)
+
+        if response.status in (200, 206):
+            return parts, connection, response
+
+        try:
+            response.read()
+        except BaseException:
+            connection.close()
+            raise
+        self.pool.release(parts.scheme, parts.netloc, connection)
+        if response.status in REDIRECT_CODES and redirects > 0:
+            return self.open_url(urljoin(url, response.getheader("Location")), headers, redirects - 1)
+
+        # A range that is not satisfiable means the partial file is already complete, it is verified by the caller.
+        if response.status == 416:
+            return parts, None, response
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+
+    def transfer(self, url, part_file):
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        headers = {"Connection": "keep-alive"}
+        if offset > 0:
+            headers["Range"] = "bytes=" + str(offset) + "-"
+
+        parts, connection, response = self.open_url(url, headers)
+        if connection is None:
+            return 0
+
+        size = 0
+        # A server that ignores the range request sends the whole file, the partial file is then overwritten. A
+        # connection that fails partway is closed instead of returned to the pool.
+        try:
+            with open(part_file, "ab" if response.status == 206 else "wb") as download_file:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    download_file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            connection.close()
+            raise
+        self.pool.release(parts.scheme, parts.netloc, connection)
+
+        return size
+
+    def transfer_extract(self, url, extract_directory, archive_file=None):
+        parts, connection, response = self.open_url(url, {"Connection": "keep-alive"})
+        if connection is None:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+
+        try:
+            with open(archive_file, "wb") if archive_file is not None else nullcontext() as archive:
+                reader = StreamReader(response, archive)
+                # The data filter rejects absolute paths, links and members outside the extract directory.
+                with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                    tar.extractall(extract_directory, filter="data")
+                # Read any padding left after the last tar member so the checksum covers the whole archive.
+                for _ in iter(lambda: reader.read(CHUNK_SIZE), b""):
+                    pass
+        except BaseException:
+            connection.close()
+            raise
+        self.pool.release(parts.scheme, parts.netloc, connection)
+
+        return reader
+
+    def fetch_extract(self, url, directory, member, archive_file=None, sha256=None, size=None):
+        extract_directory = directory + ".part"
+        part_file = archive_file + ".part" if archive_file is not None else None
+
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            shutil.rmtree(extract_directory, ignore_errors=True)
+            try:
+                reader = self.transfer_extract(url, extract_directory, part_file)
+            except HTTPError:
+                self.record(None)
+                raise
+            except tarfile.FilterError as error:
+                # An archive with members outside its directory is rejected, downloading it again would not help.
+                shutil.rmtree(extract_directory, ignore_errors=True)
+                if part_file is not None and os.path.isfile(part_file):
+                    os.remove(part_file)
+                self.record(None)
+                raise ValueError("Archive from " + url + " can not be extracted safely. " + str(error))
+            except (OSError, http.client.HTTPException, tarfile.TarError) as error:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    shutil.rmtree(extract_directory, ignore_errors=True)
+                    self.record(None)
+                    raise URLError(error)
+                logging.warning("Download from " + url + " interrupted, restarting. " + str(error))
+                continue
+
+            if (size is None or reader.size == size) and (sha256 is None or reader.hash.hexdigest() == sha256):
+                extracted_directory = os.path.join(extract_directory, member)
+                if not os.path.isdir(extracted_directory):
+                    shutil.rmtree(extract_directory, ignore_errors=True)
+                    self.record(None)
+                    raise ValueError("Archive from " + url + " does not contain directory '" + member + "'.")
+
+                os.replace(extracted_directory, directory)
+                shutil.rmtree(extract_directory, ignore_errors=True)
+                if part_file is not None:
+                    os.replace(part_file, archive_file)
+                self.record(reader.size)
+                return reader.size
+
+            if attempt < DOWNLOAD_ATTEMPTS:
+                logging.warning("Download from " + url + " does not match the index checksum, restarting.")
+
+        shutil.rmtree(extract_directory, ignore_errors=True)
+        if part_file is not None and os.path.isfile(part_file):
+            os.remove(part_file)
+        self.record(None)
+        raise ValueError("Download from " + url + " does not match the index checksum.")
+
+    def fetch(self, url, file_name, sha256=None, size=None):
+        part_file = file_name + ".part"
+        if size is not None and os.path.isfile(part_file) and os.path.getsize(part_file) > size:
+            os.remove(part_file)
+
+        transferred = 0
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                transferred += self.transfer(url, part_file)
+            except HTTPError:
+                self.record(None)
+                raise
+            except (OSError, http.client.HTTPException) as error:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    self.record(None)
+                    raise URLError(error)
+                logging.warning("Download from " + url + " interrupted, resuming. " + str(error))
+                continue
+
+            if verify_file(part_file, sha256, size):
+                os.replace(part_file, file_name)
+                self.record(transferred)
+                return transferred
+
+            os.remove(part_file)
+            if attempt < DOWNLOAD_ATTEMPTS:
+                logging.warning("Download from " + url + " does not match the index checksum, restarting.")
+
+        self.record(None)
+        raise ValueError("Download from " + url + " does not match the index checksum.")
+
+    def record(self, size):
+        with self.lock:
+            if size is None:
+                self.failed += 1
+            else:
+                self.downloaded += 1
+                self.size += size
+
+    def wait(self):
+        for key, task in list(self.tasks.items()):
+            error = task.exception()
+            if error is not None:
+                logging.error("Download task '" + str(key) + "' failed. " + str(error))
+
+        duration = datetime.now() - self.start
+        logging.info("Downloaded " + str(self.downloaded) + " file(s), " + str(round(self.size / (1024 * 1024), 1)) +
+                     " MB in " + str(round(duration.total_seconds())) + " second(s).")
+        if self.failed > 0:
+            logging.warning(str(self.failed) + " download(s) failed.")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
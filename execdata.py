@@ -0,0 +1,195 @@
+#
+# Author: Jordan Doyle
+#
+
+import logging
+import os
+import struct
+
+CHUNK_SIZE = 1024 * 1024
+# Block types, magic number and format version of the JaCoCo execution data format written by JaCoCo 0.7.5 and later.
+BLOCK_HEADER = 0x01
+BLOCK_SESSION_INFO = 0x10
+BLOCK_EXECUTION_DATA = 0x11
+MAGIC_NUMBER = 0xC0C0
+FORMAT_VERSION = 0x1007
+EXEC_EXTENSIONS = (".ec", ".exec")
+
+
+class ExecDataStream:
+
+    def __init__(self, exec_file, chunk_size=CHUNK_SIZE):
+        self.exec_file = exec_file
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.position = 0
+
+    def fill(self, size):
+        # Returns False when the data ends before the requested number of bytes.
+        while len(self.buffer) - self.position < size:
+            chunk = self.exec_file.read(max(self.chunk_size, size))
+            if not chunk:
+                return False
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+        return True
+
+    def read(self, size):
+        if not self.fill(size):
+            raise ValueError("Unexpected end of execution data.")
+        data = self.buffer[self.position:self.position + size]
+        self.position += size
+        return data
+
+    def read_byte(self):
+        if not self.fill(1):
+            raise ValueError("Unexpected end of execution data.")
+        self.position += 1
+        return self.buffer[self.position - 1]
+
+    def read_varint(self):
+        value = shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_string(self):
+        # Strings are written with Java's modified UTF-8, which decodes the same for class names and session ids.
+        size, = struct.unpack(">H", self.read(2))
+        return self.read(size).decode("utf-8", errors="surrogateescape")
+
+    def blocks(self):
+        # Dumps appended to the same file start with a header block of their own, each header is checked.
+        while self.fill(1):
+            block_type = self.read_byte()
+            if block_type == BLOCK_HEADER:
+                magic_number, version = struct.unpack(">HH", self.read(4))
+                if magic_number != MAGIC_NUMBER:
+                    raise ValueError("Invalid execution data file.")
+                if version != FORMAT_VERSION:
+                    raise ValueError("Incompatible execution data version " + hex(version) + ".")
+            elif block_type == BLOCK_SESSION_INFO:
+                session_id = self.read_string()
+                start, dump = struct.unpack(">qq", self.read(16))
+                yield BLOCK_SESSION_INFO, (session_id, start, dump)
+            elif block_type == BLOCK_EXECUTION_DATA:
+                class_id, = struct.unpack(">q", self.read(8))
+                name = self.read_string()
+                count = self.read_varint()
+                # Probes are packed eight to a byte with the first probe in the lowest bit, the bytes read as one
+                # little endian integer are a bit vector with probe i in bit i.
+                probes = int.from_bytes(self.read((count + 7) // 8), "little")
+                yield BLOCK_EXECUTION_DATA, (class_id, name, count, probes)
+            else:
+                raise ValueError("Unknown execution data block type " + hex(block_type) + ".")
+
+
+def write_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def write_string(value):
+    data = value.encode("utf-8", errors="surrogateescape")
+    return struct.pack(">H", len(data)) + data
+
+
+class ExecutionDataStore:
+
+    def __init__(self):
+        self.sessions = []
+        # Maps class ids to [name, probe count, probe bit vector].
+        self.classes = {}
+
+    def add(self, class_id, name, count, probes):
+        entry = self.classes.get(class_id)
+        if entry is None:
+            self.classes[class_id] = [name, count, probes]
+            return
+
+        if entry[0] != name or entry[1] != count:
+            raise ValueError("Incompatible execution data for class " + name + " with id " +
+                             format(class_id & 0xFFFFFFFFFFFFFFFF, "016x") + ".")
+        entry[2] |= probes
+
+    def merge(self, store):
+        # Every class is checked before any is merged, so a store with incompatible data leaves this one unchanged.
+        for class_id, (name, count, probes) in store.classes.items():
+            entry = self.classes.get(class_id)
+            if entry is not None and (entry[0] != name or entry[1] != count):
+                raise ValueError("Incompatible execution data for class " + name + " with id " +
+                                 format(class_id & 0xFFFFFFFFFFFFFFFF, "016x") + ".")
+
+        for class_id, (name, count, probes) in store.classes.items():
+            self.add(class_id, name, count, probes)
+        self.sessions += store.sessions
+
+    def read(self, exec_file):
+        # Blocks read before invalid or truncated data are kept, a dump may be cut off when the app is killed.
+        with open(exec_file, "rb") as exec_data:
+            for block_type, block in ExecDataStream(exec_data).blocks():
+                if block_type == BLOCK_SESSION_INFO:
+                    self.sessions.append(block)
+                else:
+                    self.add(*block)
+
+    def write(self, exec_file):
+        with open(exec_file + ".part", "wb") as exec_data:
+            exec_data.write(struct.pack(">BHH", BLOCK_HEADER, MAGIC_NUMBER, FORMAT_VERSION))
+            for session_id, start, dump in self.sessions:
+                exec_data.write(bytes([BLOCK_SESSION_INFO]) + write_string(session_id) + struct.pack(">qq", start, dump))
+            for class_id, (name, count, probes) in sorted(self.classes.items(), key=lambda item: (item[1][0], item[0])):
+                exec_data.write(bytes([BLOCK_EXECUTION_DATA]) + struct.pack(">q", class_id) + write_string(name) +
+                                write_varint(count) + probes.to_bytes((count + 7) // 8, "little"))
+        os.replace(exec_file + ".part", exec_file)
+
+    def summary(self):
+        classes = {}
+        for class_id, (name, count, probes) in sorted(self.classes.items(), key=lambda item: (item[1][0], item[0])):
+            # Different versions of a class have the same name and different ids.
+            key = name if name not in classes else name + "@" + format(class_id & 0xFFFFFFFFFFFFFFFF, "016x")
+            classes[key] = {"probes": count, "covered": bin(probes).count("1")}
+
+        probes = sum(item["probes"] for item in classes.values())
+        covered = sum(item["covered"] for item in classes.values())
+        return {"sessions": len(self.sessions), "classes": len(classes),
+                "coveredClasses": sum(1 for item in classes.values() if item["covered"]), "probes": probes,
+                "coveredProbes": covered, "coverage": round(covered / probes, 4) if probes else 0.0,
+                "classCoverage": classes}
+
+
+def merge_files(exec_files):
+    # Runs in a worker process, every file is read into a store of its own so a file with incompatible data is
+    # skipped as a whole. Files cut off after some of their blocks are merged up to the cut and reported as partial.
+    store = ExecutionDataStore()
+    invalid = []
+    partial = []
+    for exec_file in exec_files:
+        file_store = ExecutionDataStore()
+        try:
+            file_store.read(exec_file)
+        except (OSError, ValueError) as error:
+            if not file_store.sessions and not file_store.classes:
+                logging.warning("Skipping execution data file " + exec_file + ". " + str(error))
+                invalid.append(exec_file)
+                continue
+            logging.warning("Execution data file " + exec_file + " is incomplete, merging the blocks before the " +
+                            "error. " + str(error))
+            partial.append(exec_file)
+
+        try:
+            store.merge(file_store)
+        except ValueError as error:
+            logging.warning("Skipping execution data file " + exec_file + ". " + str(error))
+            invalid.append(exec_file)
+            if exec_file in partial:
+                partial.remove(exec_file)
+
+    return store, invalid, partial
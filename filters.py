@@ -0,0 +1,262 @@
+#
+# Author: Jordan Doyle
+#
+# Filter expressions are evaluated over whole columns of the package table. Each comparison produces a bit mask with
+# one bit per package, so combining comparisons with 'and', 'or' and 'not' is a single integer operation.
+#
+#   expression := term ("or" term)*
+#   term       := factor ("and" factor)*
+#   factor     := "not" factor | "(" expression ")" | comparison
+#   comparison := column [("<" | "<=" | ">" | ">=" | "==" | "=" | "!=") value | "between" value "and" value
+#                 | "in" "(" value ("," value)* ")"]
+#
+# Numeric values may use the units y, m, w and d, e.g. 'age < 10y' or 'age >= 6m'. A column on its own tests a boolean
+# column, e.g. 'source' or 'not manual'.
+#
+
+import math
+import operator
+import re
+import time
+from array import array
+
+DAY_MILLISECONDS = 24 * 60 * 60 * 1000
+UNITS = {"y": 1, "m": 1 / 12, "w": 7 / 365, "d": 1 / 365}
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq,
+             "=": operator.eq, "!=": operator.ne}
+KEYWORDS = {"and", "or", "not", "between", "in"}
+# Columns whose values change with the current time rather than with the package record.
+TIME_COLUMNS = {"age"}
+TOKEN_PATTERN = re.compile(r"\s*(?:(\d+(?:\.\d+)?)([ymwd])?\b|\"([^\"]*)\"|'([^']*)'|([A-Za-z_][A-Za-z0-9_.]*)|"
+                           r"(<=|>=|==|!=|<|>|=|\(|\)|,))")
+
+
+def to_mask(flags):
+    bits = "".join("1" if flag else "0" for flag in flags)
+    return int(bits[::-1], 2) if bits else 0
+
+
+def count_mask(mask):
+    return bin(mask).count("1")
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid filter expression at '" + expression[position:] + "'.")
+        number, unit, double_quoted, single_quoted, name, symbol = match.groups()
+        if number is not None:
+            tokens.append(("value", float(number) * UNITS[unit] if unit else float(number)))
+        elif double_quoted is not None or single_quoted is not None:
+            tokens.append(("value", double_quoted if double_quoted is not None else single_quoted))
+        elif name is not None:
+            tokens.append(("keyword", name.lower()) if name.lower() in KEYWORDS else ("name", name))
+        else:
+            tokens.append(("symbol", symbol))
+        position = match.end()
+
+    return tokens
+
+
+class Parser:
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind is not None and token[0] != kind) or (value is not None and token[1] != value):
+            raise ValueError("Invalid filter expression '" + self.expression + "', expected " +
+                             str(value if value is not None else kind) + " but found " + str(token[1]) + ".")
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        node = self.parse_expression()
+        if self.position != len(self.tokens):
+            raise ValueError("Invalid filter expression '" + self.expression + "', unexpected '" +
+                             str(self.peek()[1]) + "'.")
+        return node
+
+    def parse_expression(self):
+        node = self.parse_term()
+        while self.peek() == ("keyword", "or"):
+            self.take()
+            node = ("or", node, self.parse_term())
+        return node
+
+    def parse_term(self):
+        node = self.parse_factor()
+        while self.peek() == ("keyword", "and"):
+            self.take()
+            node = ("and", node, self.parse_factor())
+        return node
+
+    def parse_factor(self):
+        if self.peek() == ("keyword", "not"):
+            self.take()
+            return "not", self.parse_factor()
+        if self.peek() == ("symbol", "("):
+            self.take()
+            node = self.parse_expression()
+            self.take("symbol", ")")
+            return node
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        column = self.take("name")
+        kind, value = self.peek()
+        if kind == "symbol" and value in OPERATORS:
+            self.take()
+            return "compare", column, value, self.take("value")
+        if (kind, value) == ("keyword", "between"):
+            self.take()
+            lower = self.take("value")
+            self.take("keyword", "and")
+            return "between", column, lower, self.take("value")
+        if (kind, value) == ("keyword", "in"):
+            self.take()
+            self.take("symbol", "(")
+            values = [self.take("value")]
+            while self.peek() == ("symbol", ","):
+                self.take()
+                values.append(self.take("value"))
+            self.take("symbol", ")")
+            return "in", column, tuple(values)
+        return "column", column
+
+
+def parse(expression):
+    return Parser(expression).parse()
+
+
+def referenced_columns(node):
+    if isinstance(node, str):
+        node = parse(node)
+
+    if node[0] in ("or", "and"):
+        return referenced_columns(node[1]) | referenced_columns(node[2])
+    if node[0] == "not":
+        return referenced_columns(node[1])
+    return {node[1]}
+
+
+class PackageTable:
+
+    def __init__(self, records, now=None):
+        now = time.time() * 1000 if now is None else now
+        self.records = records
+        self.size = len(records)
+        self.all_rows = (1 << self.size) - 1
+        self.masks = {}
+        self.columns = {}
+        self.builders = {}
+
+        self.define("minSdk", self.add_numeric, lambda: (record["minSdkVersion"] for record in records))
+        self.define("targetSdk", self.add_numeric, lambda: (record["targetSdkVersion"] for record in records))
+        self.define("versionCode", self.add_numeric, lambda: (record["versionCode"] for record in records))
+        self.define("lastUpdated", self.add_numeric, lambda: (record["lastUpdated"] for record in records))
+        self.define("age", self.add_numeric,
+                    lambda: ((now - record["lastUpdated"]) // DAY_MILLISECONDS / 365 for record in records))
+        self.define("package", self.add_text, lambda: (record["package"] for record in records))
+        self.define("name", self.add_text, lambda: (record["name"] for record in records))
+        self.define("category", self.add_set, lambda: (record["categories"] for record in records))
+        self.define("source", self.add_boolean, lambda: (record["source"] is not None for record in records))
+        self.define("sdk", self.add_boolean, lambda: (record["minSdkVersion"] is not None and
+                                                      record["targetSdkVersion"] is not None for record in records))
+
+    def define(self, name, add, values):
+        # Columns are built the first time an expression uses them, so a table that only evaluates a few expressions
+        # does not pay for the columns it never reads.
+        self.builders[name] = (add, values)
+
+    def add_numeric(self, name, values):
+        self.columns[name] = ("numeric", array("d", (math.nan if value is None else value for value in values)))
+
+    def add_text(self, name, values):
+        self.columns[name] = ("text", list(values))
+
+    def add_set(self, name, values):
+        self.columns[name] = ("set", [frozenset(value) for value in values])
+
+    def add_boolean(self, name, values):
+        self.columns[name] = ("boolean", to_mask(values))
+
+    def column(self, name):
+        if name in self.builders:
+            add, values = self.builders.pop(name)
+            add(name, values())
+        if name not in self.columns:
+            raise ValueError("Unknown filter column '" + name + "', expected one of " +
+                             ", ".join(sorted(self.columns.keys() | self.builders.keys())) + ".")
+        return self.columns[name]
+
+    def evaluate(self, node):
+        if isinstance(node, str):
+            node = parse(node)
+
+        if node[0] == "or":
+            return self.evaluate(node[1]) | self.evaluate(node[2])
+        if node[0] == "and":
+            return self.evaluate(node[1]) & self.evaluate(node[2])
+        if node[0] == "not":
+            return self.all_rows & ~self.evaluate(node[1])
+
+        # Comparisons are cached so that many expressions sharing the same comparisons are cheap to evaluate.
+        if node not in self.masks:
+            self.masks[node] = self.compare(node)
+        return self.masks[node]
+
+    def compare(self, node):
+        column_type, values = self.column(node[1])
+
+        if node[0] == "column":
+            if column_type != "boolean":
+                raise ValueError("Filter column '" + node[1] + "' is not a boolean column.")
+            return values
+        if column_type == "boolean":
+            raise ValueError("Filter column '" + node[1] + "' is a boolean column, use it without a comparison.")
+
+        if column_type == "set":
+            if node[0] == "in":
+                wanted = set(node[2])
+                return to_mask(not wanted.isdisjoint(value) for value in values)
+            if node[0] == "compare" and node[2] in ("=", "==", "!="):
+                return to_mask((node[3] in value) != (node[2] == "!=") for value in values)
+            raise ValueError("Filter column '" + node[1] + "' only supports '==', '!=' and 'in'.")
+
+        expected = str if column_type == "text" else float
+        compared = node[2:] if node[0] == "between" else node[2] if node[0] == "in" else node[3:]
+        if not all(isinstance(value, expected) for value in compared):
+            raise ValueError("Filter column '" + node[1] + "' must be compared with " +
+                             ("text" if expected is str else "numbers") + ".")
+
+        if node[0] == "compare":
+            compare = OPERATORS[node[2]]
+            return to_mask(compare(value, node[3]) for value in values)
+        if node[0] == "between":
+            return to_mask(node[2] <= value <= node[3] for value in values)
+        return to_mask(value in node[2] for value in values)
+
+    def apply(self, rules):
+        remaining = self.all_rows
+        rejected = []
+        for name, expression in rules:
+            mask = self.evaluate(expression)
+            rejected.append((name, expression, remaining & ~mask))
+            remaining &= mask
+
+        return remaining, rejected
+
+    def select(self, mask):
+        bits = bin(mask)[2:][::-1]
+        return [self.records[index] for index, bit in enumerate(bits) if bit == "1"]
@@ -0,0 +1,224 @@
+#
+# Author: Jordan Doyle
+#
+
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+GRADLE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gradlew.sh")
+WRAPPER_PATTERN = re.compile(r"^distributionUrl=.*/gradle-(.+?)-(?:bin|all)\.zip\s*$")
+FAILED_TASK_PATTERN = re.compile(r"Execution failed for task '([^']+)'")
+
+BUILD_TIMEOUT = 60
+OUTPUT_TIMEOUT = 15
+KILL_TIMEOUT = 10
+STOP_TIMEOUT = 60
+# Daemons are registered in a directory of their own for every script, `--stop` only stops the daemons registered in
+# the same directory, so a script never stops the daemons of another one running at the same time.
+DAEMON_DIRECTORY = "script-daemons"
+LOG_LIMIT = 16 * 1024 * 1024
+LOG_TAIL = 500
+# Failures no build recovers from, the build is stopped as soon as one of them is written to the output.
+FATAL_PATTERNS = [("missing-sdk", re.compile(r"Failed to find target with hash string|Failed to find Build Tools "
+                                             r"revision|Failed to install the following (?:Android )?SDK|"
+                                             r"SDK location not found|License for package .* not accepted")),
+                  ("unsupported-java", re.compile(r"Unsupported class file major version \d+|compiled by a more "
+                                                  r"recent version of the Java Runtime|UnsupportedClassVersionError|"
+                                                  r"Could not determine java version from")),
+                  ("dependency-resolution", re.compile(r"Could not resolve all (?:files|dependencies|artifacts|task "
+                                                       r"dependencies) for configuration"))]
+
+
+def read_wrapper_version(build_directory):
+    # The same wrapper properties as gradlew.sh are read, the build directory is checked before its parent.
+    for directory in (build_directory, os.path.dirname(build_directory)):
+        properties_file = os.path.join(directory, "gradle", "wrapper", "gradle-wrapper.properties")
+        if not os.path.isfile(properties_file):
+            continue
+
+        version = None
+        with open(properties_file, errors="replace") as properties:
+            for line in properties:
+                match = WRAPPER_PATTERN.match(line.strip().replace("\\:", ":"))
+                if match is not None:
+                    version = match.group(1)
+        if version is not None:
+            return version
+
+    return None
+
+
+class GradleRun:
+
+    def __init__(self, command, build_directory, log_file, environment=None, timeout=None, output_timeout=None):
+        self.command = command
+        self.build_directory = build_directory
+        self.log_file = log_file
+        self.environment = environment
+        self.timeout = timeout
+        self.output_timeout = output_timeout
+        self.exit_code = None
+        self.reason = None
+        self.detail = None
+        self.duration = None
+        self.failed_tasks = []
+        self.last_output = None
+        self.process = None
+
+    def read_output(self, log):
+        # Only the start and the end of very long output is kept, the lines in between are counted. Once a line does
+        # not fit into the start, every later line goes to the end so the log stays in order.
+        written = omitted = 0
+        truncated = False
+        tail = deque(maxlen=LOG_TAIL)
+        for line in self.process.stdout:
+            self.last_output = time.monotonic()
+            if not truncated and written + len(line) <= LOG_LIMIT:
+                log.write(line)
+                written += len(line)
+            else:
+                truncated = True
+                if len(tail) == tail.maxlen:
+                    omitted += 1
+                tail.append(line)
+
+            text = line.decode("utf-8", errors="replace")
+            match = FAILED_TASK_PATTERN.search(text)
+            if match is not None and match.group(1) not in self.failed_tasks:
+                self.failed_tasks.append(match.group(1))
+            for reason, pattern in FATAL_PATTERNS:
+                if self.reason is None and pattern.search(text):
+                    self.stop(reason, text.strip())
+
+        if tail:
+            log.write(("... " + str(omitted) + " line(s) omitted ...\n").encode())
+            log.writelines(tail)
+
+    def stop(self, reason, detail):
+        self.reason = reason
+        self.detail = detail
+        # Gradle is started in a process group of its own, so the wrapper script and every process it started are
+        # stopped. The build running in a daemon is cancelled once its client is gone.
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def run(self):
+        start = self.last_output = time.monotonic()
+        with open(self.log_file, "wb") as log:
+            self.process = subprocess.Popen(self.command, cwd=self.build_directory, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, env=self.environment, start_new_session=True)
+            reader = threading.Thread(target=self.read_output, args=(log,), daemon=True)
+            reader.start()
+
+            stopped = None
+            while self.process.poll() is None:
+                now = time.monotonic()
+                if stopped is None and self.reason is not None:
+                    stopped = now
+                elif stopped is None and self.timeout is not None and now - start > self.timeout:
+                    self.stop("timeout", "No result after " + str(round(now - start)) + " second(s).")
+                    stopped = now
+                elif stopped is None and self.output_timeout is not None and \
+                        now - self.last_output > self.output_timeout:
+                    self.stop("output-timeout", "No output for " + str(round(now - self.last_output)) + " second(s).")
+                    stopped = now
+                elif stopped is not None and now - stopped > KILL_TIMEOUT:
+                    self.kill()
+
+                try:
+                    self.process.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    pass
+
+            # Processes left in the group could keep the output open, they are killed when the rest of the output is not
+            # read in time. Gradle daemons detach from the group and keep running.
+            reader.join(KILL_TIMEOUT)
+            if reader.is_alive():
+                self.kill()
+                reader.join(KILL_TIMEOUT)
+
+        self.exit_code = self.process.returncode
+        self.duration = round(time.monotonic() - start, 1)
+        if self.exit_code != 0 and self.reason is None:
+            self.reason = "task-failed" if self.failed_tasks else "build-failed"
+        if self.reason is not None:
+            logging.error("Gradle build failed (" + self.reason + ")" + (": " + self.detail if self.detail else "."))
+        return self
+
+    def summary(self):
+        return {"exitCode": self.exit_code, "reason": self.reason, "detail": self.detail, "duration": self.duration,
+                "failedTasks": self.failed_tasks}
+
+
+def run_gradle(command, build_directory, log_file, environment=None, timeout=None, output_timeout=None):
+    return GradleRun(command, build_directory, log_file, environment, timeout, output_timeout).run()
+
+
+class DaemonPool:
+
+    def __init__(self, user_home=None, name=None, build_cache=True):
+        self.user_home = os.path.abspath(user_home) if user_home is not None else None
+        self.build_cache = build_cache
+        self.registry = None
+        if name is not None:
+            home = self.user_home or os.environ.get("GRADLE_USER_HOME") or os.path.join(os.path.expanduser("~"),
+                                                                                       ".gradle")
+            self.registry = os.path.join(os.path.abspath(home), DAEMON_DIRECTORY, name)
+        self.lock = threading.Lock()
+        self.daemons = {}
+
+    def command(self, build_directory, tasks, java_home=None):
+        # Builds with the same JDK and Gradle version reuse the same warm daemons, they are tracked so that every
+        # daemon started during the run can be stopped at the end of it.
+        version = read_wrapper_version(build_directory)
+        with self.lock:
+            self.daemons.setdefault((java_home, version), build_directory)
+
+        command = [GRADLE_SCRIPT] + tasks + ["--daemon"]
+        if self.build_cache:
+            command.append("--build-cache")
+        command += self.home_arguments()
+        if java_home is not None:
+            command.append("-Dorg.gradle.java.home=" + java_home)
+
+        return command
+
+    def home_arguments(self):
+        arguments = []
+        if self.user_home is not None:
+            arguments += ["--gradle-user-home", self.user_home]
+        if self.registry is not None:
+            arguments.append("-Dorg.gradle.daemon.registry.base=" + self.registry)
+        return arguments
+
+    def stop(self):
+        stopped = set()
+        for (java_home, version), build_directory in self.daemons.items():
+            # Stopping daemons stops every daemon of the Gradle version registered in the same directory.
+            if version in stopped or not os.path.isdir(build_directory):
+                continue
+
+            logging.info("Stopping Gradle " + str(version or "default") + " daemons.")
+            command = [GRADLE_SCRIPT, "--stop"] + self.home_arguments()
+            try:
+                subprocess.call(command, cwd=build_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                timeout=STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logging.warning("Stopping Gradle " + str(version or "default") + " daemons timed out.")
+            stopped.add(version)
+
+        self.daemons = {}
@@ -0,0 +1,99 @@
+#
+# Author: Jordan Doyle
+#
+
+import hashlib
+import json
+import os
+
+import filters
+
+# Bump the state version whenever the stored fields change so that old state files trigger a full evaluation.
+STATE_VERSION = 1
+
+
+def rules_signature(rules, manual_packages):
+    rule_data = json.dumps({"rules": rules, "manual": sorted(manual_packages)})
+    return hashlib.sha256(rule_data.encode()).hexdigest()
+
+
+def load_state(state_file, signature):
+    if not os.path.isfile(state_file):
+        return None
+
+    with open(state_file) as state_data:
+        state = json.load(state_data)
+
+    # Stored results are only valid for the rules they were evaluated with.
+    if state.get("version") != STATE_VERSION or state.get("signature") != signature:
+        return None
+    return state
+
+
+def save_state(state_file, signature, records, failures, selected_packages):
+    packages = {record["package"]: {"lastUpdated": record["lastUpdated"], "versionCode": record["versionCode"],
+                                    "failed": failures[record["package"]]} for record in records}
+    state = {"version": STATE_VERSION, "signature": signature, "packages": packages,
+             "selected": {package: details["versionCode"] for package, details in selected_packages.items()}}
+
+    os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
+    with open(state_file + ".part", "w") as state_data:
+        state_data.write(json.dumps(state))
+    os.replace(state_file + ".part", state_file)
+
+
+def is_changed(record, previous):
+    return previous is None or (previous["lastUpdated"], previous["versionCode"]) != (record["lastUpdated"],
+                                                                                      record["versionCode"])
+
+
+def split_records(records, state):
+    previous_packages = state["packages"] if state is not None else {}
+    changed, unchanged = [], []
+    for record in records:
+        (changed if is_changed(record, previous_packages.get(record["package"])) else unchanged).append(record)
+
+    packages = {record["package"] for record in records}
+    removed = [package for package in previous_packages if package not in packages]
+    return changed, unchanged, removed
+
+
+def record_failures(failures, table, rule_index, mask):
+    for record in table.select(table.all_rows & ~mask):
+        failures[record["package"]].append(rule_index)
+
+
+def evaluate_failures(records, rules, state, create_table):
+    changed, unchanged, removed = split_records(records, state)
+    failures = {record["package"]: [] for record in records}
+
+    # Changed and new packages are evaluated against every rule.
+    changed_table = create_table(changed)
+    for rule_index, (_, expression) in enumerate(rules):
+        record_failures(failures, changed_table, rule_index, changed_table.evaluate(expression))
+
+    # Unchanged packages keep their previous results, only rules that depend on the current time are evaluated again.
+    time_rules = [rule_index for rule_index, (_, expression) in enumerate(rules)
+                  if filters.referenced_columns(expression) & filters.TIME_COLUMNS]
+    for record in unchanged:
+        previous_failures = state["packages"][record["package"]]["failed"]
+        failures[record["package"]] = [rule_index for rule_index in previous_failures if rule_index not in time_rules]
+    if unchanged and time_rules:
+        unchanged_table = create_table(unchanged)
+        for rule_index in time_rules:
+            record_failures(failures, unchanged_table, rule_index, unchanged_table.evaluate(rules[rule_index][1]))
+    for package_failures in failures.values():
+        package_failures.sort()
+
+    return failures, changed, unchanged, removed
+
+
+def list_selection_changes(state, packages):
+    updated, dropped = [], []
+    for package, version_code in (state or {}).get("selected", {}).items():
+        if package not in packages:
+            dropped.append(package)
+        elif packages[package]["versionCode"] != version_code:
+            updated.append(package)
+
+    return {"updated": sorted(updated), "dropped": sorted(dropped)}
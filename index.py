@@ -0,0 +1,310 @@
+#
+# Author: Jordan Doyle
+#
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import urllib.request
+from contextlib import closing
+from urllib.error import HTTPError
+
+CHUNK_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = 60
+WHITESPACE = " \t\n\r"
+
+# Bump the cache version whenever the cached record fields change so that stale caches are rebuilt.
+CACHE_VERSION = 2
+CACHE_ENTRIES = 4
+CACHE_COLUMNS = [("name", "name", "TEXT"), ("targetSdkVersion", "target_sdk", "INTEGER"),
+                 ("minSdkVersion", "min_sdk", "INTEGER"), ("package", "package", "TEXT"),
+                 ("source", "source", "TEXT"), ("categories", "categories", "TEXT"), ("url", "url", "TEXT"),
+                 ("lastUpdated", "last_updated", "INTEGER"), ("versionCode", "version_code", "INTEGER"),
+                 ("sha256", "sha256", "TEXT"), ("size", "size", "INTEGER"), ("sourceSha256", "source_sha256", "TEXT"),
+                 ("sourceSize", "source_size", "INTEGER")]
+
+
+class JsonStream:
+
+    def __init__(self, json_file, chunk_size=CHUNK_SIZE):
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def read(self, size=None):
+        if self.finished:
+            return False
+
+        chunk = self.json_file.read(max(self.chunk_size, size or 0))
+        if not chunk:
+            self.finished = True
+            return False
+
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                raise ValueError("Unexpected end of JSON data.")
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected '" + character + "' at JSON position " + str(self.position) + ".")
+        self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # The value is incomplete, double the buffered data so large values are not re-parsed many times.
+                if self.read(len(self.buffer) - self.position):
+                    continue
+                raise
+
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self.buffer) and self.read():
+                continue
+
+            self.position = end
+            return value
+
+    def members(self):
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+
+            if self.peek() == ",":
+                self.position += 1
+                continue
+            self.expect("}")
+            return
+
+
+def iterate_index(file_name):
+    with open(file_name) as index_file:
+        stream = JsonStream(index_file)
+        for section in stream.members():
+            if section == "packages":
+                for package in stream.members():
+                    yield section, package, stream.value()
+            else:
+                yield section, None, stream.value()
+
+
+def stream_index(file_name):
+    index_items = iterate_index(file_name)
+    for section, _, value in index_items:
+        if section == "repo":
+            return value, ((package, details) for section, package, details in index_items if section == "packages")
+        if section == "packages":
+            raise ValueError("Index file '" + file_name + "' lists packages before the repo details.")
+
+    raise ValueError("Index file '" + file_name + "' does not contain repo details.")
+
+
+def hash_file(file_name):
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as hash_file_data:
+        for chunk in iter(lambda: hash_file_data.read(CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def open_cache(cache_file):
+    connection = sqlite3.connect(cache_file)
+    if connection.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+        connection.execute("DROP TABLE IF EXISTS indexes")
+        connection.execute("DROP TABLE IF EXISTS packages")
+        connection.execute("PRAGMA user_version = " + str(CACHE_VERSION))
+
+    connection.execute("CREATE TABLE IF NOT EXISTS indexes (hash TEXT PRIMARY KEY, repo TEXT, created REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS packages (hash TEXT, " + ", ".join(
+        column + " " + column_type for _, column, column_type in CACHE_COLUMNS) + ", PRIMARY KEY (hash, package))")
+    return connection
+
+
+def cache_row(record):
+    return tuple(json.dumps(record[field]) if field == "categories" else record[field] for field, _, _ in CACHE_COLUMNS)
+
+
+def load_cached_index(cache_file, index_hash):
+    if not os.path.isfile(cache_file):
+        return None
+
+    with closing(open_cache(cache_file)) as connection:
+        row = connection.execute("SELECT repo FROM indexes WHERE hash = ?", (index_hash,)).fetchone()
+        if row is None:
+            return None
+
+        records = []
+        fields = [field for field, _, _ in CACHE_COLUMNS]
+        columns = [column for _, column, _ in CACHE_COLUMNS]
+        query = "SELECT " + ", ".join(columns) + " FROM packages WHERE hash = ? ORDER BY rowid"
+        for values in connection.execute(query, (index_hash,)):
+            record = dict(zip(fields, values))
+            record["categories"] = json.loads(record["categories"])
+            records.append(record)
+
+    return json.loads(row[0]), records
+
+
+def save_cached_index(cache_file, index_hash, repo, records):
+    with closing(open_cache(cache_file)) as connection, connection:
+        connection.execute("DELETE FROM packages WHERE hash = ?", (index_hash,))
+        connection.execute("INSERT OR REPLACE INTO indexes VALUES (?, ?, ?)",
+                           (index_hash, json.dumps(repo), time.time()))
+        connection.executemany("INSERT INTO packages VALUES (?" + ", ?" * len(CACHE_COLUMNS) + ")",
+                               [(index_hash,) + cache_row(record) for record in records])
+
+        # Only the most recently cached index files are kept, older entries can be rebuilt from their index file.
+        for stale_hash, in connection.execute("SELECT hash FROM indexes ORDER BY created DESC LIMIT -1 OFFSET ?",
+                                              (CACHE_ENTRIES,)).fetchall():
+            connection.execute("DELETE FROM packages WHERE hash = ?", (stale_hash,))
+            connection.execute("DELETE FROM indexes WHERE hash = ?", (stale_hash,))
+
+
+def request_file(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return response.read(), response.headers
+    except HTTPError as error:
+        if error.code == 304:
+            return None, error.headers
+        raise
+
+
+def request_verified_file(repository, file_details):
+    data, _ = request_file(repository + file_details["name"])
+    if "size" in file_details and len(data) != file_details["size"]:
+        raise ValueError("Size of '" + file_details["name"] + "' does not match the repository entry.")
+    if "sha256" in file_details and hashlib.sha256(data).hexdigest() != file_details["sha256"]:
+        raise ValueError("Checksum of '" + file_details["name"] + "' does not match the repository entry.")
+
+    return data
+
+
+def apply_merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = apply_merge_patch(target.get(key), value)
+
+    return target
+
+
+def read_index_timestamp(file_name):
+    repo, _ = stream_index(file_name)
+    return repo.get("timestamp")
+
+
+def write_index_file(file_name, data):
+    temporary_file = file_name + ".part"
+    with open(temporary_file, "wb") as index_file:
+        index_file.write(data)
+    os.replace(temporary_file, file_name)
+
+
+def save_index_snapshot(file_name, timestamp, snapshot_directory):
+    snapshot_file = os.path.join(snapshot_directory, "index-v2-" + str(timestamp) + ".json.gz")
+    if os.path.isfile(snapshot_file):
+        return
+
+    logging.info("Saving app index snapshot '" + os.path.basename(snapshot_file) + "'.")
+    os.makedirs(snapshot_directory, exist_ok=True)
+    with open(file_name, "rb") as index_file, gzip.open(snapshot_file + ".part", "wb") as snapshot:
+        shutil.copyfileobj(index_file, snapshot)
+    os.replace(snapshot_file + ".part", snapshot_file)
+
+
+def apply_index_diff(repository, index_file, entry, local_timestamp):
+    # Diffs are keyed by the timestamp of the index they apply to, there is nothing to apply for older indexes.
+    if local_timestamp is None or str(local_timestamp) not in entry.get("diffs", {}):
+        return False
+
+    diff_details = entry["diffs"][str(local_timestamp)]
+    logging.info("Downloading app index diff '" + diff_details["name"] + "'.")
+    diff = json.loads(request_verified_file(repository, diff_details))
+
+    with open(index_file) as index_data:
+        package_data = apply_merge_patch(json.load(index_data), diff)
+
+    if package_data.get("repo", {}).get("timestamp") != entry["timestamp"]:
+        logging.warning("App index diff did not produce the repository timestamp.")
+        return False
+
+    write_index_file(index_file, json.dumps(package_data).encode())
+    logging.info("Applied app index diff to '" + index_file + "'.")
+    return True
+
+
+def refresh_index(repository, index_file, state_file, snapshot_directory):
+    state = {}
+    if os.path.isfile(state_file):
+        with open(state_file) as state_data:
+            state = json.load(state_data)
+
+    headers = {}
+    if os.path.isfile(index_file):
+        if "etag" in state:
+            headers["If-None-Match"] = state["etag"]
+        if "modified" in state:
+            headers["If-Modified-Since"] = state["modified"]
+
+    entry_data, entry_headers = request_file(repository + "/entry.json", headers)
+    if entry_data is None:
+        logging.info("Repository entry has not changed, app index is up to date.")
+        return False
+
+    entry = json.loads(entry_data)
+    local_timestamp = read_index_timestamp(index_file) if os.path.isfile(index_file) else None
+    if local_timestamp is not None:
+        save_index_snapshot(index_file, local_timestamp, snapshot_directory)
+
+    updated = local_timestamp != entry["timestamp"]
+    if not updated:
+        logging.info("App index timestamp matches the repository, app index is up to date.")
+    elif not apply_index_diff(repository, index_file, entry, local_timestamp):
+        logging.info("Downloading full app index '" + entry["index"]["name"] + "'.")
+        write_index_file(index_file, request_verified_file(repository, entry["index"]))
+
+    save_index_snapshot(index_file, entry["timestamp"], snapshot_directory)
+
+    state = {"timestamp": entry["timestamp"]}
+    if entry_headers.get("ETag") is not None:
+        state["etag"] = entry_headers.get("ETag")
+    if entry_headers.get("Last-Modified") is not None:
+        state["modified"] = entry_headers.get("Last-Modified")
+    with open(state_file, "w") as state_data:
+        state_data.write(json.dumps(state, indent=4))
+
+    return updated
@@ -0,0 +1,178 @@
+#
+# Author: Jordan Doyle
+#
+
+import logging
+import os
+import shutil
+import threading
+
+import manifest
+import worktree
+
+BUILD_TYPE = "jacoco"
+LIBRARY_FILE = "jacoco-instrument.aar"
+LIBRARY_INSTRUMENTATION = "jacoco.instrument.JacocoInstrumentation"
+LAUNCH_ACTIVITY_KEY = "jacoco.instrument.LAUNCH_ACTIVITY"
+END_ACTION_KEY = "jacoco.instrument.END_ACTION"
+OVERLAY_MANIFEST = """<?xml version="1.0" encoding="utf-8"?>
+<manifest xmlns:android="http://schemas.android.com/apk/res/android" xmlns:tools="http://schemas.android.com/tools">
+    <application />
+</manifest>
+"""
+
+template_lock = threading.Lock()
+templates = {}
+
+
+def update_manifest_file(manifest_file, package=None, manifest_cache=None, launch_activity=None, model=None):
+    # The model the manifest was read into is updated when it is given, the manifest is not parsed again.
+    if model is None:
+        with open(manifest_file, "rb") as manifest_data:
+            data = manifest_data.read()
+        digest = manifest.get_digest(data)
+    else:
+        digest = model.digest
+
+    # Manifests this function wrote before are recognised by their hash, they are not parsed or written again. The
+    # library instrumentation is given the launch activity, templates are not.
+    prefix = "instrument:" + str(package) + ":" + ("library:" + launch_activity + ":" if launch_activity else "")
+    entry = manifest_cache.lookup(prefix + digest) if manifest_cache is not None else None
+    if entry is not None:
+        logging.info("Manifest file " + manifest_file + " is already instrumented.")
+        return entry["package"]
+
+    if model is None:
+        logging.info("Parsing manifest file content.")
+        model = manifest.Manifest(manifest_file, data)
+    # Overlay manifests of a build type have no package of their own, the package of the main manifest is given.
+    package = package or model.package
+    if package is None:
+        return None
+
+    if launch_activity is not None:
+        add_library_elements(model, package, launch_activity)
+    else:
+        add_template_elements(model, package)
+
+    if model.additions["manifest"] or model.additions["application"]:
+        if not os.path.isfile(manifest_file + ".orig"):
+            logging.info("Creating backup of manifest file.")
+            shutil.copy(manifest_file, manifest_file + ".orig")
+
+        logging.info("Writing updated content to manifest file.")
+        model.save()
+
+    if manifest_cache is not None:
+        # Only the hash of the instrumented manifest is recorded, other copies of the original still need the changes.
+        manifest_cache.record([prefix + model.digest], {"package": package})
+        manifest_cache.record(["read:" + model.digest], {"package": model.package,
+                                                         "launchActivity": model.read_launch_activity()})
+    return package
+
+
+def add_template_elements(model, package):
+    if model.add_element("manifest", "instrumentation", package + ".JacocoInstrumentation",
+                         {"android:targetPackage": package}):
+        logging.info("Adding instrument element to manifest content.")
+    if model.add_element("manifest", "uses-permission", "android.permission.READ_EXTERNAL_STORAGE"):
+        logging.info("Adding read permission to manifest content.")
+    if model.add_element("manifest", "uses-permission", "android.permission.WRITE_EXTERNAL_STORAGE"):
+        logging.info("Adding write permission to manifest content.")
+    if model.add_element("application", "activity", package + ".InstrumentActivity",
+                         {"android:enabled": "true", "android:exported": "true"}):
+        logging.info("Adding instrument activity to manifest content.")
+    if model.add_element("application", "receiver", package + ".EndEmmaBroadcast",
+                         {"android:enabled": "true", "tools:ignore": "ExportedReceiver"},
+                         [("intent-filter", None, {}, [("action", package + ".END_EMMA", {}, [])])]):
+        logging.info("Adding EndEmma broadcast reciever to manifest content.")
+
+
+def add_library_elements(model, package, launch_activity):
+    # The precompiled library reads the launch activity and the end broadcast action from the meta-data of its
+    # instrumentation element, the permissions it needs are merged from the manifest of the library.
+    if model.add_element("manifest", "instrumentation", LIBRARY_INSTRUMENTATION, {"android:targetPackage": package},
+                         [("meta-data", LAUNCH_ACTIVITY_KEY, {"android:value": launch_activity}, []),
+                          ("meta-data", END_ACTION_KEY, {"android:value": package + ".END_EMMA"}, [])]):
+        logging.info("Adding library instrument element to manifest content.")
+
+
+def load_templates(template_directory):
+    # The templates are read once per run and shared by every app, the AndroidX variants replace the classes of the
+    # same name for apps that use AndroidX.
+    with template_lock:
+        if template_directory not in templates:
+            loaded = {}
+            for directory in (template_directory, os.path.join(template_directory, "androidx")):
+                if not os.path.isdir(directory):
+                    continue
+                for file in sorted(os.listdir(directory)):
+                    if not file.endswith('.java'):
+                        continue
+                    with open(os.path.join(directory, file), 'r') as class_file:
+                        logging.info("Reading " + os.path.relpath(os.path.join(directory, file), template_directory) +
+                                     " class content.")
+                        loaded[os.path.relpath(os.path.join(directory, file), template_directory)] = class_file.read()
+            templates[template_directory] = loaded
+
+        return templates[template_directory]
+
+
+def add_instrument_classes(template_directory, source, package, activity, androidx):
+    class_templates = load_templates(template_directory)
+    for file in class_templates:
+        if os.path.dirname(file):
+            continue
+
+        if androidx and os.path.join("androidx", file) in class_templates:
+            file = os.path.join("androidx", file)
+
+        class_content = class_templates[file]
+        if '<APP-PACKAGE>' in class_content:
+            logging.info("Adding package '" + package + "' to " + file)
+            class_content = class_content.replace('<APP-PACKAGE>', package)
+        if '<LAUNCH-ACTIVITY>' in class_content:
+            logging.info("Adding launch activity '" + activity + "' to " + file)
+            class_content = class_content.replace('<LAUNCH-ACTIVITY>', activity)
+
+        # Worktrees are kept between runs, a class is written again when its template changed and left alone when
+        # it is unchanged, so the worktree's fingerprint stays the same.
+        class_file = os.path.join(source, os.path.basename(file))
+        if os.path.isfile(class_file):
+            with open(class_file, 'r') as existing_file:
+                if existing_file.read() == class_content:
+                    continue
+
+        logging.info("Writing updated class content '" + file)
+        worktree.write_file(class_file, class_content)
+
+
+def add_instrument_library(library_file, module_directory):
+    # The library is linked into the module, so the build file refers to it by a path inside the worktree.
+    library_directory = os.path.join(module_directory, "libs")
+    os.makedirs(library_directory, exist_ok=True)
+    file = os.path.join(library_directory, LIBRARY_FILE)
+    if not os.path.isfile(file) or not os.path.samefile(library_file, file):
+        logging.info("Linking instrumentation library to " + file + ".")
+        worktree.replace_link(os.path.abspath(library_file), file)
+
+    return "libs/" + LIBRARY_FILE
+
+
+def get_overlay_directory(module_directory):
+    return os.path.join(module_directory, "src", BUILD_TYPE)
+
+
+def create_overlay(module_directory, package):
+    # The instrumented build type gets the JaCoCo classes and manifest entries from a source set of its own, the main
+    # source set and manifest of the app are left as they are for the debug build type.
+    overlay_directory = get_overlay_directory(module_directory)
+    source_directory = os.path.join(overlay_directory, "java", package.replace(".", os.path.sep))
+    os.makedirs(source_directory, exist_ok=True)
+
+    overlay_manifest = os.path.join(overlay_directory, "AndroidManifest.xml")
+    if not os.path.isfile(overlay_manifest):
+        logging.info("Creating " + BUILD_TYPE + " manifest file.")
+        worktree.write_file(overlay_manifest, OVERLAY_MANIFEST)
+
+    return overlay_manifest, source_directory
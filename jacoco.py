@@ -1,7 +1,8 @@
 #
 # Author: Jordan Doyle
 #
-# usage: jacoco.py [-h] [-o OUTPUT] [-d] [-s] [-f] [-a AGE] [-i MIN] [-x MAX] [-c] [-p] [-v] [-g]
+# usage: jacoco.py [-h] [-o OUTPUT] [-v] [-j JACOCO] [-c] [-n JOBS] [-g GRADLE_HOME] [-k]
+#                  [-t TIMEOUT] [-s OUTPUT_TIMEOUT] [-b] [-l LIBRARY]
 #
 # options:
 #   -h, --help                          show this help message and exit
@@ -9,23 +10,56 @@
 #   -j, --jacoco                        set jacoco class directory
 #   -v, --verbose                       output all log messages
 #   -c, --clean                         delete previous builds
+#   -n JOBS, --jobs JOBS                maximum concurrent builds
+#   -g GRADLE_HOME, --gradle-home GRADLE_HOME
+#                                       shared Gradle user home
+#   -k, --keep-daemons                  leave Gradle daemons running after the build
+#   -t TIMEOUT, --timeout TIMEOUT       minutes before a Gradle build is stopped
+#   -s OUTPUT_TIMEOUT, --output-timeout OUTPUT_TIMEOUT
+#                                       minutes without Gradle output before a build is stopped
+#   -b, --combined                      build the debug and JaCoco APK files with one Gradle invocation
+#   -l LIBRARY, --library LIBRARY       use the precompiled instrumentation library instead of the class templates
 #
 
 import argparse
 import logging
 import os
 import shutil
-import subprocess
 import sys
-import xml.etree.ElementTree as ElementTree
-from pathlib import Path
+
+import buildcache
+import buildfile
+import gradle
+import instrument
+import manifest
+import project
+import scheduler
+import toolchain
+import worktree
+
+VARIANT = "jacoco"
+COMBINED_VARIANT = "combined"
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("-o", "--output", type=str, default='output', help="set output directory")
 arg_parser.add_argument("-v", "--verbose", default=False, action="store_true", help="output all log messages")
 arg_parser.add_argument("-j", "--jacoco", type=str, default='classes', help="set jacoco class directory")
 arg_parser.add_argument("-c", "--clean", default=False, action="store_true", help="delete previous builds")
+arg_parser.add_argument("-n", "--jobs", type=int, default=scheduler.BUILD_JOBS, help="maximum concurrent builds")
+arg_parser.add_argument("-g", "--gradle-home", type=str, default=None, help="shared Gradle user home")
+arg_parser.add_argument("-k", "--keep-daemons", default=False, action="store_true",
+                        help="leave Gradle daemons running after the build")
+arg_parser.add_argument("-t", "--timeout", type=int, default=gradle.BUILD_TIMEOUT,
+                        help="minutes before a Gradle build is stopped")
+arg_parser.add_argument("-s", "--output-timeout", type=int, default=gradle.OUTPUT_TIMEOUT,
+                        help="minutes without Gradle output before a build is stopped")
+arg_parser.add_argument("-b", "--combined", default=False, action="store_true",
+                        help="build the debug and JaCoco APK files with one Gradle invocation")
+arg_parser.add_argument("-l", "--library", type=str, default=None,
+                        help="use the precompiled instrumentation library instead of the class templates")
 args = arg_parser.parse_args()
+variant = COMBINED_VARIANT if args.combined else VARIANT
+instrumented_build_type = instrument.BUILD_TYPE if args.combined else "debug"
 
 log_level = logging.DEBUG if args.verbose else logging.INFO
 log_format = '[%(levelname)s] (%(filename)s:%(lineno)d) - %(message)s'
@@ -37,10 +71,14 @@ if not os.path.isdir(args.output):
     logging.error("Provided output directory (" + args.output + ") does not exist.")
     exit(20)
 
-if not os.path.isdir(args.jacoco):
+if args.library is None and not os.path.isdir(args.jacoco):
     logging.error("JaCoco class directory (" + args.jacoco + ") does not exist.")
     exit(30)
 
+if args.library is not None and not os.path.isfile(args.library):
+    logging.error("Instrumentation library (" + args.library + ") does not exist.")
+    exit(35)
+
 apk_directory = os.path.join(args.output, "apk")
 if not os.path.isdir(apk_directory):
     logging.error("APK directory (" + apk_directory + ") does not exist.")
@@ -51,346 +89,222 @@ if args.clean:
     if os.path.isdir(japk_directory):
         logging.info("Deleting previous JaCoco APK files.")
         shutil.rmtree(japk_directory)
+    if os.path.isdir(os.path.join(args.output, worktree.WORKTREE_DIRECTORY, variant)):
+        logging.info("Deleting previous JaCoco worktrees.")
+        shutil.rmtree(os.path.join(args.output, worktree.WORKTREE_DIRECTORY, variant))
 
 if not os.path.isdir(japk_directory):
     logging.info("Creating new JaCoco APK directory (" + japk_directory + ").")
     os.makedirs(japk_directory)
 
-if "JAVA_HOME" not in os.environ:
-    logging.warning("Java home environment variable is not set.")
-
-java_11_enabled = True
-if "JAVA_11_HOME" not in os.environ:
-    logging.warning("Java 11 home environment variable is not set.")
-    java_11_enabled = False
-
-
-def update_build_file(build_file):
-    if not os.path.isfile(build_file + ".orig"):
-        logging.info("Creating backup of gradle build file.")
-        shutil.copy(build_file, build_file + ".orig")
-
-    with open(build_file, "r") as file:
-        logging.info("Reading app gradle file contents.")
-        contents = file.readlines()
-
-    androidx = build_block = debug_block = other_block = debug_found = debugging = coverage = False
-    for index, line in enumerate(contents):
-        if build_block:
-            if debug_block:
-                if "debuggable true" in line:
-                    debugging = True
-                elif "testCoverageEnabled true" in line:
-                    coverage = True
-                elif "}" in line:
-                    debug_block = False
-                    if not debugging:
-                        logging.info("Adding 'debuggable true' to the gradle build.")
-                        contents.insert(index, "\t\t\tdebuggable true\n")
-                    if not coverage:
-                        logging.info("Adding 'testCoverageEnabled true' to the gradle build.")
-                        contents.insert(index, "\t\t\ttestCoverageEnabled true\n")
-                    debugging = coverage = False
-                continue
-            elif "debug {" in line:
-                debug_block = True
-                debug_found = True
-                continue
-
-            if other_block:
-                if "}" in line:
-                    other_block = False
-                continue
-            elif "{" in line:
-                other_block = True
-                continue
-
-            if "}" in line:
-                build_block = False
-                if not debug_found:
-                    logging.info("Adding debug release to the app gradle build.")
-                    contents.insert(index, "\t\t}\n")
-                    contents.insert(index, "\t\t\ttestCoverageEnabled true\n")
-                    contents.insert(index, "\t\t\tdebuggable true\n")
-                    contents.insert(index, "\t\tdebug {\n")
-        elif "buildTypes {" in line:
-            build_block = True
-            continue
-
-        if "androidx.appcompat:appcompat" in line:
-            androidx = True
-
-    with open(build_file, "w") as file:
-        logging.info("Writing updated content to app gradle file.")
-        file.writelines(contents)
+dapk_directory = os.path.join(args.output, "dapk")
+if args.combined:
+    if args.clean and os.path.isdir(dapk_directory):
+        logging.info("Deleting previous debug APK files.")
+        shutil.rmtree(dapk_directory)
 
-    return androidx
-
-
-def update_manifest_file(manifest_file):
-    if not os.path.isfile(manifest_file + ".orig"):
-        logging.info("Creating backup of manifest file.")
-        shutil.copy(manifest_file, manifest_file + ".orig")
-
-    logging.info("Parsing manifest file content.")
-    tree = ElementTree.parse(manifest_file)
-    root = tree.getroot()
-
-    if "package" in root.keys():
-        package = root.get("package")
-    else:
-        return None
-
-    android_namespace = tool_namespace = None
-    for key, value in root.attrib.items():
-        if "http://schemas.android.com/apk/res/android" in value:
-            android_namespace = key
-            continue
-        if "http://schemas.android.com/tools" in value:
-            tool_namespace = key
-            continue
-
-    if android_namespace is None:
-        root.set("xmlns:android", "http://schemas.android.com/apk/res/android")
-        android_namespace = "android"
-
-    if tool_namespace is None:
-        root.set("xmlns:tools", "http://schemas.android.com/tools")
-        tool_namespace = "tools"
-
-    namespace_link = "{http://schemas.android.com/apk/res/android}"
-
-    add_instrument = True
-    for element in tree.findall("instrumentation"):
-        if element.get(namespace_link + "name") == package + ".JacocoInstrumentation":
-            add_instrument = False
-            break
-
-    if add_instrument:
-        logging.info("Adding instrument element to manifest content.")
-        instrument = ElementTree.Element("instrumentation")
-        instrument.set(android_namespace + ":name", package + ".JacocoInstrumentation")
-        instrument.set(android_namespace + ":targetPackage", package)
-        root.append(instrument)
-
-    add_read_permission = add_write_permission = True
-    for element in tree.findall("uses-permission"):
-        if element.get(namespace_link + "name") == "android.permission.READ_EXTERNAL_STORAGE":
-            add_read_permission = False
-            continue
-        if element.get(namespace_link + "name") == "android.permission.WRITE_EXTERNAL_STORAGE":
-            add_write_permission = False
-
-        if not add_read_permission and not add_write_permission:
-            break
-
-    if add_read_permission:
-        logging.info("Adding read permission to manifest content.")
-        read_permission = ElementTree.Element("uses-permission")
-        read_permission.set(android_namespace + ":name", "android.permission.READ_EXTERNAL_STORAGE")
-        root.append(read_permission)
-
-    if add_write_permission:
-        logging.info("Adding write permission to manifest content.")
-        write_permission = ElementTree.Element("uses-permission")
-        write_permission.set(android_namespace + ":name", "android.permission.WRITE_EXTERNAL_STORAGE")
-        root.append(write_permission)
-
-    application = tree.find("application")
-
-    add_activity = True
-    for element in application.findall("activity"):
-        if element.get(namespace_link + "name") == package + ".InstrumentActivity":
-            add_activity = False
-            break
-
-    if add_activity:
-        logging.info("Adding instrument activity to manifest content.")
-        activity = ElementTree.Element("activity")
-        activity.set(android_namespace + ":name", package + ".InstrumentActivity")
-        activity.set(android_namespace + ":enabled", "true")
-        activity.set(android_namespace + ":exported", "true")
-        application.append(activity)
-
-    add_receiver = True
-    for element in application.findall("receiver"):
-        if element.get(namespace_link + "name") == package + ".EndEmmaBroadcast":
-            add_receiver = False
-            break
-
-    if add_receiver:
-        logging.info("Adding EndEmma broadcast reciever to manifest content.")
-        receiver = ElementTree.Element("receiver")
-        receiver.set(android_namespace + ":name", package + ".EndEmmaBroadcast")
-        receiver.set(android_namespace + ":enabled", "true")
-        receiver.set(tool_namespace + ":ignore", "ExportedReceiver")
-
-        intent = ElementTree.Element("intent-filter")
-        action = ElementTree.Element("action")
-        action.set(android_namespace + ":name", package + ".END_EMMA")
-        intent.append(action)
-        receiver.append(intent)
-        application.append(receiver)
-
-    logging.info("Writing updated content to manifest file.")
-    tree.write(manifest_file)
-
-    return package
-
-
-def read_launch_activity_from_manifest(manifest_file):
-    tree = ElementTree.parse(manifest_file)
-
-    application = tree.find("application")
-    activities = application.findall("activity")
-    for activity in activities:
-        intents = activity.findall("intent-filter")
-        for intent in intents:
-            actions = intent.findall("action")
-            for action in actions:
-                if "android.intent.action.MAIN" in action.attrib.values():
-                    for key in activity.keys():
-                        if "name" in key:
-                            return activity.get(key)
-
-    return None
-
-
-def add_instrument_classes(source, package, activity, androidx):
-    for file in os.listdir(args.jacoco):
-        if not file.endswith('.java'):
-            continue
-
-        if os.path.isfile(os.path.join(source, os.path.basename(file))):
-            continue
-
-        if "InstrumentActivity.java" in file and androidx:
-            file = os.path.join("androidx", file)
-
-        with open(os.path.join(args.jacoco, file), 'r') as class_file:
-            logging.info("Reading " + file + " class content.")
-            class_content = class_file.read()
-
-        if '<APP-PACKAGE>' in class_content:
-            logging.info("Adding package '" + package + "' to " + file)
-            class_content = class_content.replace('<APP-PACKAGE>', package)
-        if '<LAUNCH-ACTIVITY>' in class_content:
-            logging.info("Adding launch activity '" + activity + "' to " + file)
-            class_content = class_content.replace('<LAUNCH-ACTIVITY>', activity)
-
-        with open(os.path.join(source, os.path.basename(file)), 'w') as class_file:
-            logging.info("Writing updated class content '" + file)
-            class_file.write(class_content)
+    if not os.path.isdir(dapk_directory):
+        logging.info("Creating new debug APK directory (" + dapk_directory + ").")
+        os.makedirs(dapk_directory)
 
+if "JAVA_HOME" not in os.environ:
+    logging.warning("Java home environment variable is not set.")
 
-def copy_apk_file(source, destination: str, name, title):
-    file = str(None)
-    for file_path in Path(source).rglob("*.apk"):
-        file = str(file_path.resolve())
-        logging.info("JaCoco APK for " + title + " is " + file)
-        break
 
+def link_apk_file(layout, destination: str, name, title, build_type):
+    label = "Debug" if args.combined and build_type == "debug" else "JaCoco"
+    file = project.find_output_apk(layout, build_type)
     if file is None:
-        logging.error("Failed to find the JaCoco APK for " + title + ".")
+        logging.error("Failed to find the " + label + " APK for " + title + ".")
         return
+    logging.info(label + " APK for " + title + " is " + file)
 
-    logging.info("Copying JaCoco APK to JAPK directory.")
-    shutil.copy(file, os.path.join(destination, name + ".apk"))
-
+    logging.info("Linking " + label + " APK to " + os.path.basename(destination).upper() + " directory.")
+    worktree.replace_link(file, os.path.join(destination, name + ".apk"))
 
-for apk_file in os.listdir(apk_directory):
-    if not os.path.isfile(os.path.join(apk_directory, apk_file)) or not apk_file.endswith(".apk"):
-        logging.info("Ignoring file " + apk_file)
-        continue
 
-    app = os.path.splitext(os.path.basename(apk_file))[0]
+def instrument_app(app):
+    apk_file = app + ".apk"
     app_title = ''.join([i for i in app if not i.isdigit()]).replace('_', ' ').title().strip()
 
-    if os.path.isfile(os.path.join(japk_directory, apk_file)):
-        logging.info(app_title + " already built, Skipping.")
-        continue
-
     logging.info("Processing '" + app_title + "'.")
 
     source_directory = os.path.join(args.output, "source", app)
     if not os.path.isdir(source_directory):
         logging.error("Source directory (" + source_directory + ") does not exist.")
-        continue
-
-    for path in Path(source_directory).rglob('local.properties'):
-        properties_file = str(path.resolve())
-        os.remove(properties_file)
-
-    gradle_build_file = None
-    for path in Path(source_directory).rglob('*/build.gradle'):
-        gradle_build_file = str(path.resolve())
-        logging.info("Gradle build file for " + app_title + " is " + gradle_build_file)
-        break
-
+        return "failed"
+
+    # The app is instrumented in its own worktree of the extracted source, so the debug build of the same app can run
+    # at the same time and the extracted source is never patched.
+    worktree_directory = worktree.create_worktree(
+        source_directory, worktree.get_worktree_directory(args.output, variant, app))
+    layout = project.scan_project(worktree_directory)
+    for properties_file in layout.properties_files:
+        if os.path.isfile(properties_file):
+            os.remove(properties_file)
+
+    gradle_build_file = layout.app_build_file
     if gradle_build_file is None:
         logging.error("Failed to find gradle build file for " + app_title + ".")
-        continue
-    use_androidx = update_build_file(gradle_build_file)
-
-    app_manifest = None
-    for path in Path(source_directory).rglob('AndroidManifest.xml'):
-        if "build" not in str(path.resolve()):
-            app_manifest = str(path.resolve())
-            logging.info("Manifest file for " + app_title + " is " + app_manifest)
-            break
-
+        return "failed"
+    logging.info("Gradle build file for " + app_title + " is " + gradle_build_file)
+    if args.combined:
+        build_types = {"debug": [buildfile.DEBUGGABLE],
+                       instrument.BUILD_TYPE: [buildfile.DEBUGGABLE, buildfile.TEST_COVERAGE]}
+    else:
+        build_types = {"debug": [buildfile.DEBUGGABLE, buildfile.TEST_COVERAGE]}
+    # The precompiled library is added as a local dependency of the instrumented build type only.
+    dependencies = []
+    if args.library is not None:
+        library_path = instrument.add_instrument_library(args.library, os.path.dirname(gradle_build_file))
+        dependencies.append((instrumented_build_type + "Implementation", library_path))
+    use_androidx = buildfile.update_build_file(gradle_build_file, build_types, dependencies)
+
+    app_manifest = layout.main_manifest
     if app_manifest is None:
         logging.error("Failed to find manifest file for " + app_title + ".")
-        continue
+        return "failed"
+    logging.info("Manifest file for " + app_title + " is " + app_manifest)
 
-    app_package = update_manifest_file(app_manifest)
+    # The manifest is parsed once, the same model is read here and updated with the instrumentation below.
+    manifest_entry, manifest_model = manifest.read_manifest(app_manifest, manifest_cache)
+    app_package = manifest_entry["package"]
     if app_package is None:
         logging.error("Failed to find package name for " + app_title + ".")
-        continue
+        return "failed"
     logging.info("Package name for " + app_title + " is " + str(app_package) + "'.")
 
-    launch_activity = read_launch_activity_from_manifest(app_manifest)
+    launch_activity = manifest_entry["launchActivity"]
     if launch_activity is None:
         logging.error("Failed to find launch activity for " + app_title + ".")
-        continue
+        return "failed"
 
     if launch_activity.startswith('.'):
         launch_activity = app_package + launch_activity
     logging.info("Launch activity for " + app_title + " is " + str(launch_activity) + "'.")
 
-    package_directory = app_package.replace(".", os.path.sep)
-    java_src_directory = None
-    for path in Path(source_directory).rglob(package_directory):
-        if "test" not in str(path) and "androidTest" not in str(path) and "build" not in str(path):
-            java_src_directory = str(path.resolve())
-            logging.info("Java SRC directory for " + app_title + " is " + java_src_directory)
-
-    if java_src_directory is None:
-        logging.error("Failed to find java src directory for " + app_title + ".")
-        continue
-    add_instrument_classes(java_src_directory, app_package, launch_activity, use_androidx)
-
-    build_directory = None
-    for path in Path(source_directory).rglob("build.gradle"):
-        build_directory = os.path.dirname(str(path.resolve()))
-        logging.info("Build directory for " + app_title + " is " + build_directory)
-        break
-
+    if args.combined:
+        # The main manifest and source set stay untouched for the debug build type, the instrumentation is added to
+        # the source set of the JaCoCo build type instead.
+        instrumented_manifest, java_src_directory = instrument.create_overlay(os.path.dirname(gradle_build_file),
+                                                                              app_package)
+    else:
+        instrumented_manifest = app_manifest
+        java_src_directory = layout.find_package_directory(app_package)
+    instrument.update_manifest_file(instrumented_manifest, app_package, manifest_cache,
+                                    launch_activity if args.library is not None else None,
+                                    manifest_model if instrumented_manifest == app_manifest else None)
+
+    if args.library is None:
+        if java_src_directory is None:
+            logging.error("Failed to find java src directory for " + app_title + ".")
+            return "failed"
+        logging.info("Java SRC directory for " + app_title + " is " + java_src_directory)
+        instrument.add_instrument_classes(args.jacoco, java_src_directory, app_package, launch_activity, use_androidx)
+
+    build_directory = layout.build_directory
     if build_directory is None:
         logging.error("Failed to find build directory for " + app_title + ".")
-        continue
+        return "failed"
+    logging.info("Build directory for " + app_title + " is " + build_directory)
+
+    java_home = toolchain_resolver.resolve(app, build_directory)
+    logging.info("JDK for " + app_title + " is " + str(java_home or "the default JDK") + ".")
+
+    # Apps are only built again when their patched source, the instrumentation templates, the Gradle tasks or the JDK
+    # changed since the last build.
+    outputs = {build_type: (apk_directories[build_type], caches[build_type]) for build_type in build_tasks}
+    tasks = [build_tasks[build_type] for build_type in build_tasks] + (["--continue"] if args.combined else [])
+    # The library is linked into the worktree, so it is part of the worktree's fingerprint.
+    fingerprint = buildcache.get_fingerprint(worktree_directory, tasks, args.jacoco if args.library is None else None)
+    statuses = {build_type: "skipped" for build_type, (directory, cache) in outputs.items()
+                if cache.lookup(app, fingerprint, java_home, os.path.join(directory, apk_file)) is not None}
+    if len(statuses) == len(outputs):
+        logging.info(app_title + " already built, Skipping.")
+        return statuses if args.combined else "skipped"
 
+    # Both build types are assembled by one Gradle invocation, which configures the project and resolves its
+    # dependencies once. With --continue a build type still builds when the other one fails.
     logging.info("Running gradle build on " + app_title + ".")
-    if subprocess.call(os.getcwd() + "/gradlew.sh assembleDebug > " + source_directory + "/build.log 2>&1",
-                       cwd=build_directory, shell=True) == 0:
-        copy_apk_file(source_directory, japk_directory, app, app_title)
-    else:
-        logging.error("Gradle build for " + app_title + " failed. See log for details.")
-        if java_11_enabled:
-            logging.info("Running gradle build on " + app_title + " with Java 11.")
-            if subprocess.call(os.getcwd() + "/gradlew.sh assembleDebug -Dorg.gradle.java.home=" + os.environ.get(
-                    "JAVA_11_HOME") + " > " + source_directory + "/java_11_build.log 2>&1", cwd=build_directory,
-                               shell=True) == 0:
-                copy_apk_file(source_directory, japk_directory, app, app_title)
-            else:
-                logging.error("Gradle build for " + app_title + " failed with Java 11. See log for details.")
+    log_file = os.path.abspath(os.path.join(log_directory, app + ".gradle.log"))
+    project.unlink_output_apks(layout)
+    gradle_run = gradle.run_gradle(daemon_pool.command(build_directory, tasks, java_home), build_directory, log_file,
+                                   timeout=args.timeout * 60, output_timeout=args.output_timeout * 60)
+    build_scheduler.add_details(app, {"gradle": gradle_run.summary()})
+    for build_type, (directory, cache) in outputs.items():
+        if build_type in statuses:
+            continue
+        if is_build_type_failed(build_type, gradle_run):
+            logging.error(("Gradle " + build_type + " build" if args.combined else "Gradle build") + " for " + app_title +
+                          " failed. See log for details.")
+            statuses[build_type] = "failed"
+            continue
+
+        link_apk_file(layout, directory, app, app_title, build_type)
+        if not os.path.isfile(os.path.join(directory, apk_file)):
+            statuses[build_type] = "failed"
+            continue
+
+        cache.record(app, fingerprint, java_home, os.path.join(directory, apk_file))
+        statuses[build_type] = "built"
+
+    # A build type reused from the cache was built with the same JDK, the JDK only failed when nothing was built.
+    succeeded = any(status in ("built", "skipped") for status in statuses.values())
+    toolchain_resolver.record(app, build_directory, java_home, None if succeeded else gradle_run.reason)
+    return statuses if args.combined else statuses["debug"]
+
+
+def is_build_type_failed(build_type, gradle_run):
+    if gradle_run.exit_code == 0:
+        return False
+    if gradle_run.reason != "task-failed":
+        return True
+
+    # Tasks of another build type do not fail this one, while shared tasks or a failed configuration fail both.
+    task_names = [task.split(":")[-1] for task in gradle_run.failed_tasks]
+    return not task_names or any(build_type.capitalize() in name or not any(
+        other.capitalize() in name for other in build_tasks) for name in task_names)
+
+
+def build_variants(app):
+    # Apps that fail before Gradle runs fail in every build type.
+    status = instrument_app(app)
+    return status if isinstance(status, dict) else {build_type: status for build_type in build_tasks}
+
+
+apps = []
+for apk_file in sorted(os.listdir(apk_directory)):
+    if not os.path.isfile(os.path.join(apk_directory, apk_file)) or not apk_file.endswith(".apk"):
+        logging.info("Ignoring file " + apk_file)
+        continue
+    apps.append(os.path.splitext(os.path.basename(apk_file))[0])
+
+# Each app's messages and Gradle output are written to its own log files, builds of different apps run concurrently.
+log_directory = os.path.join(args.output, "logs", "jacoco")
+build_scheduler = scheduler.BuildScheduler(log_directory, args.jobs)
+# In combined mode the debug APK is built with the JaCoCo build type and stored in the debug APK directory, otherwise
+# the instrumented debug build type is stored in the JaCoCo APK directory.
+if args.combined:
+    build_tasks = {"debug": "assembleDebug", instrument.BUILD_TYPE: "assemble" + instrument.BUILD_TYPE.capitalize()}
+    apk_directories = {"debug": dapk_directory, instrument.BUILD_TYPE: japk_directory}
+else:
+    build_tasks = {"debug": "assembleDebug"}
+    apk_directories = {"debug": japk_directory}
+# Manifests are only parsed when their hash was not seen before, in this run or an earlier one.
+manifest_cache = manifest.ManifestCache(os.path.join(args.output, manifest.CACHE_FILE))
+caches = {build_type: buildcache.BuildCache(os.path.join(directory, buildcache.CACHE_FILE))
+          for build_type, directory in apk_directories.items()}
+# The JDK for each app is chosen from its Gradle and Android Gradle Plugin versions, the JDK that built an app is
+# remembered for the next run.
+toolchain_resolver = toolchain.ToolchainResolver(os.path.join(args.output, toolchain.TOOLCHAIN_FILE))
+# Gradle daemons are kept warm between apps and share one Gradle user home and build cache, they are registered for
+# this script only and stopped once every app is built unless another run is going to use them.
+daemon_pool = gradle.DaemonPool(args.gradle_home, "jacoco")
+try:
+    build_scheduler.run(apps, build_variants if args.combined else instrument_app)
+finally:
+    manifest_cache.save()
+    if not args.keep_daemons:
+        daemon_pool.stop()
+build_scheduler.log_summary()
+build_scheduler.write_summary()
@@ -0,0 +1,21 @@
+package jacoco.instrument;
+
+import android.content.BroadcastReceiver;
+import android.content.Context;
+import android.content.Intent;
+import android.os.Process;
+
+public class EndEmmaBroadcast extends BroadcastReceiver {
+
+    private final JacocoInstrumentation instrumentation;
+
+    public EndEmmaBroadcast(JacocoInstrumentation instrumentation) {
+        this.instrumentation = instrumentation;
+    }
+
+    @Override
+    public void onReceive(Context context, Intent intent) {
+        instrumentation.onActivityEnd();
+        Process.killProcess(Process.myPid());
+    }
+}
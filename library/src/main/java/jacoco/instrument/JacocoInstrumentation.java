@@ -0,0 +1,175 @@
+package jacoco.instrument;
+
+import static android.Manifest.permission.READ_EXTERNAL_STORAGE;
+import static android.Manifest.permission.WRITE_EXTERNAL_STORAGE;
+import static android.content.pm.PackageManager.PERMISSION_GRANTED;
+
+import android.app.Activity;
+import android.app.Instrumentation;
+import android.content.ComponentName;
+import android.content.Context;
+import android.content.Intent;
+import android.content.IntentFilter;
+import android.content.pm.PackageManager;
+import android.os.Build;
+import android.os.Bundle;
+import android.os.Environment;
+import android.os.Looper;
+import android.util.Log;
+
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+
+/**
+ * Starts the launch activity of the app under test and writes the JaCoCo execution data when it is destroyed or the
+ * end broadcast is received. The launch activity and the broadcast action are read from the meta-data of the
+ * instrumentation element, so the same class works in every app.
+ */
+public class JacocoInstrumentation extends Instrumentation {
+
+    public static final String TAG = "JacocoInstrumentation";
+    public static final String LAUNCH_ACTIVITY = "jacoco.instrument.LAUNCH_ACTIVITY";
+    public static final String END_ACTION = "jacoco.instrument.END_ACTION";
+
+    private String launchActivity;
+    private String endAction;
+    private Intent mIntent;
+    private boolean ended;
+
+    @Override
+    public void onCreate(Bundle arguments) {
+        super.onCreate(arguments);
+
+        Context targetContext = getTargetContext();
+        Bundle metaData = readMetaData();
+        launchActivity = metaData.getString(LAUNCH_ACTIVITY);
+        endAction = metaData.getString(END_ACTION, targetContext.getPackageName() + ".END_EMMA");
+
+        if (launchActivity != null) {
+            mIntent = new Intent(Intent.ACTION_MAIN);
+            mIntent.setClassName(targetContext, launchActivity);
+        } else {
+            mIntent = targetContext.getPackageManager().getLaunchIntentForPackage(targetContext.getPackageName());
+            if (mIntent != null && mIntent.getComponent() != null) {
+                launchActivity = mIntent.getComponent().getClassName();
+            }
+        }
+
+        if (mIntent == null) {
+            Log.e(TAG, "Failed to find the launch activity of " + targetContext.getPackageName() + ".");
+            finish(Activity.RESULT_CANCELED, new Bundle());
+            return;
+        }
+
+        mIntent.addFlags(Intent.FLAG_ACTIVITY_NEW_TASK);
+        start();
+    }
+
+    private Bundle readMetaData() {
+        try {
+            ComponentName component = new ComponentName(getContext(), getClass());
+            Bundle metaData = getContext().getPackageManager()
+                    .getInstrumentationInfo(component, PackageManager.GET_META_DATA).metaData;
+            if (metaData != null) {
+                return metaData;
+            }
+        } catch (PackageManager.NameNotFoundException e) {
+            Log.w(TAG, "Failed to read instrumentation meta-data.", e);
+        }
+
+        return new Bundle();
+    }
+
+    @Override
+    public void onStart() {
+        super.onStart();
+
+        Looper.prepare();
+        EndEmmaBroadcast broadcast = new EndEmmaBroadcast(this);
+        IntentFilter filter = new IntentFilter(endAction);
+        if (Build.VERSION.SDK_INT >= 33) {
+            getTargetContext().registerReceiver(broadcast, filter, Context.RECEIVER_EXPORTED);
+        } else {
+            getTargetContext().registerReceiver(broadcast, filter);
+        }
+        Log.d(TAG, "EndEmmaBroadcast registered for " + endAction + ".");
+
+        startActivitySync(mIntent);
+    }
+
+    @Override
+    public void callActivityOnCreate(Activity activity, Bundle icicle) {
+        super.callActivityOnCreate(activity, icicle);
+
+        if (isLaunchActivity(activity)) {
+            checkStoragePermissions(activity);
+        }
+    }
+
+    @Override
+    public void callActivityOnDestroy(Activity activity) {
+        super.callActivityOnDestroy(activity);
+
+        if (isLaunchActivity(activity) && activity.isFinishing()) {
+            onActivityEnd();
+        }
+    }
+
+    private boolean isLaunchActivity(Activity activity) {
+        return activity.getClass().getName().equals(launchActivity);
+    }
+
+    private void checkStoragePermissions(Activity activity) {
+        if (Build.VERSION.SDK_INT < 23) {
+            return;
+        }
+
+        Log.i(TAG, "Checking Storage Permissions");
+        int readCode = activity.checkSelfPermission(READ_EXTERNAL_STORAGE);
+        int writeCode = activity.checkSelfPermission(WRITE_EXTERNAL_STORAGE);
+        Log.i(TAG, "Read and write codes: " + readCode + "/" + writeCode);
+
+        if (writeCode != PERMISSION_GRANTED || readCode != PERMISSION_GRANTED) {
+            Log.i(TAG, "Asking for storage permissions.");
+            activity.requestPermissions(new String[]{READ_EXTERNAL_STORAGE, WRITE_EXTERNAL_STORAGE}, PERMISSION_GRANTED);
+        }
+    }
+
+    public synchronized void onActivityEnd() {
+        if (ended) {
+            return;
+        }
+
+        ended = true;
+        generateCoverageReport();
+        finish(Activity.RESULT_OK, new Bundle());
+    }
+
+    private void generateCoverageReport() {
+        String fileName = "coverage-" + System.currentTimeMillis() + ".ec";
+        File downloadsFile = Environment.getExternalStoragePublicDirectory(Environment.DIRECTORY_DOWNLOADS);
+        File file = new File(downloadsFile, fileName);
+        Log.d(TAG, "Generating coverage report at " + file);
+
+        OutputStream out = null;
+        try {
+            out = new FileOutputStream(file, true);
+            Object agent = Class.forName("org.jacoco.agent.rt.RT").getMethod("getAgent").invoke(null);
+            if (agent != null) {
+                out.write((byte[]) agent.getClass().getMethod("getExecutionData", boolean.class).invoke(agent, false));
+            }
+        } catch (Exception e) {
+            Log.d(TAG, e.toString(), e);
+        } finally {
+            if (out != null) {
+                try {
+                    out.close();
+                } catch (IOException e) {
+                    e.printStackTrace();
+                }
+            }
+        }
+    }
+}
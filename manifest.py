@@ -0,0 +1,221 @@
+#
+# Author: Jordan Doyle
+#
+
+import hashlib
+import io
+import logging
+import re
+import threading
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
+
+import statefile
+import worktree
+
+CACHE_FILE = "manifest_cache.json"
+CACHE_VERSION = 1
+ANDROID_NAMESPACE = "http://schemas.android.com/apk/res/android"
+TOOLS_NAMESPACE = "http://schemas.android.com/tools"
+NAME = "{" + ANDROID_NAMESPACE + "}name"
+INDEXED_ELEMENTS = {"manifest": ("uses-permission", "instrumentation"),
+                    "application": ("activity", "activity-alias", "receiver", "service", "provider")}
+
+
+def get_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Manifest:
+
+    def __init__(self, manifest_file, data=None):
+        self.manifest_file = manifest_file
+        if data is None:
+            with open(manifest_file, "rb") as manifest_data:
+                data = manifest_data.read()
+        self.data = data
+        self.digest = get_digest(data)
+
+        # The prefixes the manifest declares are kept, elements added to it use the same prefixes.
+        self.prefixes = {}
+        root = None
+        for event, item in ElementTree.iterparse(io.BytesIO(data), events=("start-ns", "start")):
+            if event == "start-ns":
+                self.prefixes.setdefault(item[1], item[0])
+            elif root is None:
+                root = item
+        self.root = root
+        self.application = root.find("application")
+        self.package = root.get("package")
+
+        # Elements are indexed by their fully qualified name, so an element is found however its name is written.
+        self.elements = {}
+        for parent_tag, tags in INDEXED_ELEMENTS.items():
+            parent = self.root if parent_tag == "manifest" else self.application
+            for tag in tags:
+                self.elements[tag] = {} if parent is None else {
+                    self.resolve_name(element.get(NAME)): element for element in parent.findall(tag)
+                    if element.get(NAME) is not None}
+        self.additions = {"manifest": [], "application": []}
+
+    def resolve_name(self, name, package=None):
+        package = package or self.package
+        if name is None or package is None:
+            return name
+        if name.startswith("."):
+            return package + name
+        if "." not in name:
+            return package + "." + name
+        return name
+
+    def find(self, tag, name):
+        return self.elements.get(tag, {}).get(self.resolve_name(name))
+
+    def read_launch_activity(self):
+        # Launcher aliases point to the activity that is started, an action without the launcher category is only
+        # used when no activity has both.
+        candidates = []
+        for tag in ("activity", "activity-alias"):
+            for name, element in self.elements[tag].items():
+                for intent_filter in element.findall("intent-filter"):
+                    actions = [action.get(NAME) for action in intent_filter.findall("action")]
+                    categories = [category.get(NAME) for category in intent_filter.findall("category")]
+                    if "android.intent.action.MAIN" not in actions:
+                        continue
+
+                    activity = name
+                    if tag == "activity-alias":
+                        activity = self.resolve_name(element.get("{" + ANDROID_NAMESPACE + "}targetActivity"))
+                    candidates.append(("android.intent.category.LAUNCHER" not in categories, activity))
+
+        return min(candidates, key=lambda item: item[0])[1] if candidates else None
+
+    def get_prefix(self, namespace, default):
+        return self.prefixes.get(namespace, default)
+
+    def add_element(self, parent, tag, name, attributes=None, children=None):
+        if self.find(tag, name) is not None or any(item[0] == tag and item[1] == name
+                                                   for item in self.additions[parent]):
+            return False
+
+        self.additions[parent].append((tag, name, attributes or {}, children or []))
+        return True
+
+    def format_element(self, tag, name, attributes, children, indent, unit):
+        android = self.get_prefix(ANDROID_NAMESPACE, "android")
+        tools = self.get_prefix(TOOLS_NAMESPACE, "tools")
+        items = ([(android + ":name", name)] if name is not None else []) + [
+            (key.replace("android:", android + ":").replace("tools:", tools + ":"), value)
+            for key, value in attributes.items()]
+        start = indent + "<" + tag + "".join(" " + key + "=" + quoteattr(value) for key, value in items)
+        if not children:
+            return start + " />\n"
+
+        return start + ">\n" + "".join(self.format_element(*child, indent + unit, unit) for child in children) + \
+            indent + "</" + tag + ">\n"
+
+    def save(self):
+        if self.application is None and self.additions["application"]:
+            self.additions["manifest"].append(("application", None, {}, self.additions["application"]))
+            self.additions["application"] = []
+        if not self.additions["manifest"] and not self.additions["application"]:
+            return False
+
+        # Elements are added as text before the closing tags, the rest of the manifest is written back unchanged.
+        text = self.data.decode("utf-8", errors="surrogateescape")
+        newline = "\r\n" if "\r\n" in text else "\n"
+        text = text.replace("\r\n", "\n")
+        indent_match = re.search(r"\n([ \t]+)<", text)
+        unit = indent_match.group(1) if indent_match is not None else "    "
+
+        declarations = ""
+        for namespace, prefix in ((ANDROID_NAMESPACE, "android"), (TOOLS_NAMESPACE, "tools")):
+            if namespace not in self.prefixes:
+                declarations += " xmlns:" + prefix + "=" + quoteattr(namespace)
+                self.prefixes[namespace] = prefix
+
+        if self.additions["application"]:
+            elements = "".join(self.format_element(*item, unit * 2, unit) for item in self.additions["application"])
+            if "</application>" in text:
+                text = insert_before(text, text.rfind("</application>"), elements, unit)
+            else:
+                match = re.search(r"<application\b[^>]*?/>", text)
+                text = text[:match.end() - 2].rstrip() + ">\n" + elements + unit + "</application>" + \
+                    text[match.end():]
+        if self.additions["manifest"]:
+            elements = "".join(self.format_element(*item, unit, unit) for item in self.additions["manifest"])
+            text = insert_before(text, text.rfind("</manifest>"), elements, "")
+        if declarations:
+            match = re.search(r"<manifest\b", text)
+            text = text[:match.end()] + declarations + text[match.end():]
+
+        self.data = text.replace("\n", newline).encode("utf-8", errors="surrogateescape")
+        self.digest = get_digest(self.data)
+        worktree.write_file(self.manifest_file, self.data)
+        self.additions = {"manifest": [], "application": []}
+        return True
+
+
+def insert_before(text, end, elements, indent):
+    # Elements go on lines of their own before the closing tag, which is moved to a new line when it shares one.
+    line_start = text.rfind("\n", 0, end) + 1
+    if text[line_start:end].strip():
+        return text[:end] + "\n" + elements + indent + text[end:]
+    return text[:line_start] + elements + text[line_start:]
+
+
+class ManifestCache:
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.recorded = {}
+
+        cache = statefile.load(cache_file)
+        if isinstance(cache, dict) and cache.get("version") == CACHE_VERSION:
+            self.entries = cache.get("entries", {})
+
+    def lookup(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def record(self, keys, entry):
+        with self.lock:
+            for key in keys:
+                self.entries[key] = entry
+                self.recorded[key] = entry
+
+    def save(self):
+        # Entries are kept in memory during the run and written once at its end, so concurrent builds never wait for
+        # the cache file. The entries recorded in this run are merged into the current file, entries another run
+        # wrote in the meantime are kept.
+        def merge(cache):
+            entries = cache.get("entries", {}) if isinstance(cache, dict) and cache.get("version") == CACHE_VERSION \
+                else {}
+            entries.update(self.recorded)
+            return {"version": CACHE_VERSION, "entries": entries}
+
+        with self.lock:
+            if not self.recorded:
+                return
+            statefile.update(self.cache_file, merge, None)
+            self.recorded = {}
+
+
+def read_manifest(manifest_file, cache=None):
+    # The package and launch activity of a manifest are cached by its hash, manifests seen before are not parsed. The
+    # model of a parsed manifest is returned with them so it can be updated without parsing it again.
+    with open(manifest_file, "rb") as manifest_data:
+        data = manifest_data.read()
+    key = "read:" + get_digest(data)
+    entry = cache.lookup(key) if cache is not None else None
+    if entry is not None:
+        return entry, None
+
+    model = Manifest(manifest_file, data)
+    entry = {"package": model.package, "launchActivity": model.read_launch_activity()}
+    if cache is not None:
+        cache.record([key], entry)
+    logging.debug("Parsed manifest file " + manifest_file + ".")
+    return entry, model
@@ -0,0 +1,167 @@
+#
+# Author: Jordan Doyle
+#
+# usage: merge.py [-h] [-o OUTPUT] [-v] [-i INPUT] [-n JOBS] [-c]
+#
+# options:
+#   -h, --help                          show this help message and exit
+#   -o OUTPUT, --output OUTPUT          set output directory
+#   -v, --verbose                       output all log messages
+#   -i INPUT, --input INPUT             set coverage directory, defaults to <output>/coverage
+#   -n JOBS, --jobs JOBS                maximum concurrent merge processes
+#   -c, --clean                         merge every coverage file again
+#
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+
+import execdata
+
+# Coverage files are merged in tasks of this many files, so the files of one app are spread over the processes.
+FILES_PER_TASK = 64
+SUMMARY_FILE = "summary.json"
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-o", "--output", type=str, default='output', help="set output directory")
+arg_parser.add_argument("-v", "--verbose", default=False, action="store_true", help="output all log messages")
+arg_parser.add_argument("-i", "--input", type=str, default=None,
+                        help="set coverage directory, defaults to <output>/coverage")
+arg_parser.add_argument("-n", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="maximum concurrent merge processes")
+arg_parser.add_argument("-c", "--clean", default=False, action="store_true", help="merge every coverage file again")
+args = arg_parser.parse_args()
+
+log_level = logging.DEBUG if args.verbose else logging.INFO
+log_format = '[%(levelname)s] (%(filename)s:%(lineno)d) - %(message)s'
+logging.basicConfig(level=log_level, format=log_format,
+                    handlers=[logging.FileHandler(os.path.join(args.output, 'merge.log')),
+                              logging.StreamHandler(sys.stdout)])
+
+if not os.path.isdir(args.output):
+    logging.error("Provided output directory (" + args.output + ") does not exist.")
+    exit(20)
+
+coverage_directory = args.input or os.path.join(args.output, "coverage")
+if not os.path.isdir(coverage_directory):
+    logging.error("Coverage directory (" + coverage_directory + ") does not exist.")
+    exit(40)
+
+merged_directory = os.path.join(args.output, "merged")
+if args.clean and os.path.isdir(merged_directory):
+    logging.info("Deleting previous merged coverage files.")
+    shutil.rmtree(merged_directory)
+
+if not os.path.isdir(merged_directory):
+    logging.info("Creating new merged coverage directory (" + merged_directory + ").")
+    os.makedirs(merged_directory)
+
+
+def find_exec_files(app_directory):
+    exec_files = {}
+    for directory, directories, files in os.walk(app_directory):
+        directories.sort()
+        for file in sorted(files):
+            if not file.endswith(execdata.EXEC_EXTENSIONS):
+                continue
+            stat = os.stat(os.path.join(directory, file))
+            exec_files[os.path.relpath(os.path.join(directory, file), app_directory)] = [stat.st_size,
+                                                                                        stat.st_mtime_ns]
+    return exec_files
+
+
+def load_state(state_file):
+    if not os.path.isfile(state_file):
+        return {}
+
+    try:
+        with open(state_file) as state_data:
+            return json.load(state_data)
+    except ValueError:
+        return {}
+
+
+def plan_app(app):
+    # Probes are only ever set, so a merged file stays valid while the files it was merged from are unchanged, and
+    # only files added since the last run are merged into it.
+    exec_files = find_exec_files(os.path.join(coverage_directory, app))
+    state = load_state(os.path.join(merged_directory, app + ".json"))
+    inputs = state.get("inputs", {})
+    merged_file = os.path.join(merged_directory, app + ".exec")
+    if inputs and os.path.isfile(merged_file) and all(exec_files.get(file) == value for file, value in inputs.items()):
+        return exec_files, [file for file in exec_files if file not in inputs], state
+    return exec_files, list(exec_files), {}
+
+
+def write_app(app, exec_files, store, invalid, partial):
+    # The merged file is written before the state that lists its inputs, an interrupted run merges the files again.
+    store.write(os.path.join(merged_directory, app + ".exec"))
+    summary = store.summary()
+    with open(os.path.join(merged_directory, app + ".json.part"), "w") as state_data:
+        state_data.write(json.dumps({"inputs": exec_files, "invalid": invalid, "partial": partial,
+                                       "summary": summary}, indent=4))
+    os.replace(os.path.join(merged_directory, app + ".json.part"), os.path.join(merged_directory, app + ".json"))
+    return summary
+
+
+if __name__ == "__main__":
+    apps = sorted(app for app in os.listdir(coverage_directory) if os.path.isdir(os.path.join(coverage_directory, app)))
+    summaries = {}
+
+    # Workers are forked, so they do not run this script again, and the files of every app are submitted before any
+    # result is collected so the processes are kept busy.
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs),
+                                                      mp_context=multiprocessing.get_context("fork"))
+    tasks = {}
+    for app in apps:
+        exec_files, pending, state = plan_app(app)
+        app_directory = os.path.join(coverage_directory, app)
+        tasks[app] = (exec_files, state, len(pending), [
+            (pending[index:index + FILES_PER_TASK], executor.submit(
+                execdata.merge_files, [os.path.join(app_directory, file) for file in
+                                       pending[index:index + FILES_PER_TASK]]))
+            for index in range(0, len(pending), FILES_PER_TASK)])
+
+    for app in apps:
+        exec_files, state, merged, futures = tasks[app]
+        if not futures and state:
+            logging.info("Coverage of " + app + " is already merged, Skipping.")
+            summaries[app] = dict(state["summary"], files=len(exec_files), invalid=len(state.get("invalid", [])),
+                                  partial=len(state.get("partial", [])))
+            summaries[app].pop("classCoverage", None)
+            continue
+
+        store = execdata.ExecutionDataStore()
+        invalid = list(state.get("invalid", []))
+        partial = list(state.get("partial", []))
+        if state:
+            store.read(os.path.join(merged_directory, app + ".exec"))
+        for files, future in futures:
+            task_store, task_invalid, task_partial = future.result()
+            try:
+                store.merge(task_store)
+                invalid += [os.path.relpath(file, os.path.join(coverage_directory, app)) for file in task_invalid]
+                partial += [os.path.relpath(file, os.path.join(coverage_directory, app)) for file in task_partial]
+            except ValueError as error:
+                # The files of a task are only incompatible with other tasks when the app changed between test
+                # sessions, all of them are reported as invalid.
+                logging.warning("Skipping " + str(len(files)) + " coverage file(s) of " + app + ". " + str(error))
+                invalid += files
+
+        summary = write_app(app, exec_files, store, invalid, partial)
+        logging.info("Merged " + str(merged) + " coverage file(s) of " + app + ", " + str(summary["coveredProbes"]) +
+                     " of " + str(summary["probes"]) + " probes covered (" +
+                     str(round(summary["coverage"] * 100, 2)) + "%).")
+        summaries[app] = dict(summary, files=len(exec_files), invalid=len(invalid), partial=len(partial))
+        summaries[app].pop("classCoverage")
+
+    executor.shutdown()
+    with open(os.path.join(merged_directory, SUMMARY_FILE + ".part"), "w") as summary_data:
+        summary_data.write(json.dumps(summaries, indent=4))
+    os.replace(os.path.join(merged_directory, SUMMARY_FILE + ".part"), os.path.join(merged_directory, SUMMARY_FILE))
+    logging.info("Merged the coverage of " + str(len(apps)) + " app(s) into " + merged_directory + ".")
@@ -0,0 +1,210 @@
+#
+# Author: Jordan Doyle
+#
+
+import json
+import os
+from collections import deque
+
+BUILD_FILES = ("build.gradle", "build.gradle.kts")
+SETTINGS_FILES = ("settings.gradle", "settings.gradle.kts")
+# Directories that never contain project files, Gradle build directories are only skipped next to a build file.
+PRUNED_DIRECTORIES = {".git", ".gradle", ".idea", ".svn", ".hg", "node_modules"}
+SOURCE_DIRECTORIES = ("java", "kotlin")
+CONTENT_DIRECTORIES = ("java", "kotlin", "res", "assets", "jniLibs", "aidl", "cpp")
+# Android Gradle Plugin 4.1 and newer write output-metadata.json next to the APK files, older versions output.json.
+OUTPUT_METADATA_FILES = ("output-metadata.json", "output.json")
+
+
+class ProjectLayout:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.build_files = []
+        self.settings_files = []
+        self.manifests = []
+        self.source_roots = []
+        self.properties_files = []
+        self.output_directories = []
+        self.output_apks = []
+        self.build_directory = None
+        self.app_build_file = None
+        self.main_manifest = None
+
+    def module_directories(self):
+        directories = [os.path.dirname(self.app_build_file)] if self.app_build_file is not None else []
+        return directories + [os.path.dirname(build_file) for build_file in self.build_files
+                              if os.path.dirname(build_file) not in directories]
+
+    def find_package_directory(self, package):
+        # Source roots of the application module are checked first, the package directory is not scanned for.
+        package_path = package.replace(".", os.path.sep)
+        for module_directory in self.module_directories():
+            for source_root in self.source_roots:
+                source_set = os.path.dirname(source_root)
+                if os.path.basename(source_set) != "main" or os.path.dirname(os.path.dirname(source_set)) != \
+                        module_directory:
+                    continue
+                if os.path.isdir(os.path.join(source_root, package_path)):
+                    return os.path.join(source_root, package_path)
+
+        return None
+
+
+def is_application_module(build_file):
+    with open(build_file, errors="replace") as build_data:
+        contents = build_data.read()
+
+    # Matches the plugin id as well as version catalog aliases such as libs.plugins.android.application.
+    return "android.application" in contents
+
+
+def list_output_apks(output_directories):
+    apk_files = []
+    for output_directory in output_directories:
+        for directory, _, files in os.walk(output_directory):
+            apk_files += [os.path.join(directory, file) for file in sorted(files) if file.endswith(".apk")]
+
+    return apk_files
+
+
+def scan_directory(layout):
+    # Directories are visited breadth first in name order, so files closer to the project root are found first.
+    directories = deque([(layout.directory, 0)])
+    while directories:
+        directory, depth = directories.popleft()
+        with os.scandir(directory) as scanned_entries:
+            entries = sorted(scanned_entries, key=lambda item: item.name)
+
+        names = {entry.name for entry in entries}
+        has_build_file = any(name in names for name in BUILD_FILES)
+        source_set = os.path.basename(os.path.dirname(directory)) == "src"
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in PRUNED_DIRECTORIES:
+                    continue
+                if entry.name == "build" and has_build_file:
+                    output_directory = os.path.join(entry.path, "outputs", "apk")
+                    if os.path.isdir(output_directory):
+                        layout.output_directories.append(output_directory)
+                    continue
+                if source_set and entry.name in CONTENT_DIRECTORIES:
+                    # Source and resource directories are large and never contain project files.
+                    if entry.name in SOURCE_DIRECTORIES:
+                        layout.source_roots.append(entry.path)
+                    continue
+                directories.append((entry.path, depth + 1))
+            elif entry.name in BUILD_FILES:
+                layout.build_files.append((depth, entry.path))
+            elif entry.name in SETTINGS_FILES:
+                layout.settings_files.append((depth, entry.path))
+            elif entry.name == "AndroidManifest.xml":
+                layout.manifests.append(entry.path)
+            elif entry.name == "local.properties":
+                layout.properties_files.append(entry.path)
+
+
+def scan_project(directory):
+    # The project is walked once per build, every later lookup of the build, including finding its APK files, uses the
+    # returned layout.
+    directory = os.path.abspath(directory)
+    layout = ProjectLayout(directory)
+    scan_directory(layout)
+
+    # The root project is the shallowest settings file, or the shallowest build file when there is none.
+    root_files = layout.settings_files or layout.build_files
+    if root_files:
+        layout.build_directory = os.path.dirname(min(root_files, key=lambda item: item[0])[1])
+    layout.build_files = [build_file for _, build_file in layout.build_files]
+    layout.settings_files = [settings_file for _, settings_file in layout.settings_files]
+
+    module_files = [build_file for build_file in layout.build_files
+                    if os.path.dirname(build_file) != layout.build_directory]
+    # Single module projects apply the application plugin in the root build file, modules are checked first because
+    # root build files often declare the plugin without applying it.
+    root_files = [build_file for build_file in layout.build_files if build_file not in module_files]
+    layout.app_build_file = next((build_file for build_file in module_files + root_files
+                                  if is_application_module(build_file)), module_files[0] if module_files else None)
+
+    if layout.app_build_file is not None:
+        app_manifest = os.path.join(os.path.dirname(layout.app_build_file), "src", "main", "AndroidManifest.xml")
+        if os.path.isfile(app_manifest):
+            layout.main_manifest = app_manifest
+    if layout.main_manifest is None:
+        main_manifests = [manifest for manifest in layout.manifests
+                          if manifest.endswith(os.path.join("src", "main", "AndroidManifest.xml"))]
+        layout.main_manifest = next(iter(main_manifests or layout.manifests), None)
+
+    layout.output_apks = list_output_apks(layout.output_directories)
+    return layout
+
+
+def find_output_apks(layout, build_type=None):
+    # Only the Gradle output directories of the modules are searched for the APK files created by a build.
+    output_directories = [os.path.join(os.path.dirname(build_file), "build", "outputs", "apk")
+                          for build_file in layout.build_files]
+    layout.output_directories = [directory for directory in output_directories if os.path.isdir(directory)]
+    layout.output_apks = list_output_apks(layout.output_directories)
+    if build_type is None:
+        return layout.output_apks
+
+    # APK files are written to outputs/apk/<flavor>/<build type>, or outputs/apk/<build type> without flavors.
+    return [apk_file for apk_file in layout.output_apks
+            if build_type in os.path.dirname(apk_file).split(os.path.sep)[-2:]]
+
+
+def read_output_metadata(metadata_file):
+    # Returns the variant name, APK file and whether the APK is filtered, e.g. by ABI, for every listed output.
+    try:
+        with open(metadata_file) as metadata_data:
+            metadata = json.load(metadata_data)
+    except (OSError, ValueError):
+        return []
+
+    directory = os.path.dirname(metadata_file)
+    outputs = []
+    if isinstance(metadata, dict):
+        for element in metadata.get("elements", []):
+            if "outputFile" in element:
+                outputs.append((metadata.get("variantName"), os.path.join(directory, element["outputFile"]),
+                                bool(element.get("filters")) and element.get("type") != "UNIVERSAL"))
+    elif isinstance(metadata, list):
+        for element in metadata:
+            apk_data = element.get("apkData", {})
+            if element.get("outputType", {}).get("type") == "APK" and "path" in element:
+                outputs.append((apk_data.get("fullName"), os.path.join(directory, element["path"]),
+                                apk_data.get("type") not in ("MAIN", "UNIVERSAL")))
+
+    return outputs
+
+
+def find_output_apk(layout, build_type):
+    # The metadata written by the Android Gradle Plugin names the APK of each variant, so the APK of the build type is
+    # found without relying on file names. Variants of product flavors end with the build type, e.g. freeDebug.
+    for module_directory in layout.module_directories():
+        output_directory = os.path.join(module_directory, "build", "outputs", "apk")
+        candidates = []
+        for directory, directories, files in os.walk(output_directory):
+            directories.sort()
+            for metadata_file in OUTPUT_METADATA_FILES:
+                if metadata_file in files:
+                    candidates += [(filtered, variant_name, apk_file) for variant_name, apk_file, filtered
+                                   in read_output_metadata(os.path.join(directory, metadata_file))
+                                   if variant_name is not None and (variant_name == build_type or variant_name.endswith(
+                                       build_type[:1].upper() + build_type[1:])) and os.path.isfile(apk_file)]
+                    break
+
+        if candidates:
+            return min(candidates)[2]
+
+    # Projects built without metadata fall back to the APK files in the output directory of the build type.
+    return next(iter(find_output_apks(layout, build_type)), None)
+
+
+def unlink_output_apks(layout):
+    # APK files are hard linked into the APK directories, Gradle may update an APK file in place when it packages the
+    # app again, so linked APK files are removed from the output before a build.
+    for apk_file in find_output_apks(layout):
+        if os.stat(apk_file).st_nlink > 1:
+            os.remove(apk_file)
@@ -0,0 +1,128 @@
+#
+# Author: Jordan Doyle
+#
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BUILD_JOBS = 1
+SUMMARY_FILE = "summary.json"
+# Memory reserved for each concurrent Gradle build, a build and its daemon easily use a few GB.
+BUILD_MEMORY = 3 * 1024 * 1024 * 1024
+
+
+def get_available_memory():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def get_job_limit(jobs):
+    limit = max(1, min(jobs, os.cpu_count() or 1))
+
+    memory = get_available_memory()
+    if memory is not None:
+        limit = max(1, min(limit, memory // BUILD_MEMORY))
+
+    if limit < jobs:
+        logging.warning("Limiting concurrent builds to " + str(limit) + " for the available CPU and memory.")
+    return limit
+
+
+class ThreadFilter(logging.Filter):
+
+    def __init__(self, thread_name):
+        super().__init__()
+        self.thread_name = thread_name
+
+    def filter(self, record):
+        return record.threadName == self.thread_name
+
+
+def log_counts(statuses, description):
+    logging.info("Built " + str(statuses.count("built")) + ", skipped " + str(statuses.count("skipped")) +
+                 " and failed " + str(statuses.count("failed")) + " of " + str(len(statuses)) + " " + description + ".")
+
+
+class BuildScheduler:
+
+    def __init__(self, log_directory, jobs=BUILD_JOBS):
+        self.log_directory = log_directory
+        self.jobs = get_job_limit(jobs)
+        self.results = []
+        self.details = {}
+        self.lock = threading.Lock()
+
+    def run_app(self, function, app):
+        # Messages logged while building an app are also written to a log file of its own, workers build one app at a
+        # time so the thread name identifies the app.
+        handler = logging.FileHandler(os.path.join(self.log_directory, app + ".log"), mode="w")
+        handler.setFormatter(logging.getLogger().handlers[0].formatter)
+        handler.addFilter(ThreadFilter(threading.current_thread().name))
+        logging.getLogger().addHandler(handler)
+
+        start = datetime.now()
+        try:
+            status = function(app)
+        except Exception as error:
+            logging.exception("Unexpected error building " + app + ". " + str(error))
+            status = "failed"
+        finally:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+
+        result = {"app": app, "status": status, "duration": round((datetime.now() - start).total_seconds(), 1)}
+        with self.lock:
+            result.update(self.details.pop(app, {}))
+        if isinstance(status, dict):
+            # Apps built in more than one variant report the status of each of them, the app failed when any failed.
+            result["variants"] = status
+            result["status"] = "failed" if "failed" in status.values() else \
+                "built" if "built" in status.values() else "skipped"
+        with self.lock:
+            self.results.append(result)
+        return result
+
+    def add_details(self, app, details):
+        # Details such as the Gradle failure reason are added to the result of the app in the summary file.
+        with self.lock:
+            self.details.setdefault(app, {}).update(details)
+
+    def run(self, apps, function):
+        os.makedirs(self.log_directory, exist_ok=True)
+        logging.info("Building " + str(len(apps)) + " app(s) with " + str(self.jobs) + " concurrent build(s).")
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for app in apps:
+                executor.submit(self.run_app, function, app)
+
+        return self.results
+
+    def log_summary(self):
+        for result in sorted(self.results, key=lambda item: item["app"]):
+            variants = result.get("variants", {})
+            details = " (" + ", ".join(variant + " " + variants[variant] for variant in sorted(variants)) + ")" \
+                if variants else ""
+            logging.info("Build summary: " + result["app"] + " " + result["status"] + " in " +
+                         str(result["duration"]) + " second(s)" + details + ".")
+
+        for variant in sorted({variant for result in self.results for variant in result.get("variants", {})}):
+            log_counts([result["variants"][variant] for result in self.results
+                        if variant in result.get("variants", {})], variant + " app(s)")
+        log_counts([result["status"] for result in self.results], "app(s)")
+
+    def write_summary(self):
+        summary_file = os.path.join(self.log_directory, SUMMARY_FILE)
+        with open(summary_file + ".part", "w") as summary_data:
+            summary_data.write(json.dumps(sorted(self.results, key=lambda item: item["app"]), indent=4))
+        os.replace(summary_file + ".part", summary_file)
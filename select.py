@@ -1,7 +1,9 @@
 #
 # Author Jordan Doyle.
 #
-# usage: select.py [-h] [-o OUTPUT] [-d] [-s] [-f] [-a AGE] [-i MIN] [-x MAX] [-c] [-p] [-v] [-g]
+# usage: select.py [-h] [-o OUTPUT] [-d] [-s] [-f] [-a AGE] [-i MIN] [-x MAX] [-c] [-p] [-v] [-g] [-t] [-k] [-r]
+#                  [-e REPOSITORY] [-j JOBS] [-w] [-b] [-n NUMBER] [-m {stratified,weighted}] [-y SEED]
+#                  [-q FILTER] [-l PROFILES] [-u] [-z STORE] [-Z STORE_SIZE]
 #
 # options:
 #   -h, --help                          show this help message and exit
@@ -16,9 +18,28 @@
 #   -p, --package                       output packages
 #   -v, --verbose                       output all log messages
 #   -g, --category-packages             output category packages
+#   -t, --stream                        stream app index file
+#   -k, --cache                         cache app index records
+#   -r, --refresh                       refresh app index file
+#   -e REPOSITORY, --repository REPOSITORY
+#                                       F-Droid repository address
+#   -j JOBS, --jobs JOBS                maximum concurrent downloads
+#   -w, --stream-source                 extract source archive while downloading
+#   -b, --drop-archive                  delete source archive after extracting
+#   -n NUMBER, --number NUMBER          apps selected per category
+#   -m {stratified,weighted}, --sampling {stratified,weighted}
+#                                       category sampling method
+#   -y SEED, --seed SEED                selection seed
+#   -q FILTER, --filter FILTER          additional filter expression, e.g. "minSdk between 16 and 29 and age < 10y"
+#   -l PROFILES, --profiles PROFILES    selection profile file
+#   -u, --incremental                   only filter packages changed since the previous selection
+#   -z STORE, --store STORE             artifact store directory shared by output directories
+#   -Z STORE_SIZE, --store-size STORE_SIZE
+#                                       maximum artifact store size in GB
 #
 
 import argparse
+import itertools
 import json
 import logging
 import os
@@ -26,10 +47,17 @@ import random
 import shutil
 import sys
 from datetime import datetime
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
 
 import wget
 
+import download
+import filters
+import incremental
+import index
+import selection
+import store
+
 argParser = argparse.ArgumentParser()
 argParser.add_argument("-o", "--output", type=str, default='output', help="output directory")
 argParser.add_argument("-d", "--download", default=False, action="store_true", help="download APK files")
@@ -42,6 +70,28 @@ argParser.add_argument("-c", "--category", default=False, action="store_true", h
 argParser.add_argument("-p", "--package", default=False, action="store_true", help="output packages")
 argParser.add_argument("-v", "--verbose", default=False, action="store_true", help="output all log messages")
 argParser.add_argument("-g", "--category-packages", default=False, action="store_true", help="output category packages")
+argParser.add_argument("-t", "--stream", default=False, action="store_true", help="stream app index file")
+argParser.add_argument("-k", "--cache", default=False, action="store_true", help="cache app index records")
+argParser.add_argument("-r", "--refresh", default=False, action="store_true", help="refresh app index file")
+argParser.add_argument("-e", "--repository", type=str, default='https://f-droid.org/repo',
+                       help="F-Droid repository address")
+argParser.add_argument("-j", "--jobs", type=int, default=download.DOWNLOAD_JOBS, help="maximum concurrent downloads")
+argParser.add_argument("-w", "--stream-source", default=False, action="store_true",
+                       help="extract source archive while downloading")
+argParser.add_argument("-b", "--drop-archive", default=False, action="store_true",
+                       help="delete source archive after extracting")
+argParser.add_argument("-n", "--number", type=int, default=1, help="apps selected per category")
+argParser.add_argument("-m", "--sampling", type=str, default="stratified", choices=selection.SAMPLING_METHODS,
+                       help="category sampling method")
+argParser.add_argument("-y", "--seed", type=int, default=None, help="selection seed")
+argParser.add_argument("-q", "--filter", type=str, default=[], action="append", help="additional filter expression")
+argParser.add_argument("-l", "--profiles", type=str, default=None, help="selection profile file")
+argParser.add_argument("-u", "--incremental", default=False, action="store_true",
+                       help="only filter packages changed since the previous selection")
+argParser.add_argument("-z", "--store", type=str, default=None,
+                       help="artifact store directory shared by output directories")
+argParser.add_argument("-Z", "--store-size", type=float, default=store.STORE_SIZE,
+                       help="maximum artifact store size in GB")
 args = argParser.parse_args()
 
 log_level = logging.DEBUG if args.verbose else logging.INFO
@@ -58,10 +108,22 @@ if not os.path.isdir(args.output):
     exit(20)
 
 APP_INDEX_FILE = 'app_index.json'
-if not os.path.isfile(APP_INDEX_FILE):
+APP_INDEX_CACHE = 'app_index.db'
+APP_INDEX_STATE = 'app_index_state.json'
+APP_INDEX_SNAPSHOTS = 'app_index_snapshots'
+SELECTION_STATE = 'f_droid_selection_state.json'
+if args.refresh:
+    logging.info("Refreshing " + APP_INDEX_FILE + " from " + args.repository + ".")
+    try:
+        index.refresh_index(args.repository, APP_INDEX_FILE, APP_INDEX_STATE, APP_INDEX_SNAPSHOTS)
+        logging.info("Refresh successful.")
+    except (URLError, ValueError) as e:
+        logging.error("Error refreshing app index file. " + str(e))
+        exit(30)
+elif not os.path.isfile(APP_INDEX_FILE):
     logging.info("Downloading " + APP_INDEX_FILE + ".")
     try:
-        wget.download('https://f-droid.org/repo/index-v2.json', APP_INDEX_FILE)
+        wget.download(args.repository + '/index-v2.json', APP_INDEX_FILE)
         logging.info("Download successful.")
     except HTTPError as e:
         logging.error("Error downloading app index file." + str(e))
@@ -92,6 +154,16 @@ FILTERED_APPS = {"com.androidfromfrankfurt.workingtimealert": "App will not inst
                  "com.mmazzarolo.breathly": "App can't be instrumented. Code is obfuscated."}
 
 
+# Streamed packages are filtered in batches of this many packages as the index is read.
+FILTER_BATCH_SIZE = 4096
+
+# Reasons logged for packages removed by the default filter rules, see get_filter_rules.
+FILTER_REASONS = {"category": "App category does not meet requirements.",
+                  "age": "App is not maintained, too old.",
+                  "source": "App does not provide source code.",
+                  "sdk": "App does not declare an SDK version between the minimum and maximum."}
+
+
 def write_json_file(file_name, data):
     logging.info("Writing JSON data in '" + os.path.basename(file_name) + "'.")
 
@@ -114,75 +186,181 @@ def get_latest_version(last_updated, versions):
     return latest_version
 
 
-def get_package_dictionary(package, metadata, version):
-    return {"name": metadata["name"]["en-US"], "targetSdkVersion": version["manifest"]["usesSdk"]["targetSdkVersion"],
-            "minSdkVersion": version["manifest"]["usesSdk"]["minSdkVersion"], "package": package,
-            "source": package_data["repo"]["address"] + version["src"]["name"], "categories": metadata["categories"],
-            "url": package_data["repo"]["address"] + version["file"]["name"], "lastUpdated": metadata["lastUpdated"],
-            "versionCode": version["manifest"]["versionCode"]}
-
-
-def filtered(package, metadata, version):
-    global manual, category, age, sdk, source
-
-    if package in FILTERED_APPS.keys():
-        manual += 1
-        logging.debug("Filtering '" + package + "': " + FILTERED_APPS.get(package))
-        return True
-
-    if not set(metadata["categories"]).isdisjoint(FILTERED_CATEGORIES):
-        category += 1
-        logging.debug("Filtering '" + package + "': App category does not meet requirements.")
-        return True
-
-    last_updated = datetime.fromtimestamp(metadata["lastUpdated"] / 1000.0)
-    number_of_years = (datetime.now() - last_updated).days / 365
-    if number_of_years > args.max:
-        age += 1
-        logging.debug("Filtering '" + package + "': App is not maintained, too old.")
-        return True
-
-    if "src" not in version:
-        source += 1
-        logging.debug("Filtering '" + package + "': App does not provide source code.")
-        return True
-
-    if "usesSdk" in version["manifest"]:
-        if not args.min <= version["manifest"]["usesSdk"]["minSdkVersion"] \
-               <= args.max or not args.min <= version["manifest"]["usesSdk"]["targetSdkVersion"] <= args.max:
-            sdk += 1
-            logging.debug("Filtering '" + package + "': App SDK is less than the minimum " + str(
-                args.min) + " or greater than the maximum " + str(args.max) + ".")
-            return True
-    else:
-        sdk += 1
-        logging.debug("Filtering '" + package + "': App does not declare SDK version.")
-        return True
-
-    return False
+def get_package_name(package, metadata):
+    # Names are localised, apps without an en-US name use the first name they have.
+    names = metadata.get("name") or {}
+    if isinstance(names, str):
+        return names
+    return names.get("en-US") or next(iter(names.values()), package)
 
 
-def list_filtered_packages():
-    packages = {}
-
-    for package_name, package_details in package_data["packages"].items():
+def get_package_dictionary(package, metadata, version):
+    manifest = version.get("manifest", {})
+    uses_sdk = manifest.get("usesSdk", {})
+    source = version.get("src", {})
+    source_url = package_data["repo"]["address"] + source["name"] if "name" in source else None
+    return {"name": get_package_name(package, metadata), "targetSdkVersion": uses_sdk.get("targetSdkVersion"),
+            "minSdkVersion": uses_sdk.get("minSdkVersion"), "package": package, "source": source_url,
+            "categories": metadata.get("categories", []),
+            "url": package_data["repo"]["address"] + version["file"]["name"],
+            "lastUpdated": metadata["lastUpdated"], "versionCode": manifest.get("versionCode"),
+            "sha256": version["file"].get("sha256"), "size": version["file"].get("size"),
+            "sourceSha256": source.get("sha256"), "sourceSize": source.get("size")}
+
+
+def list_package_records(package_items):
+    for package_name, package_details in package_items:
         package_metadata = package_details["metadata"]
-        package_version = get_latest_version(package_metadata["lastUpdated"], package_details["versions"])
-
-        if not filtered(package_name, package_details["metadata"], package_version):
-            packages[package_name] = get_package_dictionary(package_name, package_metadata, package_version)
-
-    return packages
-
-
-def list_category_packages(category):
-    packages = {}
-
-    for package_name, package_details in filtered_packages.items():
-        if category in package_details["categories"]:
-            packages[package_name] = package_details
-
-    return packages
+        package_version = get_latest_version(package_metadata["lastUpdated"], package_details.get("versions", {}))
+        # Every package is read before it is filtered, packages without a version can not be selected.
+        if package_version is None:
+            logging.debug("Skipping '" + package_name + "' without versions.")
+            continue
+        yield get_package_dictionary(package_name, package_metadata, package_version)
+
+
+def get_default_profile():
+    return {"name": "default", "output": args.output, "age": args.age, "min": args.min, "max": args.max,
+            "excludedCategories": sorted(FILTERED_CATEGORIES), "filter": args.filter, "number": args.number,
+            "sampling": args.sampling, "seed": args.seed}
+
+
+def load_profiles(file_name):
+    with open(file_name) as profile_file:
+        profile_data = json.load(profile_file)
+
+    profiles = []
+    for profile_index, profile_settings in enumerate(profile_data):
+        profile = get_default_profile()
+        profile["name"] = "profile_" + str(profile_index + 1)
+        if not isinstance(profile_settings, dict):
+            raise ValueError("Profile " + str(profile_index + 1) + " is not a JSON object.")
+        profile.update(profile_settings)
+        if "output" not in profile_settings:
+            profile["output"] = os.path.join(args.output, profile["name"])
+        # A single filter expression or category may be given as a string instead of a list.
+        for field in ("filter", "excludedCategories"):
+            if isinstance(profile[field], str):
+                profile[field] = [profile[field]]
+            elif not isinstance(profile[field], list) or not all(isinstance(item, str) for item in profile[field]):
+                raise ValueError("Profile '" + str(profile["name"]) + "' field '" + field +
+                                 "' must be a string or a list of strings.")
+        for field in ("age", "min", "max", "number"):
+            if not isinstance(profile[field], int) or isinstance(profile[field], bool):
+                raise ValueError("Profile '" + str(profile["name"]) + "' field '" + field + "' must be an integer.")
+        if profile["seed"] is not None and (not isinstance(profile["seed"], int) or isinstance(profile["seed"], bool)):
+            raise ValueError("Profile '" + str(profile["name"]) + "' field 'seed' must be an integer.")
+        if profile["sampling"] not in selection.SAMPLING_METHODS:
+            raise ValueError("Profile '" + profile["name"] + "' has unknown sampling method " +
+                             str(profile["sampling"]))
+        profiles.append(profile)
+
+    return profiles
+
+
+def get_filter_rules(profile):
+    sdk_range = str(profile["min"]) + " and " + str(profile["max"])
+    rules = [("manual", "not manual")]
+    if len(profile["excludedCategories"]) > 0:
+        excluded_categories = ", ".join('"' + category + '"' for category in profile["excludedCategories"])
+        rules.append(("category", "not category in (" + excluded_categories + ")"))
+    rules += [("age", "age <= " + str(profile["age"]) + "y"),
+              ("source", "source"),
+              ("sdk", "minSdk between " + sdk_range + " and targetSdk between " + sdk_range)]
+
+    return rules + [("filter", expression) for expression in profile["filter"]]
+
+
+def create_package_table(records):
+    package_table = filters.PackageTable(records)
+    package_table.add_boolean("manual", (record["package"] in FILTERED_APPS for record in records))
+    return package_table
+
+
+def log_filter_reason(name, expression, package):
+    reason = FILTERED_APPS.get(package) if name == "manual" else FILTER_REASONS.get(name, expression)
+    logging.debug("Filtering '" + package + "': " + reason)
+
+
+def log_filter_counts(rules, counts):
+    for (name, expression), count in zip(rules, counts):
+        logging.info("Filtered " + str(count) + " packages with " + name + " rule '" + expression + "'.")
+
+
+def list_filtered_packages(package_table, rules):
+    remaining, rejected = package_table.apply(rules)
+
+    log_filter_counts(rules, [filters.count_mask(mask) for _, _, mask in rejected])
+    if args.verbose:
+        for name, expression, mask in rejected:
+            for package_details in package_table.select(mask):
+                log_filter_reason(name, expression, package_details["package"])
+
+    return {package_details["package"]: package_details for package_details in package_table.select(remaining)}
+
+
+def stream_filtered_packages(records, profiles):
+    # The rules of every profile are filtered in batches while the index is read, only packages that pass the rules of
+    # at least one profile are kept in memory. The rules are checked on an empty table first, so an invalid rule fails
+    # before the index is read.
+    profile_rules = [get_filter_rules(profile) for profile in profiles]
+    for rules in profile_rules:
+        create_package_table([]).apply(rules)
+
+    results = [({}, [0] * len(rules)) for rules in profile_rules]
+    count = 0
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, FILTER_BATCH_SIZE))
+        if not batch:
+            break
+        count += len(batch)
+
+        package_table = create_package_table(batch)
+        for rules, (filtered_packages, counts) in zip(profile_rules, results):
+            remaining, rejected = package_table.apply(rules)
+            for rule_index, (name, expression, mask) in enumerate(rejected):
+                counts[rule_index] += filters.count_mask(mask)
+                if args.verbose:
+                    for package_details in package_table.select(mask):
+                        log_filter_reason(name, expression, package_details["package"])
+            filtered_packages.update((package_details["package"], package_details)
+                                     for package_details in package_table.select(remaining))
+
+    return count, results
+
+
+def list_incremental_packages(rules, state):
+    failures, changed, unchanged, removed = incremental.evaluate_failures(package_records, rules, state,
+                                                                          create_package_table)
+    logging.info("Evaluated " + str(len(changed)) + " new or updated packages, reused " + str(len(unchanged)) +
+                 " unchanged packages, " + str(len(removed)) + " packages removed from the index.")
+
+    # Packages are reported against the first rule they fail, matching the rule order of a full evaluation.
+    for rule_index, (name, expression) in enumerate(rules):
+        rejected = [package for package, package_failures in failures.items()
+                    if package_failures and package_failures[0] == rule_index]
+        logging.info("Filtered " + str(len(rejected)) + " packages with " + name + " rule '" + expression + "'.")
+        if args.verbose:
+            for package in rejected:
+                log_filter_reason(name, expression, package)
+
+    filtered_packages = {record["package"]: record for record in package_records if not failures[record["package"]]}
+    return filtered_packages, failures
+
+
+def fetch_file(url, file, sha256, size):
+    if artifact_store is None or sha256 is None:
+        downloader.fetch(url, file, sha256, size)
+        return
+
+    # Artifacts are downloaded into the shared store once and linked into each output directory that uses them.
+    if artifact_store.contains(sha256, size):
+        logging.info("Linking '" + os.path.basename(file) + "' from artifact store.")
+    else:
+        os.makedirs(os.path.dirname(artifact_store.path(sha256)), exist_ok=True)
+        downloader.fetch(url, artifact_store.path(sha256), sha256, size)
+    artifact_store.link(sha256, file)
 
 
 def download_apk_file(package_details):
@@ -190,14 +368,18 @@ def download_apk_file(package_details):
     version = str(package_details["versionCode"])
     file = os.path.join(args.output, 'apk', name + '_' + version + '.apk')
 
+    if os.path.isfile(file) and not download.verify_file(file, package_details["sha256"], package_details["size"]):
+        logging.warning(package_details["name"].title() + " APK does not match the index checksum.")
+        os.remove(file)
+
     if not os.path.isfile(file):
         os.makedirs(os.path.dirname(file), exist_ok=True)
         logging.info("Downloading " + package_details["name"].title() + " APK.")
 
         try:
-            wget.download(package_details["url"], file)
-            logging.info("Download successful.")
-        except HTTPError as error:
+            fetch_file(package_details["url"], file, package_details["sha256"], package_details["size"])
+            logging.info("Downloaded " + package_details["name"].title() + " APK.")
+        except (URLError, ValueError) as error:
             logging.error("Error downloading APK file from " + package_details["url"] + ". " + str(error))
     else:
         logging.info(package_details["name"].title() + " APK already downloaded.")
@@ -208,15 +390,50 @@ def download_source_archive(package_details):
     version = str(package_details["versionCode"])
     file = str(os.path.join(args.output, 'archive', name + '_' + version + '.tar.gz'))
     directory = str(os.path.join(args.output, 'source', name + '_' + version))
+    archive_name = package_details["source"].split('/')[-1]
+
+    if os.path.isdir(directory) and not os.path.isfile(file):
+        logging.info(package_details["name"].title() + " archive already extracted.")
+        return
+
+    stored = artifact_store is not None and package_details["sourceSha256"] is not None
+    if stored and not os.path.isfile(file) and artifact_store.contains(package_details["sourceSha256"],
+                                                                       package_details["sourceSize"]):
+        logging.info("Linking " + package_details["name"].title() + " source archive from artifact store.")
+        artifact_store.link(package_details["sourceSha256"], file)
+
+    if args.stream_source and not os.path.isfile(file):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        logging.info("Downloading and extracting " + package_details["name"].title() + " source.")
+
+        archive_file = None if args.drop_archive else file
+        if stored:
+            archive_file = artifact_store.path(package_details["sourceSha256"])
+            os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+        try:
+            downloader.fetch_extract(package_details["source"], directory, archive_name, archive_file,
+                                     package_details["sourceSha256"], package_details["sourceSize"])
+            if stored and not args.drop_archive:
+                artifact_store.link(package_details["sourceSha256"], file)
+            logging.info("Downloaded and extracted " + package_details["name"].title() + " source.")
+        except (URLError, ValueError) as error:
+            logging.error("Error downloading source archive from " + package_details["source"] + ". " + str(error))
+        return
+
+    if os.path.isfile(file) and not download.verify_file(file, package_details["sourceSha256"],
+                                                         package_details["sourceSize"]):
+        logging.warning(package_details["name"].title() + " source does not match the index checksum.")
+        os.remove(file)
 
     if not os.path.isfile(file):
         os.makedirs(os.path.dirname(file), exist_ok=True)
         logging.info("Downloading " + package_details["name"].title() + " source.")
 
         try:
-            wget.download(package_details["source"], file)
-            logging.info("Download successful.")
-        except HTTPError as error:
+            fetch_file(package_details["source"], file, package_details["sourceSha256"], package_details["sourceSize"])
+            logging.info("Downloaded " + package_details["name"].title() + " source.")
+        except (URLError, ValueError) as error:
             logging.error("Error downloading source archive from " + package_details["source"] + ". " + str(error))
     else:
         logging.info(package_details["name"].title() + " source already downloaded.")
@@ -229,7 +446,6 @@ def download_source_archive(package_details):
             shutil.unpack_archive(file, source_directory, "gztar")
             logging.info("Extracting successful.")
 
-            archive_name = package_details["source"].split('/')[-1]
             logging.info("Renaming extracted directory '" + archive_name + "'.")
             archive_directory = os.path.join(source_directory, archive_name)
             if os.path.isdir(archive_directory):
@@ -240,8 +456,19 @@ def download_source_archive(package_details):
         else:
             logging.info(package_details["name"].title() + " archive already extracted.")
 
+    if args.drop_archive and os.path.isdir(directory) and os.path.isfile(file):
+        logging.info("Deleting " + package_details["name"].title() + " source archive.")
+        os.remove(file)
+
+
+def queue_downloads(package_details):
+    if args.download:
+        downloader.submit("apk:" + package_details["package"], download_apk_file, package_details)
+    if args.source:
+        downloader.submit("source:" + package_details["package"], download_source_archive, package_details)
+
 
-def get_random_app_per_category():
+def get_random_app_per_category(category_packages):
     random_packages = {}
     selected_packages = []
     seed_index = 0
@@ -251,11 +478,17 @@ def get_random_app_per_category():
             logging.error("No packages with category " + category)
             continue
 
+        package_names = list(packages.keys())
+        if set(package_names).issubset(selected_packages):
+            logging.error("All packages with category " + category + " are already selected.")
+            continue
+
+        # Seed once per category, a package selected for an earlier category is replaced by the next random number.
+        random.seed(SEED_VALUES[seed_index])
         random_package = random_number = None
         while random_package is None or random_package in selected_packages:
-            random.seed(SEED_VALUES[seed_index])
             random_number = random.randint(1, len(packages))
-            random_package = list(packages.keys())[random_number - 1]
+            random_package = package_names[random_number - 1]
 
         package_details = packages[random_package]
         random_packages[category] = package_details
@@ -265,15 +498,32 @@ def get_random_app_per_category():
         logging.info(
             "Selected '{0}', app {1} from {2} available.".format(package_details["name"].title(), random_number,
                                                                  len(packages)))
-        if args.download:
-            download_apk_file(package_details)
-        if args.source:
-            download_source_archive(package_details)
+        queue_downloads(package_details)
 
     return random_packages
 
 
-def get_manually_selected_apps():
+def get_sampled_apps_per_category(category_packages, profile):
+    sampled_packages = selection.select_packages(category_packages, profile["seed"] or 0, profile["number"],
+                                                 profile["sampling"])
+
+    for category, packages in sampled_packages.items():
+        if len(packages) < profile["number"]:
+            logging.error("Only " + str(len(packages)) + " packages available with category " + category)
+
+        for package_details in packages:
+            logging.info("Selected '{0}' from {1} available in {2}.".format(package_details["name"].title(),
+                                                                          len(category_packages[category]), category))
+            queue_downloads(package_details)
+
+    # One app per category is written as a single record like the unseeded selection, so adding a seed does not change
+    # the format of f_droid_random_apps.json.
+    if profile["number"] == 1:
+        return {category: packages[0] for category, packages in sampled_packages.items() if packages}
+    return sampled_packages
+
+
+def get_manually_selected_apps(filtered_packages):
     packages = []
 
     for package, details in filtered_packages.items():
@@ -282,56 +532,161 @@ def get_manually_selected_apps():
 
         packages.append(details)
         logging.info("Manually selected '{0}', used in previous publication.".format(details["name"].title()))
-        if args.download:
-            download_apk_file(details)
-        if args.source:
-            download_source_archive(details)
+        queue_downloads(details)
 
     return packages
 
 
-logging.info("Loading app index from file '" + APP_INDEX_FILE + "'.")
-app_index_file = open(APP_INDEX_FILE)
-package_data = json.load(app_index_file)
-if args.format:
-    write_json_file(APP_INDEX_FILE, package_data)
-logging.info("Index contains " + str(len(package_data["packages"])) + " packages.")
+def select_profile_apps(profile, streamed=None):
+    if args.profiles is not None:
+        logging.info("Selecting apps for profile '" + profile["name"] + "'.")
+
+    logging.info("Filtering categories that do not meet requirements.")
+    categories = [category for category in index_categories if category not in profile["excludedCategories"]]
+    if args.category:
+        write_json_file(os.path.join(profile["output"], 'f_droid_categories.json'), categories)
+    logging.info("Index contains " + str(len(categories)) + " categories.")
+
+    logging.info("Filtering packages that do not meet requirements.")
+    rules = get_filter_rules(profile)
+    state_file = os.path.join(profile["output"], SELECTION_STATE)
+    signature = incremental.rules_signature(rules, FILTERED_APPS)
+    try:
+        if streamed is not None:
+            filtered_packages, counts = streamed
+            log_filter_counts(rules, counts)
+        elif args.incremental:
+            state = incremental.load_state(state_file, signature)
+            if state is None:
+                logging.info("No previous selection state for these filters, evaluating all packages.")
+            filtered_packages, failures = list_incremental_packages(rules, state)
+        else:
+            filtered_packages = list_filtered_packages(package_table, rules)
+    except ValueError as error:
+        logging.error("Error evaluating package filters. " + str(error))
+        exit(60)
+    if args.package or args.profiles is not None:
+        write_json_file(os.path.join(profile["output"], 'f_droid_packages.json'), filtered_packages)
+    logging.info(str(len(filtered_packages)) + " packages remain after filtering.")
+
+    logging.info("Creating list of packages per category.")
+    category_packages = selection.list_category_packages(filtered_packages, categories)
+    if args.category_packages:
+        write_json_file(os.path.join(profile["output"], 'f_droid_category_packages.json'), category_packages)
+
+    if profile["seed"] is None and profile["number"] == 1 and profile["sampling"] == "stratified":
+        logging.info("Selecting random app per category.")
+        random_app_per_category = get_random_app_per_category(category_packages)
+    else:
+        logging.info("Sampling " + str(profile["number"]) + " app(s) per category with seed " +
+                     str(profile["seed"] or 0) + ".")
+        random_app_per_category = get_sampled_apps_per_category(category_packages, profile)
+    write_json_file(os.path.join(profile["output"], 'f_droid_random_apps.json'), random_app_per_category)
+
+    logging.info("Gathering apps from previous publication.")
+    manually_selected_apps = get_manually_selected_apps(filtered_packages)
+    write_json_file(os.path.join(profile["output"], 'f_droid_manual_apps.json'), manually_selected_apps)
+
+    if args.incremental:
+        selection_changes = incremental.list_selection_changes(state, filtered_packages)
+        for package in selection_changes["updated"]:
+            logging.warning("Previously selected package '" + package + "' has a newer version.")
+        for package in selection_changes["dropped"]:
+            logging.warning("Previously selected package '" + package + "' no longer meets the requirements.")
+        write_json_file(os.path.join(profile["output"], 'f_droid_selection_changes.json'), selection_changes)
+
+        selected_packages = {details["package"]: details for details in manually_selected_apps}
+        for category_selection in random_app_per_category.values():
+            for details in category_selection if isinstance(category_selection, list) else [category_selection]:
+                selected_packages[details["package"]] = details
+        incremental.save_state(state_file, signature, package_records, failures, selected_packages)
+
+
+if args.profiles is not None:
+    logging.info("Loading selection profiles from '" + args.profiles + "'.")
+    try:
+        selection_profiles = load_profiles(args.profiles)
+    except (OSError, ValueError) as error:
+        logging.error("Error loading selection profiles. " + str(error))
+        exit(70)
+else:
+    selection_profiles = [get_default_profile()]
+
+cached_index = None
+if args.cache:
+    logging.info("Loading app index from cache '" + APP_INDEX_CACHE + "'.")
+    index_hash = index.hash_file(APP_INDEX_FILE)
+    cached_index = index.load_cached_index(APP_INDEX_CACHE, index_hash)
+    if cached_index is None:
+        logging.info("App index cache does not contain the current app index file.")
+
+if cached_index is not None:
+    package_data = {"repo": cached_index[0]}
+    package_records = cached_index[1]
+    logging.info("Index contains " + str(len(package_records)) + " packages.")
+else:
+    logging.info("Loading app index from file '" + APP_INDEX_FILE + "'.")
+    if args.stream:
+        # Packages are read from the index file one at a time, only the latest version record of each package is kept
+        # in memory.
+        try:
+            repo_data, index_packages = index.stream_index(APP_INDEX_FILE)
+        except ValueError as error:
+            logging.error("Error streaming app index file. " + str(error))
+            exit(50)
+        package_data = {"repo": repo_data}
+        if args.format:
+            logging.warning("App index file can not be formatted when streaming.")
+    else:
+        app_index_file = open(APP_INDEX_FILE)
+        package_data = json.load(app_index_file)
+        if args.format:
+            write_json_file(APP_INDEX_FILE, package_data)
+        logging.info("Index contains " + str(len(package_data["packages"])) + " packages.")
+        index_packages = package_data["packages"].items()
+
+    package_records = list_package_records(index_packages)
+    if args.cache:
+        package_records = list(package_records)
+        logging.info("Saving app index to cache '" + APP_INDEX_CACHE + "'.")
+        if args.format and not args.stream:
+            index_hash = index.hash_file(APP_INDEX_FILE)
+        index.save_cached_index(APP_INDEX_CACHE, index_hash, package_data["repo"], package_records)
+
+streamed_results = [None] * len(selection_profiles)
+if args.stream and cached_index is None and not args.cache and not args.incremental:
+    # Incremental selection and the index cache need every package record, otherwise streamed packages are filtered as
+    # they are read.
+    try:
+        package_count, streamed_results = stream_filtered_packages(package_records, selection_profiles)
+    except ValueError as error:
+        logging.error("Error evaluating package filters. " + str(error))
+        exit(60)
+    logging.info("Index contains " + str(package_count) + " packages.")
+else:
+    package_records = list(package_records)
+    if args.stream and cached_index is None:
+        logging.info("Index contains " + str(len(package_records)) + " packages.")
+
+    # The package table is shared by all profiles, comparisons used by more than one profile are only evaluated once.
+    package_table = create_package_table(package_records)
 
 logging.info("Finding categories in app index.")
-categories = list(package_data["repo"]["categories"].keys())
-logging.info("Filtering categories that do not meet requirements.")
-categories = [category for category in categories if category not in FILTERED_CATEGORIES]
-if args.category:
-    write_json_file(os.path.join(args.output, 'f_droid_categories.json'), categories)
-logging.info("Index contains " + str(len(categories)) + " categories.")
-
-manual = category = age = sdk = source = 0
-
-logging.info("Filtering packages that do not meet requirements.")
-filtered_packages = list_filtered_packages()
-if args.package:
-    write_json_file(os.path.join(args.output, 'f_droid_packages.json'), filtered_packages)
-logging.info("Filtered " + str(manual) + " packages manually.")
-logging.info("Filtered " + str(category) + " packages with category filter.")
-logging.info("Filtered " + str(age) + " packages above max age.")
-logging.info("Filtered " + str(source) + " packages with no source code.")
-logging.info("Filtered " + str(sdk) + " packages with unsuitable SDK version.")
-logging.info(str(len(filtered_packages)) + " packages remain after filtering.")
-
-logging.info("Creating list of packages per category.")
-category_packages = {}
-for current_category in categories:
-    category_packages[current_category] = list_category_packages(current_category)
-if args.category_packages:
-    write_json_file(os.path.join(args.output, 'f_droid_category_packages.json'), category_packages)
-
-logging.info("Selecting random app per category.")
-random_app_per_category = get_random_app_per_category()
-write_json_file(os.path.join(args.output, 'f_droid_random_apps.json'), random_app_per_category)
-
-logging.info("Gathering apps from previous publication.")
-manually_selected_apps = get_manually_selected_apps()
-write_json_file(os.path.join(args.output, 'f_droid_manual_apps.json'), manually_selected_apps)
+index_categories = list(package_data["repo"]["categories"].keys())
+
+downloader = download.Downloader(args.jobs)
+artifact_store = store.ArtifactStore(args.store, args.store_size * 1024 ** 3) if args.store is not None else None
+
+for selection_profile, streamed_result in zip(selection_profiles, streamed_results):
+    select_profile_apps(selection_profile, streamed_result)
+
+if args.download or args.source:
+    logging.info("Waiting for downloads to finish.")
+    downloader.wait()
+downloader.close()
+
+if artifact_store is not None:
+    artifact_store.evict()
 
 end = datetime.now()
 logging.info("End time: " + end.strftime("%d/%m/%Y-%H:%M:%S"))
@@ -0,0 +1,55 @@
+#
+# Author: Jordan Doyle
+#
+
+import hashlib
+import heapq
+
+SAMPLING_METHODS = ["stratified", "weighted"]
+YEAR_MILLISECONDS = 365 * 24 * 60 * 60 * 1000
+
+
+def list_category_packages(packages, categories):
+    category_packages = {category: {} for category in categories}
+
+    for package_name, package_details in packages.items():
+        for category in package_details["categories"]:
+            if category in category_packages:
+                category_packages[category][package_name] = package_details
+
+    return category_packages
+
+
+def sample_key(seed, category, package):
+    # Each package gets a uniform random key derived from the seed and its own name rather than its position in the
+    # index, so the selection does not change when the index is reordered or unrelated packages are added or removed.
+    digest = hashlib.sha256((str(seed) + ":" + category + ":" + package).encode()).digest()
+    return (int.from_bytes(digest[:8], "big") + 1) / (2 ** 64 + 1)
+
+
+def package_weight(package_details, newest):
+    # Weighted sampling favours recently updated apps, the age is relative to the newest app so it is reproducible.
+    return 1 / (1 + (newest - package_details["lastUpdated"]) / YEAR_MILLISECONDS)
+
+
+def select_packages(category_packages, seed, number=1, sampling="stratified"):
+    newest = max((package_details["lastUpdated"] for packages in category_packages.values()
+                  for package_details in packages.values()), default=0)
+
+    selected_packages = set()
+    selection = {}
+    for category in sorted(category_packages):
+        packages = category_packages[category]
+
+        def rank(package):
+            key = sample_key(seed, category, package)
+            if sampling == "weighted":
+                key = key ** (1 / package_weight(packages[package], newest))
+            return key, package
+
+        available = [package for package in packages if package not in selected_packages]
+        chosen = [package for _, package in heapq.nlargest(number, map(rank, available))]
+        selected_packages.update(chosen)
+        selection[category] = [packages[package] for package in chosen]
+
+    return {category: selection[category] for category in category_packages}
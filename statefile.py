@@ -0,0 +1,49 @@
+#
+# Author: Jordan Doyle
+#
+
+import fcntl
+import json
+import os
+import tempfile
+
+LOCK_SUFFIX = ".lock"
+
+
+def load(state_file):
+    if not os.path.isfile(state_file):
+        return None
+
+    try:
+        with open(state_file) as state_data:
+            return json.load(state_data)
+    except ValueError:
+        return None
+
+
+def write(state_file, state, indent=4):
+    # Every writer gets a temporary file of its own in the same directory, so concurrent writers never replace each
+    # other's partial files.
+    descriptor, temporary_file = tempfile.mkstemp(prefix=os.path.basename(state_file) + ".",
+                                                  dir=os.path.dirname(state_file) or ".")
+    try:
+        with os.fdopen(descriptor, "w") as state_data:
+            state_data.write(json.dumps(state, indent=indent))
+        os.replace(temporary_file, state_file)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+
+def update(state_file, function, indent=4):
+    # build.py and jacoco.py share state files, the file is read again under a lock held across processes and the
+    # changes of this process are merged into it, so the entries written by the other process are kept.
+    with open(state_file + LOCK_SUFFIX, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            state = function(load(state_file))
+            write(state_file, state, indent)
+            return state
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,94 @@
+#
+# Author: Jordan Doyle
+#
+
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+
+import download
+
+STORE_SIZE = 10
+
+
+class ArtifactStore:
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.verified = set()
+
+    def path(self, sha256):
+        # Objects are spread over sub directories by hash prefix so no single directory grows too large.
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def contains(self, sha256, size=None):
+        object_file = self.path(sha256)
+        if not os.path.isfile(object_file) or (size is not None and os.path.getsize(object_file) != size):
+            return False
+
+        # Objects are linked into every output directory that uses them, so each one is checked against its hash once
+        # per run before it is reused. A corrupted object is removed and downloaded again.
+        with self.lock:
+            if sha256 in self.verified:
+                return True
+        if not download.verify_file(object_file, sha256, size):
+            logging.warning("Artifact store object " + sha256 + " does not match its checksum, removing it.")
+            try:
+                os.remove(object_file)
+            except FileNotFoundError:
+                pass
+            return False
+        with self.lock:
+            self.verified.add(sha256)
+        return True
+
+    def touch(self, sha256):
+        now = time.time()
+        os.utime(self.path(sha256), (now, now))
+
+    def link(self, sha256, file_name):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+
+        try:
+            os.link(self.path(sha256), file_name)
+        except OSError as error:
+            # Hard links can not cross file systems or may not be supported, the object is copied instead.
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(self.path(sha256), file_name)
+        self.touch(sha256)
+
+    def objects(self):
+        for prefix in os.scandir(self.directory) if os.path.isdir(self.directory) else []:
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    yield entry.path, entry.stat()
+
+    def evict(self):
+        if self.max_size is None:
+            return 0
+
+        # Objects are removed least recently used first, files linked into output directories keep their data.
+        objects = sorted(self.objects(), key=lambda item: item[1].st_mtime)
+        total_size = sum(stat.st_size for _, stat in objects)
+        removed = 0
+        for object_file, stat in objects:
+            if total_size <= self.max_size:
+                break
+            os.remove(object_file)
+            total_size -= stat.st_size
+            removed += 1
+
+        if removed > 0:
+            logging.info("Removed " + str(removed) + " least recently used object(s) from artifact store '" +
+                         self.directory + "'.")
+        return removed
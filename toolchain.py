@@ -0,0 +1,184 @@
+#
+# Author: Jordan Doyle
+#
+
+import logging
+import os
+import re
+import threading
+
+import gradle
+import statefile
+
+TOOLCHAIN_FILE = "toolchains.json"
+JAVA_HOME_PATTERN = re.compile(r"^JAVA_(\d+)_HOME$")
+RELEASE_PATTERN = re.compile(r'^JAVA_VERSION="(?:1\.)?(\d+)')
+PLUGIN_PATTERNS = [re.compile(r"com\.android\.tools\.build:gradle:([0-9][\w.\-]*)"),
+                   re.compile(r"""id\s*\(?\s*["']com\.android\.(?:application|library)["']\s*\)?\s*version\s*["']"""
+                              r"""([0-9][\w.\-]*)"""),
+                   re.compile(r"""^\s*(?:agp|androidGradlePlugin|android-gradle-plugin|androidGradle)\s*=\s*["']"""
+                              r"""([0-9][\w.\-]*)""", re.MULTILINE)]
+
+# Gradle versions used for Android Gradle Plugin versions when a project has no wrapper, the same pairs as gradlew.sh.
+PLUGIN_GRADLE_VERSIONS = [("8.0", "8.0"), ("7.4", "7.5"), ("7.3", "7.4"), ("7.2.0", "7.3.3"), ("7.1", "7.2"),
+                          ("7.0", "7.0.2"), ("4.2", "6.7.1"), ("4.1", "6.5"), ("4.0", "6.1.1"), ("3.6", "5.6.4"),
+                          ("3.5", "5.4.1"), ("3.4", "5.1.1"), ("3.3", "4.10.1"), ("3.2", "4.6"), ("3.1", "4.4"),
+                          ("3.0", "4.1"), ("2.3", "3.3"), ("2.2", "2.14.1"), ("2.1.3", "2.14.1"), ("2.1", "2.12"),
+                          ("2.0", "2.12")]
+# The newest Java version each Gradle version can run on, from the Gradle compatibility matrix.
+GRADLE_JAVA_VERSIONS = [("8.5", 21), ("8.3", 20), ("7.6", 19), ("7.5", 18), ("7.3", 17), ("7.0", 16), ("6.7", 15),
+                        ("6.3", 14), ("6.0", 13), ("5.4", 12), ("5.0", 11), ("4.7", 10), ("4.3", 9)]
+# The oldest Java version each Android Gradle Plugin version can run on.
+PLUGIN_JAVA_VERSIONS = [("8.0", 17), ("7.0", 11)]
+# Reasons of failed Gradle builds that another JDK may not fail with, other failures say nothing about the JDK.
+JAVA_FAILURES = ["unsupported-java"]
+
+
+def parse_version(version):
+    return tuple(int(part) for part in re.findall(r"\d+", version.split("-")[0])[:3])
+
+
+def read_java_version(java_home):
+    release_file = os.path.join(java_home, "release")
+    if not os.path.isfile(release_file):
+        return None
+
+    with open(release_file, errors="replace") as release:
+        for line in release:
+            match = RELEASE_PATTERN.match(line.strip())
+            if match is not None:
+                return int(match.group(1))
+
+    return None
+
+
+def find_java_homes():
+    # JDKs are taken from JAVA_HOME and JAVA_<version>_HOME, the release file is trusted over the variable name.
+    java_homes = {}
+    for name, java_home in sorted(os.environ.items()):
+        match = JAVA_HOME_PATTERN.match(name)
+        if (name != "JAVA_HOME" and match is None) or not os.path.isdir(java_home):
+            continue
+
+        version = read_java_version(java_home) or (int(match.group(1)) if match is not None else None)
+        if version is not None:
+            java_homes.setdefault(os.path.realpath(java_home), (version, java_home))
+
+    return sorted(java_homes.values(), reverse=True)
+
+
+def read_plugin_version(build_directory):
+    # The root build files are read like gradlew.sh does, followed by a version catalog.
+    for directory in (build_directory, os.path.dirname(build_directory)):
+        for file in ("build.gradle", "build.gradle.kts", "settings.gradle", "settings.gradle.kts",
+                     os.path.join("gradle", "libs.versions.toml")):
+            build_file = os.path.join(directory, file)
+            if not os.path.isfile(build_file):
+                continue
+
+            with open(build_file, errors="replace") as build_data:
+                contents = build_data.read()
+            for pattern in PLUGIN_PATTERNS:
+                match = pattern.search(contents)
+                if match is not None:
+                    return match.group(1)
+
+    return None
+
+
+def get_gradle_version(build_directory, plugin_version):
+    wrapper_version = gradle.read_wrapper_version(build_directory)
+    if wrapper_version is not None or plugin_version is None:
+        return wrapper_version
+
+    return next((gradle_version for prefix, gradle_version in PLUGIN_GRADLE_VERSIONS
+                 if plugin_version.startswith(prefix)), None)
+
+
+def get_java_range(gradle_version, plugin_version):
+    maximum = None
+    if gradle_version is not None:
+        maximum = next((java_version for version, java_version in GRADLE_JAVA_VERSIONS
+                        if parse_version(gradle_version) >= parse_version(version)), 8)
+
+    minimum = 8
+    if plugin_version is not None:
+        minimum = next((java_version for version, java_version in PLUGIN_JAVA_VERSIONS
+                        if parse_version(plugin_version) >= parse_version(version)), 8)
+
+    return minimum, maximum
+
+
+class ToolchainResolver:
+
+    def __init__(self, toolchain_file):
+        self.toolchain_file = toolchain_file
+        self.lock = threading.Lock()
+        self.java_homes = find_java_homes()
+        self.toolchains = self.load()
+
+        for version, java_home in self.java_homes:
+            logging.info("Found Java " + str(version) + " at " + java_home + ".")
+
+    def load(self):
+        return statefile.load(self.toolchain_file) or {}
+
+    def resolve(self, app, build_directory):
+        plugin_version = read_plugin_version(build_directory)
+        gradle_version = get_gradle_version(build_directory, plugin_version)
+        minimum, maximum = get_java_range(gradle_version, plugin_version)
+        logging.info("Gradle " + str(gradle_version) + " with Android Gradle Plugin " + str(plugin_version) +
+                     " needs Java " + str(minimum) + " to " + str(maximum or "any") + ".")
+
+        with self.lock:
+            toolchain = self.toolchains.get(app, {})
+        if toolchain.get("gradle") != gradle_version or toolchain.get("plugin") != plugin_version:
+            toolchain = {}
+
+        # A JDK that built the app before is used again, otherwise the newest compatible JDK that has not failed to
+        # build the app is tried.
+        available = [java_home for _, java_home in self.java_homes]
+        if toolchain.get("javaHome") in available:
+            return toolchain["javaHome"]
+
+        compatible = [java_home for version, java_home in self.java_homes
+                      if version >= minimum and (maximum is None or version <= maximum)]
+        untried = [java_home for java_home in compatible if java_home not in toolchain.get("failed", [])]
+        if untried:
+            return untried[0]
+        if compatible:
+            logging.warning("Every compatible JDK failed to build " + app + " before, trying again.")
+            return compatible[0]
+
+        logging.warning("No compatible JDK found for " + app + ", using the default JDK.")
+        return None
+
+    def record(self, app, build_directory, java_home, reason=None):
+        # Builds without a failure reason succeeded with the JDK.
+        if reason is not None and reason not in JAVA_FAILURES:
+            return
+
+        plugin_version = read_plugin_version(build_directory)
+        gradle_version = get_gradle_version(build_directory, plugin_version)
+
+        with self.lock:
+            toolchain = self.toolchains.get(app, {})
+            if toolchain.get("gradle") != gradle_version or toolchain.get("plugin") != plugin_version:
+                toolchain = {}
+            toolchain.update({"gradle": gradle_version, "plugin": plugin_version})
+
+            if reason is None:
+                toolchain["javaHome"] = java_home
+                toolchain["failed"] = []
+            else:
+                toolchain.pop("javaHome", None)
+                toolchain["failed"] = sorted(set(toolchain.get("failed", []) + [java_home]) - {None})
+            self.toolchains[app] = toolchain
+
+            # Other runs may share the table, their entries for other apps are kept.
+            def merge(toolchains):
+                toolchains = toolchains or {}
+                toolchains[app] = toolchain
+                return toolchains
+
+            statefile.update(self.toolchain_file, merge)
@@ -0,0 +1,165 @@
+#
+# Author: Jordan Doyle
+#
+# usage: verify.py [-h] [-o OUTPUT] [-v] [-n JOBS]
+#
+# options:
+#   -h, --help                          show this help message and exit
+#   -o OUTPUT, --output OUTPUT          set output directory
+#   -v, --verbose                       output all log messages
+#   -n JOBS, --jobs JOBS                maximum concurrent verification processes
+#
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+import axml
+import instrument
+import manifest
+
+REPORT_FILE = "verify.json"
+# Debug APK files are checked in dapk, instrumented APK files in japk.
+APK_DIRECTORIES = ("dapk", "japk")
+DEBUGGABLE = "{" + manifest.ANDROID_NAMESPACE + "}debuggable"
+TARGET_PACKAGE = "{" + manifest.ANDROID_NAMESPACE + "}targetPackage"
+VALUE = "{" + manifest.ANDROID_NAMESPACE + "}value"
+DEX_FILE_PATTERN = re.compile(r"classes\d*\.dex$")
+# Classes compiled with test coverage enabled call the offline JaCoCo agent.
+JACOCO_AGENT = b"Lorg/jacoco/agent/rt/internal"
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-o", "--output", type=str, default='output', help="set output directory")
+arg_parser.add_argument("-v", "--verbose", default=False, action="store_true", help="output all log messages")
+arg_parser.add_argument("-n", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="maximum concurrent verification processes")
+args = arg_parser.parse_args()
+
+log_level = logging.DEBUG if args.verbose else logging.INFO
+log_format = '[%(levelname)s] (%(filename)s:%(lineno)d) - %(message)s'
+logging.basicConfig(level=log_level, format=log_format,
+                    handlers=[logging.FileHandler(os.path.join(args.output, 'verify.log')),
+                              logging.StreamHandler(sys.stdout)])
+
+if not os.path.isdir(args.output):
+    logging.error("Provided output directory (" + args.output + ") does not exist.")
+    exit(20)
+
+
+def read_apk(apk_file, instrumented):
+    with zipfile.ZipFile(apk_file) as apk:
+        model = manifest.Manifest(apk_file, ElementTree.tostring(axml.decode(apk.read("AndroidManifest.xml"))))
+        agent = instrumented and any(JACOCO_AGENT in apk.read(name) for name in apk.namelist()
+                                     if DEX_FILE_PATTERN.match(name))
+    return model, agent
+
+
+def find_instrumentation(model):
+    # Template instrumentation is named after the package of the app's manifest, the library instrumentation has a
+    # package of its own.
+    return next(((name, element) for name, element in model.elements["instrumentation"].items()
+                 if name.endswith(".JacocoInstrumentation")), (None, None))
+
+
+def check_instrumentation(model, errors):
+    name, element = find_instrumentation(model)
+    if element is None:
+        errors.append("Manifest has no JacocoInstrumentation instrumentation.")
+        return None
+
+    if element.get(TARGET_PACKAGE) != model.package:
+        errors.append("Instrumentation targets package " + str(element.get(TARGET_PACKAGE)) + " instead of " +
+                      str(model.package) + ".")
+
+    if name == instrument.LIBRARY_INSTRUMENTATION:
+        meta_data = {item.get(manifest.NAME): item.get(VALUE) for item in element.findall("meta-data")}
+        launch_activity = meta_data.get(instrument.LAUNCH_ACTIVITY_KEY)
+        if launch_activity is None or model.find("activity", launch_activity) is None:
+            errors.append("Instrumentation launch activity " + str(launch_activity) + " is not in the manifest.")
+        if not meta_data.get(instrument.END_ACTION_KEY):
+            errors.append("Instrumentation has no end broadcast action.")
+        return name
+
+    prefix = name[:-len(".JacocoInstrumentation")]
+    if model.find("activity", prefix + ".InstrumentActivity") is None:
+        errors.append("Manifest has no " + prefix + ".InstrumentActivity activity.")
+    receiver = model.find("receiver", prefix + ".EndEmmaBroadcast")
+    if receiver is None:
+        errors.append("Manifest has no " + prefix + ".EndEmmaBroadcast receiver.")
+    elif not any(action.get(manifest.NAME, "").endswith(".END_EMMA") for action in receiver.iter("action")):
+        errors.append("EndEmmaBroadcast receiver does not handle the END_EMMA action.")
+    return name
+
+
+def verify_apk(apk_directory, apk_file):
+    # Runs in a worker process, every check that fails is reported instead of stopping at the first one.
+    instrumented = apk_directory == "japk"
+    result = {"directory": apk_directory, "app": os.path.splitext(os.path.basename(apk_file))[0], "package": None,
+              "debuggable": False, "launchActivity": None, "errors": []}
+    errors = result["errors"]
+    try:
+        model, agent = read_apk(apk_file, instrumented)
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile, ElementTree.ParseError) as error:
+        errors.append("Failed to read the manifest of the APK file, " + str(error))
+        result["status"] = "failed"
+        return result
+
+    result["package"] = model.package
+    if not model.package:
+        errors.append("Manifest has no package name.")
+
+    result["debuggable"] = model.application is not None and model.application.get(DEBUGGABLE) == "true"
+    if not result["debuggable"]:
+        errors.append("Application is not debuggable.")
+
+    result["launchActivity"] = model.read_launch_activity()
+    if result["launchActivity"] is None:
+        errors.append("Manifest has no launcher activity.")
+
+    if instrumented:
+        result["instrumentation"] = check_instrumentation(model, errors)
+        result["jacocoAgent"] = agent
+        if not agent:
+            errors.append("APK file has no classes instrumented by JaCoCo.")
+
+    result["status"] = "failed" if errors else "passed"
+    return result
+
+
+if __name__ == "__main__":
+    apk_files = []
+    for apk_directory in APK_DIRECTORIES:
+        if not os.path.isdir(os.path.join(args.output, apk_directory)):
+            logging.info("Ignoring missing " + apk_directory + " directory.")
+            continue
+        apk_files += [(apk_directory, os.path.join(args.output, apk_directory, apk_file))
+                      for apk_file in sorted(os.listdir(os.path.join(args.output, apk_directory)))
+                      if apk_file.endswith(".apk")]
+
+    # Workers are forked, so they do not run this script again.
+    report = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs),
+                                                mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = [executor.submit(verify_apk, apk_directory, apk_file) for apk_directory, apk_file in apk_files]
+        for (apk_directory, apk_file), future in zip(apk_files, futures):
+            result = future.result()
+            report[apk_directory + "/" + os.path.basename(apk_file)] = result
+            if result["errors"]:
+                logging.error("Verification of " + apk_file + " failed. " + " ".join(result["errors"]))
+            else:
+                logging.info("Verified " + apk_file + ".")
+
+    statuses = [result["status"] for result in report.values()]
+    with open(os.path.join(args.output, REPORT_FILE + ".part"), "w") as report_data:
+        report_data.write(json.dumps({"passed": statuses.count("passed"), "failed": statuses.count("failed"),
+                                      "apks": report}, indent=4))
+    os.replace(os.path.join(args.output, REPORT_FILE + ".part"), os.path.join(args.output, REPORT_FILE))
+    logging.info("Passed " + str(statuses.count("passed")) + " and failed " + str(statuses.count("failed")) + " of " +
+                 str(len(statuses)) + " APK file(s).")
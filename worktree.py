@@ -0,0 +1,112 @@
+#
+# Author: Jordan Doyle
+#
+
+import errno
+import json
+import logging
+import os
+import shutil
+
+WORKTREE_DIRECTORY = "worktrees"
+STATE_SUFFIX = ".json"
+
+
+def get_worktree_directory(output_directory, variant, app):
+    return os.path.join(output_directory, WORKTREE_DIRECTORY, variant, app)
+
+
+def link_file(source_file, file):
+    if os.path.islink(source_file):
+        os.symlink(os.readlink(source_file), file)
+        return
+
+    try:
+        os.link(source_file, file)
+    except OSError as error:
+        # Hard links can not cross file systems or may not be supported, the file is copied instead.
+        if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copy2(source_file, file)
+
+
+def replace_link(source_file, file):
+    # The file is linked under a temporary name first, so the previous file stays in place until it is replaced.
+    if os.path.lexists(file + ".part"):
+        os.remove(file + ".part")
+    link_file(source_file, file + ".part")
+    os.replace(file + ".part", file)
+
+
+def write_file(file, data):
+    # Files of a worktree may be hard links to the extracted source, they are replaced instead of written in place so
+    # the source and the worktrees of other variants never change.
+    with open(file + ".part", "wb" if isinstance(data, bytes) else "w") as part_file:
+        part_file.write(data)
+    if os.path.isfile(file):
+        shutil.copymode(file, file + ".part")
+    os.replace(file + ".part", file)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def load_state(state_file):
+    if not os.path.isfile(state_file):
+        return {}
+
+    try:
+        with open(state_file) as state_data:
+            return json.load(state_data)
+    except ValueError:
+        return {}
+
+
+def create_worktree(source_directory, worktree_directory):
+    # The state maps every linked file to the source file it was linked from, a file is only linked again when its
+    # source changed, so the files a variant patched and the Gradle output in the worktree are kept between runs.
+    state_file = worktree_directory + STATE_SUFFIX
+    state = load_state(state_file)
+    files = {}
+    linked = 0
+
+    for directory, directories, names in os.walk(source_directory):
+        directories.sort()
+        relative_directory = os.path.relpath(directory, source_directory)
+        worktree_subdirectory = os.path.normpath(os.path.join(worktree_directory, relative_directory))
+        if os.path.lexists(worktree_subdirectory) and not os.path.isdir(worktree_subdirectory):
+            os.remove(worktree_subdirectory)
+        os.makedirs(worktree_subdirectory, exist_ok=True)
+
+        # Symbolic links to directories are not followed, they are recreated like files.
+        for name in sorted(names) + [name for name in directories if os.path.islink(os.path.join(directory, name))]:
+            source_file = os.path.join(directory, name)
+            file = os.path.join(worktree_subdirectory, name)
+            relative_file = os.path.normpath(os.path.join(relative_directory, name))
+
+            stat = os.lstat(source_file)
+            files[relative_file] = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+            if os.path.lexists(file) and state.get(relative_file) == files[relative_file]:
+                continue
+
+            remove_path(file)
+            link_file(source_file, file)
+            linked += 1
+
+    removed = 0
+    for relative_file in state:
+        if relative_file not in files and os.path.lexists(os.path.join(worktree_directory, relative_file)):
+            remove_path(os.path.join(worktree_directory, relative_file))
+            removed += 1
+
+    with open(state_file + ".part", "w") as state_data:
+        state_data.write(json.dumps(files))
+    os.replace(state_file + ".part", state_file)
+
+    logging.info("Worktree " + worktree_directory + " has " + str(len(files)) + " file(s), linked " + str(linked) +
+                 " and removed " + str(removed) + ".")
+    return worktree_directory